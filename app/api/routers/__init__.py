@@ -1,8 +1,10 @@
 from fastapi import APIRouter
 
 from .chat import chat_router  # noqa: F401
+from .engine import engine_router  # noqa: F401
 from .query import query_router  # noqa: F401
 
 api_router = APIRouter()
 api_router.include_router(chat_router, prefix="/chat")
 api_router.include_router(query_router, prefix="/query")
+api_router.include_router(engine_router, prefix="/engine")
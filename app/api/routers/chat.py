@@ -1,14 +1,31 @@
+import asyncio
 import logging
-from datetime import datetime
+import os
+from contextlib import asynccontextmanager
+from typing import List, Optional
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException, Request
 from llama_index.core.llms import MessageRole
 
 from app.api.routers.models import (
     ChatData,
     Message,
     Result,
+    SessionInfo,
+    Suggestions,
 )
+from app.api.services.access import private_access
+from app.api.services.sessions import ChatSessions, Session, get_chat_sessions
+from app.api.services.streaming import (
+    StreamFrame,
+    ToolEventHandler,
+    cancel_response_tasks,
+    merge_with_events,
+    sources_frame,
+    stream_response,
+    token_frames,
+)
+from app.api.services.suggestion import get_suggestions
 from app.engine.engine import get_chat_engine
 
 chat_router = r = APIRouter()
@@ -16,32 +33,145 @@ chat_router = r = APIRouter()
 logger = logging.getLogger("uvicorn")
 
 
+def _require_sessions() -> ChatSessions:
+    sessions = get_chat_sessions()
+    if sessions is None:
+        raise HTTPException(status_code=404, detail="Серверные сессии отключены")
+    return sessions
+
+
+@asynccontextmanager
+async def _chat_turn(data: ChatData):
+    """
+    История для агента: из сессии на сервере или, без session_id, из запроса.
+    Без сессии выдаётся None вместо Session
+    """
+    if data.session_id is None:
+        yield data.get_history_messages(), None
+        return
+
+    # Новая сессия начинается с истории из запроса, у существующей история берётся с сервера
+    async with _require_sessions().turn(data.session_id, data.get_history_messages()) as session:
+        yield session.history(), session
+
+
+def _session_info(session: Session) -> SessionInfo:
+    return SessionInfo(
+        session_id=session.session_id,
+        summary=session.summary,
+        messages=[Message(role=m.role, content=m.content or "") for m in session.messages],
+        summarized_messages=session.summarized_messages,
+    )
+
+
+@r.post("/sessions")
+async def create_session() -> SessionInfo:
+    sessions = _require_sessions()
+    return SessionInfo(session_id=sessions.new_session_id())
+
+
+@r.get("/sessions/{session_id}")
+async def get_session(session_id: str) -> SessionInfo:
+    session = await _require_sessions().get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Сессия не найдена")
+    return _session_info(session)
+
+
+@r.delete("/sessions/{session_id}")
+async def delete_session(session_id: str) -> str:
+    if not await _require_sessions().delete(session_id):
+        raise HTTPException(status_code=404, detail="Сессия не найдена")
+    return "ok"
+
+
+@r.get("/suggestions/{suggestion_id}")
+async def get_next_questions(suggestion_id: str) -> Suggestions:
+    suggestions = get_suggestions()
+    entry = suggestions.get(suggestion_id) if suggestions is not None else None
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Подсказки не найдены")
+    return Suggestions(**entry)
+
+
+def _schedule_suggestions(question: str, answer: str) -> Optional[str]:
+    suggestions = get_suggestions()
+    return suggestions.schedule(question, answer) if suggestions is not None else None
+
+
 @r.post("/request")
 async def chat_request(
         data: ChatData,
+        include_private: bool = Depends(private_access),
 ) -> Result:
-    time = datetime.now()
-
     last_message_content = data.get_last_message_content()
-    messages = data.get_history_messages()
 
     params = data.data or {}
 
     chat_engine = get_chat_engine(
-        params=params
+        params=params,
+        include_private=include_private,
     )
 
-    response = await chat_engine.achat(last_message_content, messages)
+    async with _chat_turn(data) as (messages, session):
+        response = await chat_engine.achat(last_message_content, messages)
+        if session is not None:
+            session.add_exchange(last_message_content, response.response)
 
     result = Result(
         result=Message(
             role=MessageRole.ASSISTANT,
             content=response.response
-        )
+        ),
+        session_id=data.session_id,
+        suggestions_id=_schedule_suggestions(last_message_content, response.response),
     )
 
-    print(f'Time start: {time}')
-    print(f'Time end: {datetime.now()}')
-    print(f'Time delta: {datetime.now() - time}')
-
     return result
+
+
+@r.post("/request/stream")
+async def chat_request_stream(
+        request: Request,
+        data: ChatData,
+        include_private: bool = Depends(private_access),
+):
+    last_message_content = data.get_last_message_content()
+
+    params = data.data or {}
+    if data.session_id is not None:
+        _require_sessions()
+
+    queue = asyncio.Queue()
+    chat_engine = get_chat_engine(
+        params=params,
+        event_handlers=[ToolEventHandler(queue)],
+        streaming=True,
+        include_private=include_private,
+    )
+
+    async def frames():
+        async with _chat_turn(data) as (messages, session):
+            response = await chat_engine.astream_chat(last_message_content, messages)
+            tokens: List[str] = []
+            try:
+                if response.source_nodes:
+                    yield sources_frame(response.source_nodes)
+                async for frame in token_frames(response.async_response_gen()):
+                    tokens.append(frame.data["delta"])
+                    yield frame
+            finally:
+                cancel_response_tasks(response)
+            # Прерванный ответ в сессию не попадает
+            if session is not None:
+                session.add_exchange(last_message_content, "".join(tokens))
+
+        # Ответ уже передан полностью; подсказки приходят следующим событием, если успевают
+        # за SUGGESTIONS_STREAM_WAIT секунд, иначе клиент получает их по идентификатору
+        suggestion_id = _schedule_suggestions(last_message_content, "".join(tokens))
+        if suggestion_id is not None:
+            entry = await get_suggestions().wait(suggestion_id, float(os.getenv("SUGGESTIONS_STREAM_WAIT", "10")))
+            if entry is not None:
+                yield StreamFrame("suggestions", entry)
+
+    return stream_response(request, merge_with_events(queue, frames()))
@@ -0,0 +1,74 @@
+import logging
+import os
+
+from fastapi import APIRouter, HTTPException
+from llama_index.core.settings import Settings
+from starlette.concurrency import run_in_threadpool
+
+from app.api.services.suggestion import get_suggestions
+from app.engine.embedding_cache import CachedEmbedding
+from app.engine.llm_scheduler import BatchingLLM
+from app.engine.registry import engine_registry
+from app.engine.reranker import get_reranker
+
+engine_router = r = APIRouter()
+
+logger = logging.getLogger("uvicorn")
+
+
+@r.post("/reload")
+async def engine_reload() -> str:
+    # Пересоздать индекс и инструменты после generate_datasource или правки config/tools.yaml
+    await run_in_threadpool(engine_registry.reload)
+    return "ok"
+
+
+@r.get("/llm-scheduler")
+async def llm_scheduler_metrics() -> dict:
+    # Глубина очереди и размеры пакетов планировщика локальной модели
+    llm = Settings.llm
+    if not isinstance(llm, BatchingLLM):
+        raise HTTPException(status_code=404, detail="Пакетная обработка запросов к модели не включена")
+    return llm.scheduler.metrics.snapshot(llm.scheduler.queue_depth)
+
+
+@r.get("/prefix-cache")
+async def prefix_cache_stats() -> dict:
+    # Доля токенов промптов, взятых из кеша начал вместо повторной обработки моделью
+    llm = Settings.llm
+    prefix_cache = llm.scheduler.backend.prefix_cache if isinstance(llm, BatchingLLM) else None
+    if prefix_cache is None:
+        raise HTTPException(status_code=404, detail="Кеш начал промптов не включён")
+    return prefix_cache.snapshot()
+
+
+@r.get("/embedding-cache")
+async def embedding_cache_stats() -> dict:
+    # Доля попаданий и объём текста, не переданного модели эмбеддингов
+    embed_model = Settings.embed_model
+    if not isinstance(embed_model, CachedEmbedding):
+        raise HTTPException(status_code=404, detail="Кеш эмбеддингов не включён")
+    return embed_model.stats.snapshot()
+
+
+@r.get("/reranker")
+async def reranker_stats() -> dict:
+    # Попадания в кеш оценок и число ответов в порядке поиска из-за бюджета или ошибки
+    if os.getenv("RERANK_ENABLED", "False").lower() != "true":
+        raise HTTPException(status_code=404, detail="Переранжирование не включено")
+    return get_reranker().stats.snapshot()
+
+
+@r.get("/suggestions")
+async def suggestions_stats() -> dict:
+    # Подсказки вопросов: в очереди, из кеша, сгенерированные и пропущенные из-за загрузки LLM
+    suggestions = get_suggestions()
+    if suggestions is None:
+        raise HTTPException(status_code=404, detail="Подсказки вопросов не включены")
+    return suggestions.snapshot()
+
+
+@r.get("/collections")
+async def engine_collections() -> list:
+    # Коллекции (части корпуса), которые можно выбрать в запросе полем collections
+    return engine_registry.collections
@@ -0,0 +1,20 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from app.startup import startup_status
+
+health_router = r = APIRouter()
+
+
+@r.get("/live")
+async def health_live():
+    # Процесс отвечает; 503 только если запуск завершился ошибкой и процесс нужно перезапустить
+    snapshot = startup_status.snapshot()
+    return JSONResponse(status_code=503 if startup_status.failed else 200, content=snapshot)
+
+
+@r.get("/ready")
+async def health_ready():
+    # Модели загружены, индекс открыт и прогрев завершён: можно направлять запросы
+    snapshot = startup_status.snapshot()
+    return JSONResponse(status_code=200 if startup_status.ready else 503, content=snapshot)
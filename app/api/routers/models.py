@@ -1,5 +1,5 @@
 import logging
-from typing import Any, List
+from typing import Any, Dict, List, Optional
 
 from llama_index.core.llms import ChatMessage, MessageRole
 from pydantic import BaseModel, validator
@@ -9,6 +9,10 @@ logger = logging.getLogger("uvicorn")
 
 class QueryPayload(BaseModel):
     query: str
+    # Коллекции (части корпуса) для поиска, по умолчанию — все
+    collections: Optional[List[str]] = None
+    # Фильтры метаданных: {"поле": значение} или {"поле": {"gte": значение}}, поля — из config/metadata.yaml
+    filters: Optional[Dict[str, Any]] = None
 
 
 class Message(BaseModel):
@@ -19,6 +23,8 @@ class Message(BaseModel):
 class ChatData(BaseModel):
     messages: List[Message]
     data: Any = None
+    # История сессии хранится на сервере, клиент передаёт только новое сообщение
+    session_id: Optional[str] = None
 
     class Config:
         json_schema_extra = {
@@ -61,3 +67,20 @@ class ChatData(BaseModel):
 
 class Result(BaseModel):
     result: Message
+    session_id: Optional[str] = None
+    # Подсказки следующих вопросов генерируются после ответа: GET /api/chat/suggestions/{suggestions_id}
+    suggestions_id: Optional[str] = None
+
+
+class Suggestions(BaseModel):
+    id: str
+    # pending — ещё генерируются, ready — готовы
+    status: str
+    questions: List[str] = []
+
+
+class SessionInfo(BaseModel):
+    session_id: str
+    summary: str = ""
+    messages: List[Message] = []
+    summarized_messages: int = 0
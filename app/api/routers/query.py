@@ -1,27 +1,56 @@
+import asyncio
 import logging
 import os
-from datetime import datetime
-from typing import List
+from typing import List, Optional
 
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Request
+from fastapi import Response as HTTPResponse
 from llama_index.core import Settings
-from llama_index.core.agent import AgentRunner
+from llama_index.core.callbacks import CallbackManager
 from llama_index.core.base.response.schema import Response
 from llama_index.core.tools import BaseTool
 
 from app.api.routers.models import QueryPayload
-from app.engine.index import get_index
-from app.engine.tools.query_engine import get_query_engine_tool
+from app.api.services.access import private_access
+from app.api.services.answer_cache import get_answer_cache, set_cache_headers
+from app.api.services.streaming import (
+    StreamFrame,
+    ToolEventHandler,
+    cancel_response_tasks,
+    merge_with_events,
+    response_tokens,
+    sources_frame,
+    stream_response,
+    token_frames,
+)
+from app.engine.engine import create_agent
+from app.engine.filters import build_filters
+from app.engine.registry import engine_registry
+from app.engine.reranker import rerank_settings
+from app.engine.retriever import server_timing_header, track_retrieval_timings
+from app.engine.tools.query_engine import create_query_engine
 
 query_router = r = APIRouter()
 logger = logging.getLogger("uvicorn")
 
 
-@r.post("/complete")
-async def query_complete(payload: QueryPayload) -> str:
-    time = datetime.now()
+def _cache_name(route: str, collections: Optional[List[str]]) -> str:
+    # Ответы по разным наборам коллекций кешируются отдельно
+    if collections is None:
+        return route
+    return f"{route}:{','.join(sorted(set(collections)))}"
+
 
+@r.post("/complete")
+async def query_complete(payload: QueryPayload, http_response: HTTPResponse) -> str:
     query = payload.query
+
+    cache = get_answer_cache("complete")
+    lookup = await cache.lookup(query) if cache else None
+    set_cache_headers(http_response.headers, lookup)
+    if lookup and lookup.hit:
+        return lookup.answer
+
     verbose = os.getenv("VERBOSE", "False").lower() == "true"
     system_prompt = os.getenv("SYSTEM_PROMPT"),
     
@@ -31,63 +60,158 @@ async def query_complete(payload: QueryPayload) -> str:
         system_prompt=system_prompt,
     )).text
 
-    print(f'Time start: {time}')
-    print(f'Time end: {datetime.now()}')
-    print(f'Time delta: {datetime.now() - time}')
+    if cache:
+        await cache.store(query, response, lookup.embedding)
 
     return response
 
 
 @r.post("/request-to-stored-index")
-async def query_request_to_stored_index(payload: QueryPayload) -> str:
-    time = datetime.now()
-
+async def query_request_to_stored_index(
+        payload: QueryPayload,
+        http_response: HTTPResponse,
+        include_private: bool = Depends(private_access),
+) -> str:
     query = payload.query
+    # Неизвестные коллекции и поля фильтров отклоняются до обращения к кешу
+    index = engine_registry.get_index(payload.collections)
+    filters = build_filters(payload.filters, include_private)
+
+    # Кешируются только ответы по открытым документам без фильтров
+    cache = None
+    if not payload.filters and not include_private:
+        cache = get_answer_cache(_cache_name("request-to-stored-index", payload.collections), depends_on_index=True)
+    lookup = await cache.lookup(query) if cache else None
+    set_cache_headers(http_response.headers, lookup)
+    if lookup and lookup.hit:
+        return lookup.answer
+
     verbose = os.getenv("VERBOSE", "False").lower() == "true"
     system_prompt = os.getenv("SYSTEM_PROMPT")
 
-    index = get_index()
-
-    query_engine = index.as_query_engine(
+    query_engine = create_query_engine(
+        index,
+        engine_registry.keyword_index,
+        rerank=rerank_settings("query"),
+        filters=filters,
+        scoped_store=engine_registry.scoped(payload.collections),
         verbose=verbose,
         system_prompt=system_prompt,
     )
 
-    response: Response = await query_engine.aquery(query)
+    with track_retrieval_timings() as timings:
+        response: Response = await query_engine.aquery(query)
+    if timings:
+        http_response.headers["Server-Timing"] = server_timing_header(timings)
 
-    print(f'Time start: {time}')
-    print(f'Time end: {datetime.now()}')
-    print(f'Time delta: {datetime.now() - time}')
+    if cache:
+        await cache.store(query, response.response, lookup.embedding)
 
     return response.response
 
 
 @r.post("/request-agent")
-async def query_request_agent(payload: QueryPayload) -> str:
-    time = datetime.now()
-
+async def query_request_agent(payload: QueryPayload, include_private: bool = Depends(private_access)) -> str:
     query = payload.query
 
     verbose = os.getenv("VERBOSE", "False").lower() == "true"
     system_prompt = os.getenv("SYSTEM_PROMPT")
 
     tools: List[BaseTool] = []
-    index = get_index()
-    if index is not None:
-        query_engine_tool = get_query_engine_tool(index)
+    query_engine_tool = engine_registry.get_query_engine_tool(payload.collections, payload.filters, include_private)
+    if query_engine_tool is not None:
         tools.append(query_engine_tool)
 
-    agent = AgentRunner.from_llm(
-        llm=Settings.llm,
-        tools=tools,
+    agent = create_agent(
+        tools,
         system_prompt=system_prompt,
         verbose=verbose,
     )
 
     response: Response = await agent.aquery(query)
 
-    print(f'Time start: {time}')
-    print(f'Time end: {datetime.now()}')
-    print(f'Time delta: {datetime.now() - time}')
-
     return response.response
+
+
+@r.post("/complete/stream")
+async def query_complete_stream(request: Request, payload: QueryPayload):
+    query = payload.query
+
+    async def frames():
+        completion = await Settings.llm.astream_complete(query)
+        try:
+            async for chunk in completion:
+                if chunk.delta:
+                    yield StreamFrame("token", {"delta": chunk.delta})
+        finally:
+            await completion.aclose()
+
+    return stream_response(request, frames())
+
+
+@r.post("/request-to-stored-index/stream")
+async def query_request_to_stored_index_stream(
+        request: Request,
+        payload: QueryPayload,
+        include_private: bool = Depends(private_access),
+):
+    query = payload.query
+    verbose = os.getenv("VERBOSE", "False").lower() == "true"
+    system_prompt = os.getenv("SYSTEM_PROMPT")
+
+    query_engine = create_query_engine(
+        engine_registry.get_index(payload.collections),
+        engine_registry.keyword_index,
+        rerank=rerank_settings("query"),
+        filters=build_filters(payload.filters, include_private),
+        scoped_store=engine_registry.scoped(payload.collections),
+        streaming=True,
+        verbose=verbose,
+        system_prompt=system_prompt,
+    )
+
+    async def frames():
+        response = await query_engine.aquery(query)
+        yield sources_frame(response.source_nodes)
+        async for frame in token_frames(response_tokens(response)):
+            yield frame
+
+    return stream_response(request, frames())
+
+
+@r.post("/request-agent/stream")
+async def query_request_agent_stream(
+        request: Request,
+        payload: QueryPayload,
+        include_private: bool = Depends(private_access),
+):
+    query = payload.query
+
+    verbose = os.getenv("VERBOSE", "False").lower() == "true"
+    system_prompt = os.getenv("SYSTEM_PROMPT")
+
+    tools: List[BaseTool] = []
+    query_engine_tool = engine_registry.get_query_engine_tool(payload.collections, payload.filters, include_private)
+    if query_engine_tool is not None:
+        tools.append(query_engine_tool)
+
+    queue = asyncio.Queue()
+    agent = create_agent(
+        tools,
+        system_prompt=system_prompt,
+        callback_manager=CallbackManager(handlers=[ToolEventHandler(queue)]),
+        verbose=verbose,
+        streaming=True,
+    )
+
+    async def frames():
+        response = await agent.astream_chat(query)
+        try:
+            if response.source_nodes:
+                yield sources_frame(response.source_nodes)
+            async for frame in token_frames(response.async_response_gen()):
+                yield frame
+        finally:
+            cancel_response_tasks(response)
+
+    return stream_response(request, merge_with_events(queue, frames()))
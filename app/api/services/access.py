@@ -0,0 +1,12 @@
+from typing import Optional
+
+from fastapi import Header
+
+from app.engine.filters import private_access_allowed
+
+PRIVATE_ACCESS_HEADER = "X-Private-Access-Token"
+
+
+def private_access(token: Optional[str] = Header(None, alias=PRIVATE_ACCESS_HEADER)) -> bool:
+    # Доступ к документам с private=true по заголовку с PRIVATE_ACCESS_TOKEN
+    return private_access_allowed(token)
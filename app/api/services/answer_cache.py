@@ -0,0 +1,189 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.settings import Settings
+
+from app.engine.index import get_index_version
+
+logger = logging.getLogger("uvicorn")
+
+
+@dataclass
+class CacheEntry:
+    query: str
+    # Строка эмбеддинга запроса в матрице кеша
+    row: int
+    answer: str
+    created_at: float
+
+
+@dataclass
+class CacheLookup:
+    answer: Optional[str]
+    embedding: Optional[List[float]]
+    similarity: float = 0.0
+
+    @property
+    def hit(self) -> bool:
+        return self.answer is not None
+
+
+class SemanticAnswerCache:
+    """
+    Кеш ответов по эмбеддингу запроса: близкие по смыслу запросы получают
+    сохранённый ответ без извлечения и генерации.
+    Отключается переменной окружения ANSWER_CACHE_ENABLED=False
+    """
+
+    def __init__(
+            self,
+            name: str,
+            threshold: float,
+            ttl: float,
+            max_size: int,
+            depends_on_index: bool = False,
+    ):
+        self.name = name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.depends_on_index = depends_on_index
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # Эмбеддинги записей хранятся строками одной матрицы на max_size записей и не собираются
+        # заново при каждом поиске; размерность известна после первого эмбеддинга
+        self._matrix: Optional[np.ndarray] = None
+        self._occupied = np.zeros(max_size, dtype=bool)
+        self._row_keys: List[Optional[str]] = [None] * max_size
+        self._free_rows: List[int] = list(range(max_size - 1, -1, -1))
+        self._index_version = get_index_version() if depends_on_index else None
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls, name: str, depends_on_index: bool = False) -> Optional["SemanticAnswerCache"]:
+        if os.getenv("ANSWER_CACHE_ENABLED", "True").lower() != "true":
+            return None
+        return cls(
+            name=name,
+            threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95")),
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+            max_size=int(os.getenv("ANSWER_CACHE_MAX_SIZE", "1024")),
+            depends_on_index=depends_on_index,
+        )
+
+    def clear(self):
+        self._entries.clear()
+        self._occupied[:] = False
+        self._free_rows = list(range(self.max_size - 1, -1, -1))
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        self._occupied[entry.row] = False
+        self._free_rows.append(entry.row)
+
+    def _check_index_version(self):
+        if not self.depends_on_index:
+            return
+        version = get_index_version()
+        if version != self._index_version:
+            logger.info(f"Индекс изменился, кеш ответов {self.name} сброшен")
+            self._index_version = version
+            self.clear()
+
+    def _evict_expired(self, now: float):
+        expired = [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl]
+        for key in expired:
+            self._remove(key)
+
+    def _best_match(self, embedding: np.ndarray) -> Tuple[Optional[str], float]:
+        if not self._entries or self._matrix.shape[1] != embedding.shape[0]:
+            return None, 0.0
+        similarities = np.where(self._occupied, self._matrix @ embedding, -np.inf)
+        best = int(np.argmax(similarities))
+        return self._row_keys[best], float(similarities[best])
+
+    async def lookup(self, query: str) -> CacheLookup:
+        self._check_index_version()
+        self._evict_expired(time.monotonic())
+
+        key = _normalize(query)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return CacheLookup(answer=self._entries[key].answer, embedding=None, similarity=1.0)
+
+        embedding = await Settings.embed_model.aget_query_embedding(query)
+        match_key, similarity = self._best_match(_unit(embedding))
+        if match_key is not None and similarity >= self.threshold:
+            self._entries.move_to_end(match_key)
+            self.hits += 1
+            return CacheLookup(
+                answer=self._entries[match_key].answer,
+                embedding=embedding,
+                similarity=similarity,
+            )
+
+        self.misses += 1
+        return CacheLookup(answer=None, embedding=embedding, similarity=similarity)
+
+    async def store(self, query: str, answer: str, embedding: Optional[List[float]] = None):
+        if embedding is None:
+            embedding = await Settings.embed_model.aget_query_embedding(query)
+
+        vector = _unit(embedding)
+        if self._matrix is None or self._matrix.shape[1] != vector.shape[0]:
+            # Первая запись или сменилась модель эмбеддингов: старые векторы несравнимы с новыми
+            self.clear()
+            self._matrix = np.zeros((self.max_size, vector.shape[0]), dtype=np.float32)
+
+        key = _normalize(query)
+        if key in self._entries:
+            self._remove(key)
+        while len(self._entries) >= self.max_size:
+            self._remove(next(iter(self._entries)))
+        row = self._free_rows.pop()
+        self._matrix[row] = vector
+        self._occupied[row] = True
+        self._row_keys[row] = key
+        self._entries[key] = CacheEntry(
+            query=query,
+            row=row,
+            answer=answer,
+            created_at=time.monotonic(),
+        )
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+_caches: Dict[str, Optional[SemanticAnswerCache]] = {}
+
+
+def get_answer_cache(name: str, depends_on_index: bool = False) -> Optional[SemanticAnswerCache]:
+    if name not in _caches:
+        _caches[name] = SemanticAnswerCache.from_env(name, depends_on_index=depends_on_index)
+    return _caches[name]
+
+
+def _normalize(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+def _unit(embedding: List[float]) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def set_cache_headers(headers, lookup: Optional[CacheLookup]):
+    if lookup is None:
+        return
+    headers["X-Cache"] = "HIT" if lookup.hit else "MISS"
+    headers["X-Cache-Similarity"] = f"{lookup.similarity:.4f}"
@@ -0,0 +1,63 @@
+import logging
+import os
+import time
+
+from fastapi import Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.datastructures import Headers, MutableHeaders
+
+from app.engine.tracing import REQUEST_SECONDS, RequestTrace, end_trace, new_trace_id, start_trace
+
+logger = logging.getLogger("uvicorn")
+
+TRACE_HEADER = "X-Trace-Id"
+
+
+class TracingMiddleware:
+    """
+    Трасса на каждый HTTP-запрос: идентификатор из заголовка X-Trace-Id или новый,
+    длительность запроса по маршруту в гистограмму и в журнал.
+    ASGI-middleware, а не BaseHTTPMiddleware, чтобы потоковые ответы измерялись до конца.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = Headers(scope=scope).get(TRACE_HEADER) or new_trace_id()
+        trace = RequestTrace(trace_id, scope)
+        token = start_trace(trace)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_trace(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                MutableHeaders(scope=message).append(TRACE_HEADER, trace_id)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        finally:
+            elapsed = time.perf_counter() - start
+            route = trace.route
+            REQUEST_SECONDS.labels(route, scope["method"], str(status)).observe(elapsed)
+            if route != "/metrics":
+                logger.info(f"[{trace_id}] {scope['method']} {route} {status} {elapsed * 1000:.0f} мс")
+            end_trace(token)
+
+
+def metrics_response() -> Response:
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # Несколько рабочих процессов (serve.py): метрики собираются из файлов всех процессов
+        from prometheus_client import CollectorRegistry, multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
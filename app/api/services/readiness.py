@@ -0,0 +1,28 @@
+from starlette.responses import JSONResponse
+
+from app.startup import startup_status
+
+
+class ReadinessMiddleware:
+    """
+    Пока модели и индекс загружаются, запросы к /api получают 503 с Retry-After,
+    а не ждут загрузки и не обращаются к ещё не созданным моделям.
+    /health, /metrics и документация доступны сразу
+    """
+
+    def __init__(self, app, prefix: str = "/api"):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or startup_status.ready or not scope["path"].startswith(self.prefix):
+            await self.app(scope, receive, send)
+            return
+
+        detail = "Сервер не запустился" if startup_status.failed else "Сервер запускается"
+        response = JSONResponse(
+            status_code=503,
+            content={"detail": detail, **startup_status.snapshot()},
+            headers={"Retry-After": "5"},
+        )
+        await response(scope, receive, send)
@@ -0,0 +1,325 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.settings import Settings
+
+logger = logging.getLogger("uvicorn")
+
+SUMMARY_PROMPT = (
+    "Кратко перескажи разговор пользователя с ассистентом: вопросы пользователя, данные ответы, "
+    "упомянутые факты, статьи и условия, которые могут понадобиться дальше. "
+    "Пиши на русском языке, без вступлений."
+)
+
+
+@dataclass
+class Session:
+    session_id: str
+    # Краткое содержание реплик, вытесненных из буфера
+    summary: str = ""
+    messages: List[ChatMessage] = field(default_factory=list)
+    summarized_messages: int = 0
+    updated_at: float = field(default_factory=time.time)
+
+    def history(self) -> List[ChatMessage]:
+        if not self.summary:
+            return list(self.messages)
+        summary = ChatMessage(
+            role=MessageRole.SYSTEM,
+            content=f"Краткое содержание предыдущей части разговора:\n{self.summary}",
+        )
+        return [summary, *self.messages]
+
+    def add_exchange(self, question: str, answer: str):
+        self.messages.append(ChatMessage(role=MessageRole.USER, content=question))
+        self.messages.append(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "summary": self.summary,
+            "messages": [{"role": m.role.value, "content": m.content} for m in self.messages],
+            "summarized_messages": self.summarized_messages,
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, session_id: str, data: str, updated_at: float) -> "Session":
+        values = json.loads(data)
+        return cls(
+            session_id=session_id,
+            summary=values["summary"],
+            messages=[ChatMessage(role=m["role"], content=m["content"]) for m in values["messages"]],
+            summarized_messages=values["summarized_messages"],
+            updated_at=updated_at,
+        )
+
+
+class MemorySessionStore:
+    """
+    Сессии в памяти процесса: не больше max_sessions, вытесняются давно не использованные
+    """
+
+    blocking = False
+
+    def __init__(self, max_sessions: int, ttl: float):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Session]:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if time.time() - session.updated_at > self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session: Session):
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+
+class SQLiteSessionStore:
+    """
+    Сессии в SQLite: переживают перезапуск сервера и общие для нескольких процессов
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # Соединение на поток: запросы выполняются в пуле потоков
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, session_id: str) -> Optional[Session]:
+        row = self._connection().execute(
+            "SELECT data, updated_at FROM sessions WHERE session_id = ? AND updated_at >= ?",
+            (session_id, time.time() - self.ttl),
+        ).fetchone()
+        if row is None:
+            return None
+        return Session.from_json(session_id, row[0], row[1])
+
+    def put(self, session: Session):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (session.session_id, session.to_json(), session.updated_at),
+            )
+            # Попутно удаляются истёкшие сессии
+            connection.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.ttl,))
+
+    def delete(self, session_id: str) -> bool:
+        with self._connection() as connection:
+            return connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+
+
+def _count_tokens(messages: List[ChatMessage]) -> int:
+    tokenizer = Settings.tokenizer
+    return sum(len(tokenizer(message.content or "")) for message in messages)
+
+
+class ChatSessions:
+    """
+    Серверная история разговоров: клиент передаёт session_id и только новое сообщение.
+    В LLM уходит краткое содержание старых реплик и последние реплики в пределах token_limit токенов.
+    Когда буфер переполняется, старые реплики сворачиваются в краткое содержание фоновой задачей
+    после ответа, поэтому сжатие не задерживает запрос.
+    """
+
+    def __init__(self, store, token_limit: int, summarize: bool = True):
+        self.store = store
+        self.token_limit = token_limit
+        self.summarize = summarize
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        self._compactions: Dict[str, asyncio.Task] = {}
+
+    @classmethod
+    def from_env(cls) -> Optional["ChatSessions"]:
+        if os.getenv("SESSIONS_ENABLED", "True").lower() != "true":
+            return None
+        ttl = float(os.getenv("SESSION_TTL", "86400"))
+        backend = os.getenv("SESSION_BACKEND", "memory")
+        match backend:
+            case "memory":
+                store = MemorySessionStore(int(os.getenv("SESSION_MAX_COUNT", "1000")), ttl)
+            case "sqlite":
+                path = os.getenv("SESSION_SQLITE_PATH") or os.path.join(
+                    os.getenv("STORAGE_DIR", ".storage"), "sessions.sqlite3",
+                )
+                store = SQLiteSessionStore(path, ttl)
+            case _:
+                raise ValueError(f"Неизвестное хранилище сессий: {backend}")
+        return cls(
+            store,
+            token_limit=int(os.getenv("SESSION_TOKEN_LIMIT", "2048")),
+            summarize=os.getenv("SESSION_SUMMARY_ENABLED", "True").lower() == "true",
+        )
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    async def _call(self, method, *args):
+        if self.store.blocking:
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    def _lock(self, session_id: str) -> asyncio.Lock:
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def get(self, session_id: str) -> Optional[Session]:
+        return await self._call(self.store.get, session_id)
+
+    async def delete(self, session_id: str) -> bool:
+        return await self._call(self.store.delete, session_id)
+
+    @asynccontextmanager
+    async def turn(self, session_id: str, initial_messages: Optional[List[ChatMessage]] = None) -> AsyncIterator[Session]:
+        """
+        Реплика разговора: запросы одной сессии выполняются по очереди,
+        сессия сохраняется только если ответ получен полностью
+        """
+        lock = self._lock(session_id)
+        async with lock:
+            session = await self._call(self.store.get, session_id)
+            if session is None:
+                # Новая сессия может начинаться с истории, переданной клиентом
+                session = Session(session_id, messages=list(initial_messages or []))
+            yield session
+            session.updated_at = time.time()
+            await self._call(self.store.put, session)
+
+        if _count_tokens(session.messages) > self.token_limit and session_id not in self._compactions:
+            task = self._compactions[session_id] = asyncio.create_task(self._compact(session_id))
+            task.add_done_callback(lambda _: self._compactions.pop(session_id, None))
+
+    async def wait_compactions(self):
+        """
+        Дождаться фонового сжатия историй, например перед остановкой сервера
+        """
+        if self._compactions:
+            await asyncio.gather(*self._compactions.values(), return_exceptions=True)
+
+    def _split(self, messages: List[ChatMessage]) -> int:
+        """
+        Сколько старых реплик свернуть: после сжатия последние реплики занимают не больше
+        половины буфера, чтобы сжатие не запускалось после каждого ответа
+        """
+        tokenizer = Settings.tokenizer
+        kept_tokens = 0
+        keep_from = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            kept_tokens += len(tokenizer(messages[i].content or ""))
+            if kept_tokens > self.token_limit // 2:
+                break
+            keep_from = i
+        # Свёрнутая часть заканчивается ответом ассистента
+        while keep_from < len(messages) and messages[keep_from].role != MessageRole.USER:
+            keep_from += 1
+        return keep_from
+
+    async def _summarize(self, summary: str, messages: List[ChatMessage]) -> str:
+        transcript = "\n\n".join(f"{m.role.value}: {m.content}" for m in messages)
+        if summary:
+            transcript = f"Краткое содержание ранее:\n{summary}\n\nПродолжение разговора:\n{transcript}"
+        response = await Settings.llm.achat([
+            ChatMessage(role=MessageRole.SYSTEM, content=SUMMARY_PROMPT),
+            ChatMessage(role=MessageRole.USER, content=transcript),
+        ])
+        return (response.message.content or "").strip()
+
+    async def _compact(self, session_id: str):
+        start = time.perf_counter()
+        # Краткое содержание генерируется без блокировки сессии, чтобы новые реплики не ждали LLM
+        async with self._lock(session_id):
+            session = await self._call(self.store.get, session_id)
+            if session is None:
+                return
+            split = self._split(session.messages)
+            folded = session.messages[:split]
+            summary, summarized_messages = session.summary, session.summarized_messages
+        if not folded:
+            return
+
+        new_summary = summary
+        if self.summarize:
+            try:
+                new_summary = await self._summarize(summary, folded)
+            except Exception as e:
+                # Без краткого содержания старые реплики просто вытесняются
+                logger.warning(f"Не удалось сжать историю сессии {session_id}: {e}")
+
+        async with self._lock(session_id):
+            session = await self._call(self.store.get, session_id)
+            # За время сжатия сессию могли удалить или заменить её начало
+            if (
+                    session is None
+                    or session.summary != summary
+                    or session.summarized_messages != summarized_messages
+                    or session.messages[:split] != folded
+            ):
+                logger.info(f"История сессии {session_id} изменилась во время сжатия, сжатие отменено")
+                return
+            session.summary = new_summary
+            session.messages = session.messages[split:]
+            session.summarized_messages += len(folded)
+            await self._call(self.store.put, session)
+        logger.info(
+            f"История сессии {session_id} сжата: свёрнуто реплик {len(folded)}, "
+            f"осталось {len(session.messages)}, {(time.perf_counter() - start) * 1000:.0f} мс"
+        )
+
+_sessions: Optional[ChatSessions] = None
+_sessions_loaded = False
+
+
+def get_chat_sessions() -> Optional[ChatSessions]:
+    global _sessions, _sessions_loaded
+    if not _sessions_loaded:
+        _sessions = ChatSessions.from_env()
+        _sessions_loaded = True
+    return _sessions
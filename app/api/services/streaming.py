@@ -0,0 +1,190 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from aiostream import stream
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.schema import NodeWithScore
+from starlette.concurrency import iterate_in_threadpool
+
+logger = logging.getLogger("uvicorn")
+
+SSE_MEDIA_TYPE = "text/event-stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+class StreamFrame:
+    def __init__(self, event: str, data: Any):
+        self.event = event
+        self.data = data
+
+    def to_sse(self) -> str:
+        return f"event: {self.event}\ndata: {json.dumps(self.data, ensure_ascii=False)}\n\n"
+
+    def to_ndjson(self) -> str:
+        return json.dumps({"event": self.event, "data": self.data}, ensure_ascii=False) + "\n"
+
+
+class ToolEventHandler(BaseCallbackHandler):
+    """
+    Пересылает вызовы инструментов агента в очередь потока ответа
+    """
+
+    def __init__(self, queue: asyncio.Queue):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._queue = queue
+        self._loop = asyncio.get_running_loop()
+
+    def _put(self, frame: StreamFrame):
+        # Инструменты могут выполняться в другом потоке
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, frame)
+
+    def on_event_start(
+            self,
+            event_type: CBEventType,
+            payload: Optional[Dict[str, Any]] = None,
+            event_id: str = "",
+            parent_id: str = "",
+            **kwargs: Any,
+    ) -> str:
+        if event_type == CBEventType.FUNCTION_CALL and payload:
+            tool = payload.get(EventPayload.TOOL)
+            self._put(StreamFrame("tool_call", {
+                "id": event_id,
+                "name": getattr(tool, "name", None),
+                "arguments": str(payload.get(EventPayload.FUNCTION_CALL)),
+            }))
+        return event_id
+
+    def on_event_end(
+            self,
+            event_type: CBEventType,
+            payload: Optional[Dict[str, Any]] = None,
+            event_id: str = "",
+            **kwargs: Any,
+    ) -> None:
+        if event_type == CBEventType.FUNCTION_CALL and payload:
+            self._put(StreamFrame("tool_result", {
+                "id": event_id,
+                "output": str(payload.get(EventPayload.FUNCTION_OUTPUT)),
+            }))
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+            self,
+            trace_id: Optional[str] = None,
+            trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
+
+
+def sources_frame(source_nodes: List[NodeWithScore]) -> StreamFrame:
+    return StreamFrame("sources", [
+        {
+            "id": node.node_id,
+            "score": node.score,
+            "metadata": node.metadata,
+            "text": node.get_content(),
+        }
+        for node in source_nodes
+    ])
+
+
+async def token_frames(tokens: AsyncIterator[str]) -> AsyncIterator[StreamFrame]:
+    async for token in tokens:
+        if token:
+            yield StreamFrame("token", {"delta": token})
+
+
+async def response_tokens(response) -> AsyncIterator[str]:
+    # Асинхронный генератор есть не у всех потоковых ответов llama_index
+    if hasattr(response, "async_response_gen"):
+        async for token in response.async_response_gen():
+            yield token
+    else:
+        async for token in iterate_in_threadpool(response.response_gen):
+            yield token
+
+
+def cancel_response_tasks(response) -> None:
+    """
+    Агент пишет поток LLM в ответ фоновой задачей (awrite_response_to_history_task).
+    При отключении клиента её нужно отменить, иначе генерация продолжится без читателя.
+    """
+    task = getattr(response, "awrite_response_to_history_task", None)
+    if task is None:
+        return
+    if not task.done():
+        task.cancel()
+    # async_response_gen ожидает задачу при закрытии; отменённую ждать не нужно
+    response.awrite_response_to_history_task = None
+
+
+async def merge_with_events(
+        queue: asyncio.Queue,
+        frames: AsyncIterator[StreamFrame],
+) -> AsyncIterator[StreamFrame]:
+    """
+    Объединяет кадры ответа с событиями инструментов, которые приходят в очередь
+    """
+
+    async def queued_frames():
+        while True:
+            frame = await queue.get()
+            if frame is None:
+                return
+            yield frame
+
+    async def main_frames():
+        try:
+            async for frame in frames:
+                yield frame
+        finally:
+            queue.put_nowait(None)
+
+    merged = stream.merge(queued_frames(), main_frames())
+    async with merged.stream() as streamer:
+        async for frame in streamer:
+            yield frame
+
+
+def _wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def stream_response(request: Request, frames: AsyncIterator[StreamFrame]) -> StreamingResponse:
+    """
+    Отдаёт кадры как SSE или NDJSON (по заголовку Accept).
+    При отключении клиента генерация прерывается и слот LLM освобождается.
+    """
+    ndjson = _wants_ndjson(request)
+
+    async def body():
+        try:
+            async for frame in frames:
+                if await request.is_disconnected():
+                    logger.info("Клиент отключился, генерация прервана")
+                    break
+                yield frame.to_ndjson() if ndjson else frame.to_sse()
+            else:
+                done = StreamFrame("done", {})
+                yield done.to_ndjson() if ndjson else done.to_sse()
+        except Exception as e:
+            logger.exception("Ошибка при потоковой генерации")
+            error = StreamFrame("error", {"message": str(e)})
+            yield error.to_ndjson() if ndjson else error.to_sse()
+        finally:
+            # Закрыть цепочку генераторов вплоть до потока LLM
+            await frames.aclose()
+
+    return StreamingResponse(
+        body(),
+        media_type=NDJSON_MEDIA_TYPE if ndjson else SSE_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
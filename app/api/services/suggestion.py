@@ -1,16 +1,27 @@
+import asyncio
+import hashlib
 import logging
 import os
 import re
-from typing import List, Optional
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
 
-from llama_index.core.base.llms.types import MessageRole
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
 from llama_index.core.prompts import PromptTemplate
 from llama_index.core.settings import Settings
 
-from app.api.routers.models import Message
+from app.engine.llm_scheduler import BatchingLLM, LLMOverloadedError
 
 logger = logging.getLogger("uvicorn")
 
+# Блок кода, возможно с названием языка в первой строке
+_FENCE_RE = re.compile(r"```(?:[\w-]+\n)?(.*?)```", re.DOTALL)
+# Маркер списка в начале строки: "-", "*", "•", "1." или "1)"
+_LIST_MARKER_RE = re.compile(r"^(?:[-*•]|\d+[.)])\s*")
+
 
 class NextQuestionSuggestion:
     """
@@ -25,10 +36,24 @@ class NextQuestionSuggestion:
             return None
         return PromptTemplate(prompt)
 
+    @classmethod
+    def format_conversation(cls, messages: List[ChatMessage]) -> str:
+        # Reduce the cost by only using the last two messages
+        last_user_message = None
+        last_assistant_message = None
+        for message in reversed(messages):
+            if message.role == "user":
+                last_user_message = f"User: {message.content}"
+            elif message.role == "assistant":
+                last_assistant_message = f"Assistant: {message.content}"
+            if last_user_message and last_assistant_message:
+                break
+        return f"{last_user_message}\n{last_assistant_message}"
+
     @classmethod
     async def suggest_next_questions_all_messages(
             cls,
-            messages: List[Message],
+            messages: List[ChatMessage],
     ) -> Optional[List[str]]:
         """
         Suggest the next questions that user might ask based on the conversation history
@@ -39,20 +64,8 @@ class NextQuestionSuggestion:
             return None
 
         try:
-            # Reduce the cost by only using the last two messages
-            last_user_message = None
-            last_assistant_message = None
-            for message in reversed(messages):
-                if message.role == "user":
-                    last_user_message = f"User: {message.content}"
-                elif message.role == "assistant":
-                    last_assistant_message = f"Assistant: {message.content}"
-                if last_user_message and last_assistant_message:
-                    break
-            conversation: str = f"{last_user_message}\n{last_assistant_message}"
-
             # Call the LLM and parse questions from the output
-            prompt = prompt_template.format(conversation=conversation)
+            prompt = prompt_template.format(conversation=cls.format_conversation(messages))
             output = await Settings.llm.acomplete(prompt)
             questions = cls._extract_questions(output.text)
 
@@ -63,20 +76,187 @@ class NextQuestionSuggestion:
 
     @classmethod
     def _extract_questions(cls, text: str) -> List[str] | None:
-        content_match = re.search(r"```(.*?)```", text, re.DOTALL)
-        content = content_match.group(1) if content_match else None
-        if not content:
-            return None
-        return [q.strip() for q in content.split("\n") if q.strip()]
+        # Вопросы из блока кода или, если модель его не поставила, из всего ответа
+        content_match = _FENCE_RE.search(text)
+        content = content_match.group(1) if content_match else text
+        questions = [_LIST_MARKER_RE.sub("", line.strip()).strip() for line in content.split("\n")]
+        questions = [q for q in questions if q]
+        if not content_match:
+            # Без блока кода ответ может начинаться со вступления — остаются только вопросы
+            questions = [q for q in questions if q.endswith("?")]
+        return questions or None
 
     @classmethod
     async def suggest_next_questions(
             cls,
-            chat_history: List[Message],
+            chat_history: List[ChatMessage],
             response: str,
     ) -> List[str]:
         """
         Предложите следующие вопросы, которые пользователь может задать на основе истории чата и последнего ответа
         """
-        messages = chat_history + [Message(role=MessageRole.ASSISTANT, content=response)]
+        messages = chat_history + [ChatMessage(role=MessageRole.ASSISTANT, content=response)]
         return await cls.suggest_next_questions_all_messages(messages)
+
+
+@dataclass
+class SuggestionStats:
+    cache_hits: int = 0
+    generated: int = 0
+    # Не запущены из-за загруженной очереди LLM
+    skipped: int = 0
+    failed: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, name: str):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def snapshot(self, pending: int, cached: int) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "pending": pending,
+                "cached": cached,
+                "cache_hits": self.cache_hits,
+                "generated": self.generated,
+                "skipped": self.skipped,
+                "failed": self.failed,
+            }
+
+
+@dataclass
+class _CachedQuestions:
+    questions: List[str]
+    created_at: float
+
+
+class SuggestionService:
+    """
+    Подсказки следующих вопросов вне пути ответа: генерация запускается фоновой задачей после ответа,
+    результат кешируется по хешу последней реплики (вопрос и ответ). Клиент получает подсказки
+    событием потока или запросом GET /api/chat/suggestions/{id}.
+    Когда очередь LLM загружена, подсказки не генерируются
+    """
+
+    def __init__(self, prompt: PromptTemplate, cache_size: int, ttl: float, max_pending: int, max_queue_depth: int):
+        self.prompt = prompt
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.max_pending = max_pending
+        self.max_queue_depth = max_queue_depth
+        self._cache: "OrderedDict[str, _CachedQuestions]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.stats = SuggestionStats()
+
+    @classmethod
+    def from_env(cls) -> Optional["SuggestionService"]:
+        prompt = NextQuestionSuggestion.get_configured_prompt()
+        if not prompt or os.getenv("SUGGESTIONS_ENABLED", "True").lower() != "true":
+            return None
+        return cls(
+            prompt,
+            cache_size=int(os.getenv("SUGGESTIONS_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("SUGGESTIONS_TTL", "3600")),
+            max_pending=int(os.getenv("SUGGESTIONS_MAX_PENDING", "4")),
+            max_queue_depth=int(os.getenv("SUGGESTIONS_MAX_QUEUE_DEPTH", "8")),
+        )
+
+    @staticmethod
+    def turn_id(question: str, answer: str) -> str:
+        return hashlib.sha1(f"{question}\x00{answer}".encode("utf-8")).hexdigest()
+
+    def _saturated(self) -> bool:
+        if len(self._pending) >= self.max_pending:
+            return True
+        # До окончания запуска модели ещё нет, очередь проверяется только у загруженной
+        llm = Settings._llm
+        return isinstance(llm, BatchingLLM) and llm.scheduler.queue_depth >= self.max_queue_depth
+
+    def _cached(self, suggestion_id: str) -> Optional[_CachedQuestions]:
+        entry = self._cache.get(suggestion_id)
+        if entry is not None and time.monotonic() - entry.created_at > self.ttl:
+            del self._cache[suggestion_id]
+            return None
+        return entry
+
+    def schedule(self, question: str, answer: str) -> Optional[str]:
+        """
+        Запустить генерацию подсказок для реплики и вернуть их идентификатор.
+        None — подсказок не будет: ответ пустой или очередь LLM загружена
+        """
+        if not answer:
+            return None
+        suggestion_id = self.turn_id(question, answer)
+        if self._cached(suggestion_id) is not None:
+            self._cache.move_to_end(suggestion_id)
+            self.stats.add("cache_hits")
+            return suggestion_id
+        if suggestion_id in self._pending:
+            return suggestion_id
+        if self._saturated():
+            self.stats.add("skipped")
+            return None
+        task = self._pending[suggestion_id] = asyncio.create_task(self._generate(suggestion_id, question, answer))
+        task.add_done_callback(lambda _: self._pending.pop(suggestion_id, None))
+        return suggestion_id
+
+    async def _generate(self, suggestion_id: str, question: str, answer: str):
+        conversation = NextQuestionSuggestion.format_conversation([
+            ChatMessage(role=MessageRole.USER, content=question),
+            ChatMessage(role=MessageRole.ASSISTANT, content=answer),
+        ])
+        start = time.perf_counter()
+        try:
+            output = await Settings.llm.acomplete(self.prompt.format(conversation=conversation))
+        except LLMOverloadedError:
+            # Очередь заполнилась после запуска: подсказки пропускаются и не кешируются
+            self.stats.add("skipped")
+            return
+        except Exception as e:
+            self.stats.add("failed")
+            logger.warning(f"Не удалось сгенерировать подсказки вопросов: {e}")
+            return
+        self._cache[suggestion_id] = _CachedQuestions(
+            NextQuestionSuggestion._extract_questions(output.text) or [], time.monotonic(),
+        )
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        self.stats.add("generated")
+        logger.info(f"Подсказки вопросов готовы за {(time.perf_counter() - start) * 1000:.0f} мс")
+
+    def get(self, suggestion_id: str) -> Optional[Dict[str, Any]]:
+        # pending — ещё генерируются, ready — готовы; None — неизвестный идентификатор или подсказки вытеснены
+        entry = self._cached(suggestion_id)
+        if entry is not None:
+            return {"id": suggestion_id, "status": "ready", "questions": entry.questions}
+        if suggestion_id in self._pending:
+            return {"id": suggestion_id, "status": "pending", "questions": []}
+        return None
+
+    async def wait(self, suggestion_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        task = self._pending.get(suggestion_id)
+        if task is not None and timeout > 0:
+            # Клиент, не дождавшийся подсказок, не отменяет их генерацию
+            await asyncio.wait([task], timeout=timeout)
+        return self.get(suggestion_id)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return self.stats.snapshot(pending=len(self._pending), cached=len(self._cache))
+
+    async def close(self):
+        tasks = list(self._pending.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_suggestions: Optional[SuggestionService] = None
+_suggestions_loaded = False
+
+
+def get_suggestions() -> Optional[SuggestionService]:
+    global _suggestions, _suggestions_loaded
+    if not _suggestions_loaded:
+        _suggestions = SuggestionService.from_env()
+        _suggestions_loaded = True
+    return _suggestions
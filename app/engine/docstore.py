@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
+from llama_index.core.storage.docstore.types import DEFAULT_PERSIST_FNAME as DOCSTORE_FNAME
+from llama_index.core.storage.kvstore.types import DEFAULT_BATCH_SIZE, DEFAULT_COLLECTION, BaseKVStore
+
+logger = logging.getLogger("uvicorn")
+
+DOCSTORE_SQLITE_FNAME = "docstore.sqlite3"
+
+
+class SQLiteKVStore(BaseKVStore):
+    """
+    Ключ-значение в одной таблице SQLite (коллекция, ключ) → JSON.
+    Записи читаются по одной, в памяти остаются только запрошенные.
+    Запись идёт в транзакции: операции внутри transaction() фиксируются вместе
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Одно соединение на хранилище: изменения незавершённой транзакции видны всем потокам генерации
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            "collection TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (collection, key)) WITHOUT ROWID"
+        )
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        # Вложенные вызовы входят во внешнюю транзакцию
+        with self._lock:
+            if self._depth == 0:
+                self._connection.execute("BEGIN IMMEDIATE")
+            self._depth += 1
+            try:
+                yield
+            except BaseException:
+                self._depth -= 1
+                if self._depth == 0:
+                    self._connection.execute("ROLLBACK")
+                raise
+            self._depth -= 1
+            if self._depth == 0:
+                self._connection.execute("COMMIT")
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put_all([(key, val)], collection=collection)
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put(key, val, collection=collection)
+
+    def put_all(
+            self,
+            kv_pairs: List[Tuple[str, dict]],
+            collection: str = DEFAULT_COLLECTION,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> None:
+        if not kv_pairs:
+            return
+        with self.transaction():
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO kv (collection, key, value) VALUES (?, ?, ?)",
+                ((collection, key, json.dumps(val, ensure_ascii=False)) for key, val in kv_pairs),
+            )
+
+    async def aput_all(
+            self,
+            kv_pairs: List[Tuple[str, dict]],
+            collection: str = DEFAULT_COLLECTION,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+    ) -> None:
+        self.put_all(kv_pairs, collection=collection, batch_size=batch_size)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM kv WHERE collection = ? AND key = ?", (collection, key),
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get(key, collection=collection)
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        with self._lock:
+            rows = self._connection.execute("SELECT key, value FROM kv WHERE collection = ?", (collection,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection=collection)
+
+    def keys(self, collection: str = DEFAULT_COLLECTION) -> List[str]:
+        with self._lock:
+            rows = self._connection.execute("SELECT key FROM kv WHERE collection = ?", (collection,)).fetchall()
+        return [key for key, in rows]
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        with self.transaction():
+            cursor = self._connection.execute("DELETE FROM kv WHERE collection = ? AND key = ?", (collection, key))
+        return cursor.rowcount > 0
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection=collection)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class SQLiteDocumentStore(KVDocumentStore):
+    """
+    Хранилище документов llama_index поверх SQLiteKVStore: хеши и документы читаются по ключу,
+    изменения одного документа (узел, метаданные, ссылки) записываются одной транзакцией
+    """
+
+    def __init__(self, kvstore: SQLiteKVStore, namespace: Optional[str] = None):
+        super().__init__(kvstore, namespace=namespace)
+        self._kvstore: SQLiteKVStore = kvstore
+
+    @classmethod
+    def from_env(cls, storage_dir: str) -> "SQLiteDocumentStore":
+        path = os.getenv("DOCSTORE_SQLITE_PATH") or os.path.join(storage_dir, DOCSTORE_SQLITE_FNAME)
+        kvstore = SQLiteKVStore(path)
+        migrate_json_storage(storage_dir, kvstore)
+        return cls(kvstore)
+
+    @property
+    def kvstore(self) -> SQLiteKVStore:
+        return self._kvstore
+
+    def transaction(self):
+        return self._kvstore.transaction()
+
+    def add_documents(self, docs, allow_update: bool = True, batch_size: Optional[int] = None, store_text: bool = True):
+        with self.transaction():
+            super().add_documents(docs, allow_update=allow_update, batch_size=batch_size, store_text=store_text)
+
+    def set_document_hashes(self, doc_hashes: Dict[str, str]) -> None:
+        with self.transaction():
+            super().set_document_hashes(doc_hashes)
+
+    def get_all_document_hashes(self) -> Dict[str, str]:
+        # Одним запросом вместо чтения метаданных каждого документа по отдельности
+        metadata = self._kvstore.get_all(collection=self._metadata_collection)
+        return {value["doc_hash"]: doc_id for doc_id, value in metadata.items() if value.get("doc_hash") is not None}
+
+    def document_ids(self) -> List[str]:
+        # Значения метаданных не читаются
+        return self._kvstore.keys(collection=self._metadata_collection)
+
+    def delete_document(self, doc_id: str, raise_error: bool = True) -> None:
+        with self.transaction():
+            super().delete_document(doc_id, raise_error=raise_error)
+
+    def delete_ref_doc(self, ref_doc_id: str, raise_error: bool = True) -> None:
+        with self.transaction():
+            super().delete_ref_doc(ref_doc_id, raise_error=raise_error)
+
+
+def migrate_json_storage(storage_dir: str, kvstore: SQLiteKVStore):
+    """
+    Однократный перенос docstore.json (SimpleKVStore) в SQLite. Перенесённый файл переименовывается
+    в *.migrated и при следующем запуске не читается. Индекс загружается из векторного хранилища,
+    поэтому index_store.json не используется и не переносится
+    """
+    path = os.path.join(storage_dir, DOCSTORE_FNAME)
+    if not os.path.exists(path):
+        return
+    with open(path, encoding="utf-8") as f:
+        data: Dict[str, Dict[str, dict]] = json.load(f)
+    with kvstore.transaction():
+        for collection, items in data.items():
+            kvstore.put_all(list(items.items()), collection=collection)
+    os.replace(path, path + ".migrated")
+    logger.info(f"{DOCSTORE_FNAME} перенесён в {kvstore.path}, записей: {sum(len(items) for items in data.values())}")
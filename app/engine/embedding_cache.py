@@ -0,0 +1,292 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+
+logger = logging.getLogger("uvicorn")
+
+EMBEDDING_CACHE_DIR = "embeddings"
+_KEY_SIZE = 20
+
+
+@dataclass
+class EmbeddingCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    # Байт текста, которые не пришлось передавать модели
+    bytes_saved: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, memory_hits: int = 0, disk_hits: int = 0, misses: int = 0, bytes_saved: int = 0):
+        with self._lock:
+            self.memory_hits += memory_hits
+            self.disk_hits += disk_hits
+            self.misses += misses
+            self.bytes_saved += bytes_saved
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / total if total else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate,
+                "bytes_saved": self.bytes_saved,
+            }
+
+    def __str__(self) -> str:
+        return (
+            f"попаданий в память: {self.memory_hits}, на диск: {self.disk_hits}, промахов: {self.misses}, "
+            f"доля попаданий: {self.hit_rate:.1%}, сэкономлено: {self.bytes_saved / 1024 / 1024:.1f} МБ текста"
+        )
+
+
+class DiskEmbeddingStore:
+    """
+    Эмбеддинги на диске: записи (sha1 ключа, float32[dim]) дописываются в конец
+    одного файла и читаются через np.memmap, индекс ключ → номер записи строится при открытии.
+    Запись под flock, поэтому файл могут дополнять несколько процессов генерации.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._records_path = os.path.join(path, "records.bin")
+        self._meta_path = os.path.join(path, "meta.json")
+        self._lock = threading.Lock()
+        self._dim: Optional[int] = None
+        self._dtype: Optional[np.dtype] = None
+        self._rows: Dict[bytes, int] = {}
+        self._scanned_rows = 0
+        self._mmap: Optional[np.memmap] = None
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, encoding="utf-8") as f:
+                self._set_dim(json.load(f)["dim"])
+            self._scan()
+
+    def _set_dim(self, dim: int):
+        self._dim = dim
+        self._dtype = np.dtype([("key", "u1", (_KEY_SIZE,)), ("vector", "<f4", (dim,))])
+
+    def _file_rows(self) -> int:
+        if not os.path.exists(self._records_path):
+            return 0
+        return os.path.getsize(self._records_path) // self._dtype.itemsize
+
+    def _scan(self):
+        # Дочитать записи, добавленные с прошлого просмотра (в том числе другими процессами)
+        rows = self._file_rows()
+        if rows <= self._scanned_rows:
+            return
+        self._mmap = np.memmap(self._records_path, dtype=self._dtype, mode="r", shape=(rows,))
+        keys = np.ascontiguousarray(self._mmap["key"][self._scanned_rows:rows]).tobytes()
+        for row in range(self._scanned_rows, rows):
+            offset = (row - self._scanned_rows) * _KEY_SIZE
+            self._rows.setdefault(keys[offset:offset + _KEY_SIZE], row)
+        self._scanned_rows = rows
+
+    def get_many(self, keys: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        if self._dtype is None:
+            return {}
+        with self._lock:
+            if any(key not in self._rows for key in keys):
+                self._scan()
+            found = {key: self._rows[key] for key in keys if key in self._rows}
+            if not found:
+                return {}
+            vectors = self._mmap["vector"]
+            return {key: np.array(vectors[row]) for key, row in found.items()}
+
+    def put_many(self, items: Sequence[Tuple[bytes, np.ndarray]]):
+        if not items:
+            return
+        import fcntl
+
+        with self._lock:
+            if self._dtype is None:
+                os.makedirs(self.path, exist_ok=True)
+                self._set_dim(len(items[0][1]))
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self._dim}, f)
+
+            records = np.zeros(len(items), dtype=self._dtype)
+            for i, (key, vector) in enumerate(items):
+                records[i]["key"] = np.frombuffer(key, dtype=np.uint8)
+                records[i]["vector"] = vector
+
+            with open(self._records_path, "ab") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    # Обрезанная при сбое запись не должна сдвигать следующие
+                    size = f.seek(0, os.SEEK_END)
+                    if size % self._dtype.itemsize:
+                        f.truncate(size - size % self._dtype.itemsize)
+                    f.write(records.tobytes())
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Кеш эмбеддингов по содержимому: ключ — модель, бэкенд, вид текста (запрос/фрагмент) и хеш текста.
+    Первый уровень — LRU в памяти процесса, второй — DiskEmbeddingStore в STORAGE_CACHE_DIR.
+    """
+
+    _inner: BaseEmbedding = PrivateAttr()
+    _namespace: str = PrivateAttr()
+    _memory: "OrderedDict[bytes, np.ndarray]" = PrivateAttr()
+    _memory_size: int = PrivateAttr()
+    _memory_lock: threading.Lock = PrivateAttr()
+    _disk: Optional[DiskEmbeddingStore] = PrivateAttr()
+    _stats: EmbeddingCacheStats = PrivateAttr()
+
+    def __init__(
+            self,
+            inner: BaseEmbedding,
+            backend: str = "",
+            memory_size: int = 10000,
+            cache_dir: Optional[str] = None,
+            **kwargs: Any,
+    ):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=inner.callback_manager,
+            **kwargs,
+        )
+        self._inner = inner
+        self._namespace = f"{inner.model_name}\n{backend}"
+        self._memory = OrderedDict()
+        self._memory_size = memory_size
+        self._memory_lock = threading.Lock()
+        self._disk = None
+        if cache_dir:
+            store_name = hashlib.sha1(self._namespace.encode("utf-8")).hexdigest()[:16]
+            self._disk = DiskEmbeddingStore(os.path.join(cache_dir, EMBEDDING_CACHE_DIR, store_name))
+        self._stats = EmbeddingCacheStats()
+
+    @classmethod
+    def from_env(cls, inner: BaseEmbedding) -> BaseEmbedding:
+        if os.getenv("EMBED_CACHE_ENABLED", "True").lower() != "true":
+            return inner
+        cache_dir = None
+        if os.getenv("EMBED_CACHE_DISK", "True").lower() == "true":
+            cache_dir = os.getenv("STORAGE_CACHE_DIR", ".cache")
+        return cls(
+            inner,
+            backend=os.getenv("EMBEDDING_BACKEND", "torch"),
+            memory_size=int(os.getenv("EMBED_CACHE_MEMORY_SIZE", "10000")),
+            cache_dir=cache_dir,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def inner(self) -> BaseEmbedding:
+        return self._inner
+
+    @property
+    def stats(self) -> EmbeddingCacheStats:
+        return self._stats
+
+    def _key(self, kind: str, text: str) -> bytes:
+        return hashlib.sha1(f"{self._namespace}\n{kind}\n{text}".encode("utf-8")).digest()
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        with self._memory_lock:
+            self._memory[key] = vector
+            self._memory.move_to_end(key)
+            while len(self._memory) > self._memory_size:
+                self._memory.popitem(last=False)
+
+    def _lookup(self, kind: str, texts: Sequence[str]) -> Tuple[List[bytes], Dict[bytes, np.ndarray], List[str]]:
+        """
+        Возвращает ключи текстов, найденные эмбеддинги и уникальные тексты для модели
+        """
+        keys = [self._key(kind, text) for text in texts]
+        found: Dict[bytes, np.ndarray] = {}
+        with self._memory_lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+        memory_hits = len(found)
+
+        disk_hits = 0
+        if self._disk is not None:
+            from_disk = self._disk.get_many([key for key in keys if key not in found])
+            for key, vector in from_disk.items():
+                self._remember(key, vector)
+            found.update(from_disk)
+            disk_hits = len(from_disk)
+
+        missing: Dict[bytes, str] = {}
+        saved = 0
+        for key, text in zip(keys, texts):
+            if key in found:
+                saved += len(text.encode("utf-8"))
+            else:
+                missing.setdefault(key, text)
+        self._stats.add(memory_hits=memory_hits, disk_hits=disk_hits, misses=len(missing), bytes_saved=saved)
+        return keys, found, list(missing.values())
+
+    def _store(self, kind: str, texts: Sequence[str], embeddings: Sequence[Embedding], found: Dict[bytes, np.ndarray]):
+        items = []
+        for text, embedding in zip(texts, embeddings):
+            key = self._key(kind, text)
+            vector = np.asarray(embedding, dtype=np.float32)
+            found[key] = vector
+            self._remember(key, vector)
+            items.append((key, vector))
+        if self._disk is not None:
+            self._disk.put_many(items)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        keys, found, missing = self._lookup("query", [query])
+        if missing:
+            self._store("query", missing, [self._inner._get_query_embedding(query)], found)
+        return found[keys[0]].tolist()
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        keys, found, missing = self._lookup("query", [query])
+        if missing:
+            self._store("query", missing, [await self._inner._aget_query_embedding(query)], found)
+        return found[keys[0]].tolist()
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, found, missing = self._lookup("text", texts)
+        if missing:
+            self._store("text", missing, self._inner._get_text_embeddings(missing), found)
+        return [found[key].tolist() for key in keys]
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        keys, found, missing = self._lookup("text", texts)
+        if missing:
+            self._store("text", missing, await self._inner._aget_text_embeddings(missing), found)
+        return [found[key].tolist() for key in keys]
@@ -1,38 +1,82 @@
 ﻿import os
 from typing import List
 
-from llama_index.core.agent import AgentRunner
+from llama_index.core.agent import AgentRunner, FunctionCallingAgent
 from llama_index.core.callbacks import CallbackManager
 from llama_index.core.settings import Settings
 from llama_index.core.tools import BaseTool
 
-from app.engine.index import IndexConfig, get_index
-from app.engine.tools import ToolFactory
+from app.engine.filters import build_filters
+from app.engine.registry import engine_registry
+from app.engine.reranker import rerank_settings
 from app.engine.tools.query_engine import get_query_engine_tool
+from app.engine.tracing import traced_callback_manager
 
 
-def get_chat_engine(params=None, event_handlers=None, **kwargs):
+def create_agent(
+        tools: List[BaseTool],
+        system_prompt=None,
+        callback_manager=None,
+        verbose: bool = False,
+        streaming: bool = False,
+):
+    llm = Settings.llm
+    # Агент с вызовом функций выполняет несколько инструментов одного шага параллельно,
+    # но не поддерживает потоковый ответ
+    if llm.metadata.is_function_calling_model and not streaming:
+        return FunctionCallingAgent.from_tools(
+            tools=tools,
+            llm=llm,
+            system_prompt=system_prompt,
+            callback_manager=traced_callback_manager(callback_manager),
+            verbose=verbose,
+            allow_parallel_tool_calls=True,
+        )
+    return AgentRunner.from_llm(
+        llm=llm,
+        tools=tools,
+        system_prompt=system_prompt,
+        callback_manager=traced_callback_manager(callback_manager),
+        verbose=verbose,
+    )
+
+
+def get_chat_engine(params=None, event_handlers=None, streaming: bool = False, include_private: bool = False, **kwargs):
     system_prompt = os.getenv("SYSTEM_PROMPT")
     tools: List[BaseTool] = []
     callback_manager = CallbackManager(handlers=event_handlers or [])
 
     verbose = os.getenv("VERBOSE", "False").lower() == "true"
 
-    # Добавить инструмент запроса, если существует индекс
-    index_config = IndexConfig(callback_manager=callback_manager, **(params or {}))
-    index = get_index(index_config)
-    if index is not None:
-        query_engine_tool = get_query_engine_tool(index, **kwargs)
-        tools.append(query_engine_tool)
+    # Коллекции (части корпуса) и фильтры метаданных для поиска задаются в data запроса:
+    # {"collections": [...], "filters": {"source": "file", "date": {"gte": "2024-01-01"}}}
+    collections = (params or {}).get("collections")
+    filters = (params or {}).get("filters")
 
-    # Добавить дополнительные инструменты
-    configured_tools: List[BaseTool] = ToolFactory.from_env()
-    tools.extend(configured_tools)
+    # Индекс и инструменты общие для всех запросов, на запрос создаётся только агент
+    if kwargs:
+        # Инструмент запроса с нестандартными параметрами собирается поверх общего индекса
+        index = engine_registry.get_index(collections)
+        if index is not None:
+            tools.append(get_query_engine_tool(
+                index,
+                engine_registry.keyword_index,
+                rerank=rerank_settings("chat"),
+                filters=build_filters(filters, include_private),
+                scoped_store=engine_registry.scoped(collections),
+                **kwargs,
+            ))
+        tools.extend(engine_registry.configured_tools)
+    else:
+        query_engine_tool = engine_registry.get_query_engine_tool(collections, filters, include_private, route="chat")
+        if query_engine_tool is not None:
+            tools.append(query_engine_tool)
+        tools.extend(engine_registry.configured_tools)
 
-    return AgentRunner.from_llm(
-        llm=Settings.llm,
-        tools=tools,
+    return create_agent(
+        tools,
         system_prompt=system_prompt,
         callback_manager=callback_manager,
         verbose=verbose,
+        streaming=streaming,
     )
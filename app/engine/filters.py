@@ -0,0 +1,147 @@
+import hmac
+import logging
+import os
+from dataclasses import dataclass
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import yaml
+from llama_index.core import Document
+from llama_index.core.vector_stores.types import (
+    FilterCondition,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+
+logger = logging.getLogger("uvicorn")
+
+METADATA_CONFIG_PATH = "config/metadata.yaml"
+
+# Операторы в запросе: {"поле": значение}, {"поле": [значения]} (in) или {"поле": {"оператор": значение}}
+_OPERATORS = {
+    "eq": FilterOperator.EQ,
+    "ne": FilterOperator.NE,
+    "in": FilterOperator.IN,
+    "nin": FilterOperator.NIN,
+    "gt": FilterOperator.GT,
+    "gte": FilterOperator.GTE,
+    "lt": FilterOperator.LT,
+    "lte": FilterOperator.LTE,
+}
+_RANGE_OPERATORS = {"gt", "gte", "lt", "lte"}
+
+
+class MetadataFilterError(ValueError):
+    pass
+
+
+@dataclass
+class MetadataField:
+    name: str
+    type: str = "str"
+    # Поле метаданных документа, из которого значение вычисляется при генерации индекса
+    source: Optional[str] = None
+
+    def convert(self, value: Any) -> Any:
+        match self.type:
+            case "str":
+                return str(value)
+            case "int":
+                return int(value)
+            case "float":
+                return float(value)
+            case "date":
+                # Даты хранятся числом YYYYMMDD
+                if isinstance(value, (date, datetime)):
+                    return int(value.strftime("%Y%m%d"))
+                return int(datetime.fromisoformat(str(value)[:10]).strftime("%Y%m%d"))
+            case _:
+                raise ValueError(f"Неизвестный тип поля метаданных {self.name}: {self.type}")
+
+
+@lru_cache(maxsize=1)
+def load_metadata_fields() -> Dict[str, MetadataField]:
+    if not os.path.exists(METADATA_CONFIG_PATH):
+        return {}
+    with open(METADATA_CONFIG_PATH) as f:
+        configs = yaml.safe_load(f) or {}
+    return {
+        name: MetadataField(name=name, type=config.get("type", "str"), source=config.get("from"))
+        for name, config in configs.items()
+    }
+
+
+def stamp_metadata(document: Document, loader_type: str):
+    """
+    Поля для фильтрации при поиске: тип загрузчика, флаг private и вычисляемые поля из config/metadata.yaml.
+    В текст для эмбеддингов и LLM они не попадают
+    """
+    metadata = document.metadata
+    metadata["source"] = loader_type
+    metadata["private"] = "true" if str(metadata.get("private", "false")).lower() in ("true", "1") else "false"
+    stamped = ["source", "private"]
+    for field in load_metadata_fields().values():
+        if field.source and metadata.get(field.source) is not None:
+            try:
+                metadata[field.name] = field.convert(metadata[field.source])
+                stamped.append(field.name)
+            except ValueError:
+                logger.warning(f"Поле {field.source} документа {document.id_} не приводится к типу {field.type}")
+    for keys in (document.excluded_embed_metadata_keys, document.excluded_llm_metadata_keys):
+        keys.extend(key for key in stamped if key not in keys)
+
+
+def private_access_allowed(token: Optional[str]) -> bool:
+    # Документы с private=true доступны только запросам с токеном PRIVATE_ACCESS_TOKEN
+    expected = os.getenv("PRIVATE_ACCESS_TOKEN")
+    return bool(expected and token and hmac.compare_digest(token, expected))
+
+
+def _field_filters(field: MetadataField, spec: Any) -> List[MetadataFilter]:
+    if isinstance(spec, dict):
+        conditions = spec
+    elif isinstance(spec, list):
+        conditions = {"in": spec}
+    else:
+        conditions = {"eq": spec}
+    filters = []
+    for operator, value in conditions.items():
+        if operator not in _OPERATORS:
+            raise MetadataFilterError(f"Неизвестный оператор фильтра {field.name}: {operator}")
+        if operator in _RANGE_OPERATORS and field.type == "str":
+            raise MetadataFilterError(f"Поле {field.name} нельзя сравнивать на больше или меньше")
+        if operator in ("in", "nin") and (not isinstance(value, list) or not value):
+            raise MetadataFilterError(f"Для оператора {operator} поля {field.name} нужен непустой список")
+        if operator not in ("in", "nin") and isinstance(value, (list, dict)):
+            raise MetadataFilterError(f"Для оператора {operator} поля {field.name} нужно одно значение")
+        try:
+            value = [field.convert(item) for item in value] if operator in ("in", "nin") else field.convert(value)
+        except (TypeError, ValueError):
+            raise MetadataFilterError(f"Недопустимое значение фильтра {field.name}: {value}")
+        filters.append(MetadataFilter(key=field.name, value=value, operator=_OPERATORS[operator]))
+    return filters
+
+
+def build_filters(spec: Optional[Dict[str, Any]] = None, include_private: bool = False) -> Optional[MetadataFilters]:
+    """
+    Фильтры поиска из запроса: только поля из config/metadata.yaml, условия объединяются через И.
+    Без доступа к закрытым документам всегда добавляется private = "false"
+    """
+    fields = load_metadata_fields()
+    spec = dict(spec or {})
+    if not include_private:
+        spec.pop("private", None)
+
+    filters: List[MetadataFilter] = []
+    for name, condition in spec.items():
+        if name not in fields:
+            raise MetadataFilterError(f"Поле {name} недоступно для фильтрации")
+        filters.extend(_field_filters(fields[name], condition))
+    if not include_private:
+        filters.append(MetadataFilter(key="private", value="false", operator=FilterOperator.EQ))
+
+    if not filters:
+        return None
+    return MetadataFilters(filters=filters, condition=FilterCondition.AND)
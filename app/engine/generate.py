@@ -4,15 +4,27 @@ load_dotenv()
 
 import logging
 import os
+from contextlib import nullcontext
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+from llama_index.core import Document
 from llama_index.core.ingestion import DocstoreStrategy, IngestionPipeline
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.settings import Settings
 from llama_index.core.storage import StorageContext
 from llama_index.core.storage.docstore import SimpleDocumentStore
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
 
-from app.engine.loaders import get_documents
-from app.engine.vectordb import get_vector_store
+from app.engine.docstore import SQLiteDocumentStore
+from app.engine.embedding_cache import CachedEmbedding
+from app.engine.filters import stamp_metadata
+from app.engine.index import bump_index_version
+from app.engine.ingestion import IngestionPools, run_pipelined
+from app.engine.keyword_index import KeywordIndex, keyword_index_enabled
+from app.engine.loaders import get_loader_documents
+from app.engine.manifest import SourceManifest
+from app.engine.vectordb import get_vector_store, list_collections, route_collection
 from app.settings import init_settings
 
 storage_dir = os.environ.get("STORAGE_DIR", ".storage")
@@ -22,13 +34,146 @@ logger = logging.getLogger()
 
 
 def get_doc_store():
-    if os.path.exists(storage_dir):
+    # sqlite — документы читаются по ключу, json — SimpleDocumentStore целиком в памяти
+    if os.getenv("DOCSTORE_BACKEND", "sqlite") == "sqlite":
+        return SQLiteDocumentStore.from_env(storage_dir)
+    if os.path.exists(os.path.join(storage_dir, "docstore.json")):
         return SimpleDocumentStore.from_persist_dir(storage_dir)
     else:
         return SimpleDocumentStore()
 
 
-def run_pipeline(docstore, vector_store, documents):
+def commit_scope(doc_store):
+    # Изменения части корпуса в SQLite фиксируются одной транзакцией, JSON записывается в persist_storage
+    if isinstance(doc_store, SQLiteDocumentStore):
+        return doc_store.transaction()
+    return nullcontext()
+
+
+def get_keyword_index(docstore, vector_stores) -> Optional[KeywordIndex]:
+    if not keyword_index_enabled():
+        return None
+    keyword_index = KeywordIndex.load(storage_dir)
+    if keyword_index.is_empty and docstore.get_all_document_hashes():
+        rebuild_keyword_index(keyword_index, vector_stores)
+    return keyword_index
+
+
+def rebuild_keyword_index(keyword_index: KeywordIndex, vector_stores, page_size: int = 1000):
+    # Индекс ключевых слов появился после векторного: заполнить его узлами из Chroma
+    logger.info("Построение индекса ключевых слов по узлам векторного хранилища…")
+    for vector_store in vector_stores:
+        collection = vector_store.client
+        offset = 0
+        while True:
+            result = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            if not result["ids"]:
+                break
+            nodes = []
+            for text, metadata in zip(result["documents"], result["metadatas"]):
+                node = metadata_dict_to_node(metadata)
+                node.set_content(text)
+                nodes.append(node)
+            keyword_index.add(nodes)
+            offset += len(result["ids"])
+    keyword_index.persist()
+    logger.info(f"Индекс ключевых слов построен, узлов: {len(keyword_index)}")
+
+
+def delete_documents(docstore, vector_stores, keyword_index: Optional[KeywordIndex], doc_ids: Iterable[str]):
+    # Коллекция документа не хранится, поэтому он удаляется из всех
+    doc_ids = list(doc_ids)
+    for doc_id in doc_ids:
+        docstore.delete_document(doc_id, raise_error=False)
+        for vector_store in vector_stores:
+            vector_store.delete(doc_id)
+    if keyword_index is not None:
+        keyword_index.delete_documents(doc_ids)
+
+
+def list_document_ids(docstore) -> List[str]:
+    # get_all_document_hashes возвращает {хеш: id}: документы с одинаковым содержимым в нём схлопываются
+    if isinstance(docstore, SQLiteDocumentStore):
+        return docstore.document_ids()
+    return list(docstore._kvstore.get_all(collection=docstore._metadata_collection))
+
+
+def index_manifest_documents(docstore, manifest: SourceManifest):
+    # Манифест прошлой версии: источники документов определяются один раз по их метаданным
+    if manifest.indexed:
+        return
+    logger.info("Построение индекса документов источников в манифесте…")
+
+    def documents() -> Iterator[Tuple[str, dict]]:
+        for doc_id in list_document_ids(docstore):
+            document = docstore.get_document(doc_id, raise_error=False)
+            yield doc_id, document.metadata if document is not None else {}
+
+    manifest.index_documents(documents())
+    manifest.save()
+
+
+def delete_stale_documents(docstore, vector_stores, keyword_index: Optional[KeywordIndex], manifest: SourceManifest):
+    stale_ids, stale_queries = manifest.take_stale()
+    if stale_queries:
+        prefixes = tuple(f"{key}:" for key in stale_queries)
+        stale_ids.extend(doc_id for doc_id in list_document_ids(docstore) if doc_id.startswith(prefixes))
+    if not stale_ids:
+        return
+
+    delete_documents(docstore, vector_stores, keyword_index, stale_ids)
+
+    logger.info(f"Удалено устаревших документов: {len(stale_ids)}")
+
+
+def delete_missing_documents(docstore, vector_stores, keyword_index: Optional[KeywordIndex], seen_ids: Set[str]):
+    # Полная генерация: удалить документы, которых больше нет в источниках
+    missing_ids = set(list_document_ids(docstore)) - seen_ids
+    delete_documents(docstore, vector_stores, keyword_index, missing_ids)
+
+
+def delete_moved_documents(docstore, vector_stores: Dict[str, object], collection_name: str, documents: List[Document]):
+    # Изменённый документ мог сменить коллекцию (например, значение поля метаданных):
+    # его прежние узлы удаляются из остальных коллекций
+    changed = [
+        doc.id_ for doc in documents
+        if docstore.get_document_hash(doc.id_) not in (None, doc.hash)
+    ]
+    for name, vector_store in vector_stores.items():
+        if name != collection_name:
+            for doc_id in changed:
+                vector_store.delete(doc_id)
+
+
+def shard_documents(
+        documents: Iterable[Tuple[str, Document]],
+        shard_by: str,
+) -> Dict[str, List[Document]]:
+    """
+    Распределяет документы по коллекциям согласно INGEST_SHARD_BY:
+    none — все в CHROMA_COLLECTION, loader — по типу загрузчика (CHROMA_COLLECTION-file, -web, -db),
+    metadata:<поле> — по значению поля метаданных документа
+    """
+    shards: Dict[str, List[Document]] = {}
+    for loader_type, doc in documents:
+        shards.setdefault(route_collection(doc.metadata, shard_by, loader_type), []).append(doc)
+    return shards
+
+
+def pipelined_ingestion() -> bool:
+    return os.getenv("INGEST_MODE", "sequential") == "pipelined"
+
+
+def run_pipeline(
+        docstore,
+        vector_store,
+        documents,
+        keyword_index: Optional[KeywordIndex] = None,
+        pools: Optional[IngestionPools] = None,
+):
+    if pipelined_ingestion():
+        return run_pipelined(docstore, vector_store, documents, keyword_index=keyword_index, pools=pools)
+
     pipeline = IngestionPipeline(
         transformations=[
             SentenceSplitter(
@@ -38,39 +183,107 @@ def run_pipeline(docstore, vector_store, documents):
             Settings.embed_model,
         ],
         docstore=docstore,
-        docstore_strategy=DocstoreStrategy.UPSERTS_AND_DELETE,  # type: ignore
+        # Документы подаются частями, поэтому удаление отсутствующих выполняется отдельно
+        docstore_strategy=DocstoreStrategy.UPSERTS,  # type: ignore
         vector_store=vector_store,
     )
 
     nodes = pipeline.run(show_progress=True, documents=documents)
 
+    if keyword_index is not None:
+        # Возвращаются только узлы новых и изменённых документов, их прежние узлы заменяются
+        keyword_index.delete_documents({node.ref_doc_id for node in nodes})
+        keyword_index.add(nodes)
+
     return nodes
 
 
-def persist_storage(doc_store, vector_store):
+def persist_storage(doc_store, keyword_index: Optional[KeywordIndex] = None):
+    # Индекс ключевых слов сохраняется первым: после сбоя документы будут загружены
+    # повторно и заменят свои узлы, а не пропадут из него
+    if keyword_index is not None:
+        keyword_index.persist()
+    if isinstance(doc_store, SQLiteDocumentStore):
+        return
+    # Коллекции Chroma сохраняют узлы сами, на диск записывается хранилище документов
     storage_context = StorageContext.from_defaults(
         docstore=doc_store,
-        vector_store=vector_store,
     )
     storage_context.persist(storage_dir)
 
 
+def tag_documents(documents: Iterable[Tuple[str, Document]]) -> Iterator[Tuple[str, Document]]:
+    for loader_type, doc in documents:
+        stamp_metadata(doc, loader_type)
+        yield loader_type, doc
+
+
+def batched(documents: Iterable, size: int) -> Iterator[List]:
+    iterator = iter(documents)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
 def generate_datasource():
     init_settings()
     logger.info("Начало процесса генерации индексов для предоставленных данных")
 
-    documents = get_documents()
+    doc_store = get_doc_store()
+    shard_by = os.getenv("INGEST_SHARD_BY", "none")
+    # Существующие коллекции корпуса, новые добавляются по мере появления
+    vector_stores = {name: get_vector_store(name) for name in list_collections()}
+    keyword_index = get_keyword_index(doc_store, list(vector_stores.values()))
 
-    for doc in documents:
-        doc.metadata["private"] = "false"
+    incremental = os.getenv("INGEST_INCREMENTAL", "True").lower() == "true"
+    manifest = None
+    if incremental:
+        manifest = SourceManifest.load(storage_dir)
+        if not list_document_ids(doc_store):
+            # Хранилище документов пустое: манифест не соответствует ему, загрузить всё заново
+            manifest = SourceManifest(manifest.path)
+        index_manifest_documents(doc_store, manifest)
 
-    doc_store = get_doc_store()
-    vector_store = get_vector_store()
+    # Документы обрабатываются частями, каждая часть сохраняется сразу после обработки,
+    # поэтому память не растёт с размером корпуса, а после сбоя работа продолжается
+    # с первой незафиксированной части
+    commit_size = int(os.getenv("INGEST_COMMIT_SIZE", "500"))
+    seen_ids: Set[str] = set()
+
+    # Пулы процессов конвейера создаются один раз на все части и коллекции
+    pools = IngestionPools() if pipelined_ingestion() else None
+    with pools or nullcontext():
+        for batch in batched(tag_documents(get_loader_documents(manifest)), commit_size):
+            with commit_scope(doc_store):
+                if manifest is not None:
+                    delete_stale_documents(doc_store, vector_stores.values(), keyword_index, manifest)
+
+                for collection_name, documents in shard_documents(batch, shard_by).items():
+                    if collection_name not in vector_stores:
+                        logger.info(f"Новая коллекция: {collection_name}")
+                        vector_stores[collection_name] = get_vector_store(collection_name)
+                    delete_moved_documents(doc_store, vector_stores, collection_name, documents)
+                    run_pipeline(doc_store, vector_stores[collection_name], documents, keyword_index, pools)
+                persist_storage(doc_store, keyword_index)
 
-    _ = run_pipeline(doc_store, vector_store, documents)
+            batch_ids = [doc.id_ for _, doc in batch]
+            seen_ids.update(batch_ids)
+            if manifest is not None:
+                manifest.commit(batch_ids)
+                manifest.save()
+            logger.info(f"Зафиксировано документов: {len(seen_ids)}")
 
-    persist_storage(doc_store, vector_store)
+    with commit_scope(doc_store):
+        if manifest is not None:
+            delete_stale_documents(doc_store, vector_stores.values(), keyword_index, manifest)
+        else:
+            delete_missing_documents(doc_store, vector_stores.values(), keyword_index, seen_ids)
+        persist_storage(doc_store, keyword_index)
+    if manifest is not None:
+        manifest.save()
+    bump_index_version()
 
+    if isinstance(Settings.embed_model, CachedEmbedding):
+        logger.info(f"Кеш эмбеддингов: {Settings.embed_model.stats}")
     logger.info("Процесс генерации индексов завершен")
 
 
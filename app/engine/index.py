@@ -1,19 +1,28 @@
 ﻿import logging
-from typing import Optional
+import os
+import time
+from typing import List, Optional
 
 from llama_index.core import VectorStoreIndex
 from llama_index.core.callbacks import CallbackManager
 from pydantic import BaseModel, Field
 
-from app.engine.vectordb import get_vector_store
+from app.engine.tracing import VECTOR_STORE_CONNECT_SECONDS
+from app.engine.vectordb import get_collections_store
 
 logger = logging.getLogger("uvicorn")
 
+INDEX_VERSION_FILE = "index_version"
+
 
 class IndexConfig(BaseModel):
     callback_manager: Optional[CallbackManager] = Field(
         default=None,
     )
+    # Коллекции (части корпуса) для поиска, по умолчанию — все
+    collections: Optional[List[str]] = Field(
+        default=None,
+    )
 
 
 def get_index(config: IndexConfig = None):
@@ -22,7 +31,8 @@ def get_index(config: IndexConfig = None):
 
     logger.info("Подключение векторного хранилища…")
 
-    store = get_vector_store()
+    with VECTOR_STORE_CONNECT_SECONDS.time():
+        store = get_collections_store(config.collections)
     index = VectorStoreIndex.from_vector_store(
         store,
         callback_manager=config.callback_manager,
@@ -31,3 +41,26 @@ def get_index(config: IndexConfig = None):
     logger.info("Завершенный индекс загрузки из векторного хранилища.")
 
     return index
+
+
+def _index_version_path() -> str:
+    storage_dir = os.environ.get("STORAGE_DIR", ".storage")
+    return os.path.join(storage_dir, INDEX_VERSION_FILE)
+
+
+def get_index_version() -> Optional[str]:
+    path = _index_version_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def bump_index_version() -> str:
+    # Метка меняется при каждой генерации индекса, по ней сбрасываются кеши ответов
+    version = str(time.time_ns())
+    path = _index_version_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        f.write(version)
+    return version
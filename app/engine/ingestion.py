@@ -0,0 +1,328 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+from llama_index.core import Document
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.settings import Settings
+
+logger = logging.getLogger()
+
+_DONE = object()
+
+
+@dataclass
+class IngestionConfig:
+    # Документов в одной задаче разбиения для пула процессов
+    parse_batch_size: int = 16
+    parse_workers: int = field(default_factory=lambda: os.cpu_count() or 1)
+    embed_batch_size: int = 64
+    # 0 — эмбеддинги считаются в текущем процессе, иначе в отдельных процессах,
+    # закреплённых за своими ядрами
+    embed_workers: int = 0
+    queue_size: int = 8
+
+    @classmethod
+    def from_env(cls) -> "IngestionConfig":
+        return cls(
+            parse_batch_size=int(os.getenv("INGEST_PARSE_BATCH_SIZE", "16")),
+            parse_workers=int(os.getenv("INGEST_PARSE_WORKERS", str(os.cpu_count() or 1))),
+            embed_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")),
+            embed_workers=int(os.getenv("INGEST_EMBED_WORKERS", "0")),
+            queue_size=int(os.getenv("INGEST_QUEUE_SIZE", "8")),
+        )
+
+
+@dataclass
+class StageStats:
+    name: str
+    unit: str
+    items: int = 0
+    busy_seconds: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, items: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.busy_seconds += seconds
+
+    def __str__(self) -> str:
+        rate = self.items / self.busy_seconds if self.busy_seconds else 0.0
+        return f"{self.name}: {self.items} {self.unit}, {self.busy_seconds:.2f}s, {rate:.1f} {self.unit}/s"
+
+
+# Функции, выполняемые в процессах пула
+
+_splitter: Optional[SentenceSplitter] = None
+
+
+def _init_split_worker(chunk_size: int, chunk_overlap: int):
+    global _splitter
+    _splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def _split_documents(documents: List[Document]) -> Tuple[List[BaseNode], float]:
+    start = time.perf_counter()
+    nodes = _splitter.get_nodes_from_documents(documents)
+    return nodes, time.perf_counter() - start
+
+
+def _init_embed_worker(counter, cores_per_worker: int):
+    with counter.get_lock():
+        worker_index = counter.value
+        counter.value += 1
+
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+    if available and cores_per_worker:
+        first = (worker_index * cores_per_worker) % len(available)
+        cores = {available[(first + i) % len(available)] for i in range(cores_per_worker)}
+        os.sched_setaffinity(0, cores)
+        try:
+            import torch
+            torch.set_num_threads(len(cores))
+        except ImportError:
+            pass
+
+    from app.settings import _init_embed_model
+    _init_embed_model()
+
+
+def _embed_texts(texts: List[str]) -> List[List[float]]:
+    return Settings.embed_model.get_text_embedding_batch(texts)
+
+
+class _Stage(threading.Thread):
+    """
+    Стадия конвейера: читает элементы из inbox и кладёт результаты в outbox.
+    После ошибки продолжает вычитывать inbox, чтобы не заблокировать предыдущие стадии.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            inbox: queue.Queue,
+            outbox: Optional[queue.Queue],
+            handle: Callable[[object, Callable[[object], None]], None],
+            finish: Optional[Callable[[Callable[[object], None]], None]] = None,
+            producers: int = 1,
+            consumers: int = 1,
+    ):
+        super().__init__(name=f"ingest-{name}", daemon=True)
+        self.inbox = inbox
+        self.outbox = outbox
+        self.handle = handle
+        self.finish = finish
+        self.producers = producers
+        self.consumers = consumers
+        self.error: Optional[BaseException] = None
+
+    def emit(self, item):
+        if self.outbox is not None:
+            self.outbox.put(item)
+
+    def _items(self):
+        remaining = self.producers
+        while remaining:
+            item = self.inbox.get()
+            if item is _DONE:
+                remaining -= 1
+            else:
+                yield item
+
+    def run(self):
+        items = self._items()
+        try:
+            for item in items:
+                self.handle(item, self.emit)
+            if self.finish is not None:
+                self.finish(self.emit)
+        except BaseException as e:
+            self.error = e
+            for _ in items:
+                pass
+        finally:
+            for _ in range(self.consumers):
+                self.emit(_DONE)
+
+
+class IngestionPools:
+    """
+    Пулы процессов разбиения и эмбеддингов на весь запуск генерации: процессы эмбеддингов загружают
+    модель при старте, поэтому пулы не пересоздаются для каждой части документов и коллекции
+    """
+
+    def __init__(self, config: Optional[IngestionConfig] = None):
+        self.config = config or IngestionConfig.from_env()
+        self.split_pool = ProcessPoolExecutor(
+            max_workers=self.config.parse_workers,
+            initializer=_init_split_worker,
+            initargs=(Settings.chunk_size, Settings.chunk_overlap),
+        )
+        self.embed_pool = _create_embed_pool(self.config)
+
+    def close(self):
+        self.split_pool.shutdown()
+        if self.embed_pool is not None:
+            self.embed_pool.shutdown()
+
+    def __enter__(self) -> "IngestionPools":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _select_documents(docstore, vector_store, documents: Iterable[Document], keyword_index=None):
+    """
+    Та же логика, что у DocstoreStrategy.UPSERTS в IngestionPipeline:
+    неизменённые документы пропускаются, изменённые удаляются из хранилищ перед загрузкой
+    """
+    for document in documents:
+        existing_hash = docstore.get_document_hash(document.id_)
+        if existing_hash == document.hash:
+            continue
+        if existing_hash is not None:
+            vector_store.delete(document.id_)
+        if keyword_index is not None:
+            # Индекс ключевых слов сохраняется раньше docstore и может уже содержать документ
+            keyword_index.delete_documents([document.id_])
+        yield document
+
+
+def run_pipelined(
+        docstore,
+        vector_store,
+        documents: Iterable[Document],
+        config: Optional[IngestionConfig] = None,
+        keyword_index=None,
+        pools: Optional[IngestionPools] = None,
+) -> List[StageStats]:
+    """
+    Чтение, разбиение (пул процессов), эмбеддинги (пакетами) и запись в векторное хранилище
+    выполняются одновременно, стадии связаны ограниченными очередями.
+    Без pools пулы процессов создаются на один вызов
+    """
+    own_pools = pools is None
+    if own_pools:
+        pools = IngestionPools(config)
+    config = pools.config
+
+    read_stats = StageStats("чтение", "док")
+    split_stats = StageStats("разбиение", "узлов")
+    embed_stats = StageStats("эмбеддинги", "узлов")
+    write_stats = StageStats("запись", "узлов")
+
+    split_pool = pools.split_pool
+    embed_pool = pools.embed_pool
+
+    documents_queue = queue.Queue(maxsize=config.queue_size)
+    nodes_queue = queue.Queue(maxsize=config.queue_size)
+    embedded_queue = queue.Queue(maxsize=config.queue_size)
+    processed_documents: List[Document] = []
+    pending: deque = deque()
+
+    def handle_split(batch: List[Document], emit):
+        pending.append((batch, split_pool.submit(_split_documents, batch)))
+        while len(pending) >= config.parse_workers * 2:
+            _emit_split(emit)
+
+    def finish_split(emit):
+        while pending:
+            _emit_split(emit)
+
+    def _emit_split(emit):
+        batch, future = pending.popleft()
+        nodes, seconds = future.result()
+        split_stats.add(len(nodes), seconds)
+        processed_documents.extend(batch)
+        for start in range(0, len(nodes), config.embed_batch_size):
+            emit(nodes[start:start + config.embed_batch_size])
+
+    def handle_embed(nodes: Sequence[BaseNode], emit):
+        start = time.perf_counter()
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        if embed_pool is not None:
+            embeddings = embed_pool.submit(_embed_texts, texts).result()
+        else:
+            embeddings = Settings.embed_model.get_text_embedding_batch(texts)
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+        embed_stats.add(len(nodes), time.perf_counter() - start)
+        emit(nodes)
+
+    def handle_write(nodes: Sequence[BaseNode], emit):
+        start = time.perf_counter()
+        vector_store.add(list(nodes))
+        if keyword_index is not None:
+            keyword_index.add(nodes)
+        write_stats.add(len(nodes), time.perf_counter() - start)
+
+    # С пулом процессов несколько пакетов эмбеддингов обрабатываются параллельно
+    embed_threads = max(config.embed_workers, 1)
+    stages = [
+        _Stage(
+            "split", documents_queue, nodes_queue, handle_split, finish_split,
+            consumers=embed_threads,
+        ),
+        *[
+            _Stage(f"embed-{i}", nodes_queue, embedded_queue, handle_embed)
+            for i in range(embed_threads)
+        ],
+        _Stage("write", embedded_queue, None, handle_write, producers=embed_threads),
+    ]
+    for stage in stages:
+        stage.start()
+
+    try:
+        batch: List[Document] = []
+        start = time.perf_counter()
+        for document in _select_documents(docstore, vector_store, documents, keyword_index):
+            batch.append(document)
+            if len(batch) >= config.parse_batch_size:
+                read_stats.add(len(batch), time.perf_counter() - start)
+                documents_queue.put(batch)
+                batch = []
+                start = time.perf_counter()
+        if batch:
+            read_stats.add(len(batch), time.perf_counter() - start)
+            documents_queue.put(batch)
+    finally:
+        documents_queue.put(_DONE)
+        for stage in stages:
+            stage.join()
+        if own_pools:
+            pools.close()
+
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+    # Документы фиксируются в docstore только после записи их узлов в векторное хранилище
+    docstore.add_documents(processed_documents)
+    docstore.set_document_hashes({doc.id_: doc.hash for doc in processed_documents})
+
+    stats = [read_stats, split_stats, embed_stats, write_stats]
+    for stage_stats in stats:
+        logger.info(str(stage_stats))
+    return stats
+
+
+def _create_embed_pool(config: IngestionConfig) -> Optional[Executor]:
+    if config.embed_workers <= 0:
+        return None
+    cores_per_worker = max((os.cpu_count() or 1) // config.embed_workers, 1)
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(
+        max_workers=config.embed_workers,
+        mp_context=context,
+        initializer=_init_embed_worker,
+        initargs=(context.Value("i", 0), cores_per_worker),
+    )
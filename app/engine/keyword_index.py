@@ -0,0 +1,394 @@
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from llama_index.core.schema import BaseNode, MetadataMode
+
+logger = logging.getLogger(__name__)
+
+KEYWORD_INDEX_DIR = "keyword_index"
+META_FILE = "meta.json"
+VOCAB_FILE = "vocab.json"
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    # Номера статей и пунктов сохраняются как отдельные токены
+    return _TOKEN_RE.findall(text.lower().replace("ё", "е"))
+
+
+def keyword_index_enabled() -> bool:
+    return os.getenv("KEYWORD_INDEX_ENABLED", "True").lower() == "true"
+
+
+def _csr(term_ids: np.ndarray, doc_ids: np.ndarray, freqs: np.ndarray, n_terms: int):
+    """
+    Списки вхождений, сгруппированные по термину: postings[offsets[t]:offsets[t + 1]]
+    """
+    order = np.argsort(term_ids, kind="stable")
+    offsets = np.zeros(n_terms + 1, dtype=np.int64)
+    np.cumsum(np.bincount(term_ids, minlength=n_terms), out=offsets[1:])
+    return offsets, doc_ids[order].astype(np.int32), freqs[order].astype(np.int32)
+
+
+@dataclass
+class _Entry:
+    node_id: str
+    ref_doc_id: str
+    terms: Counter
+    length: int
+
+
+class _Segment:
+    """
+    Неизменяемый сегмент индекса: массивы numpy в отдельных .npy-файлах,
+    открываются через mmap и не загружаются в память целиком
+    """
+
+    def __init__(self, name: str, path: str, nodes: List[List[str]], mmap: bool = True):
+        self.name = name
+        self.path = path
+        self.node_ids = [node_id for node_id, _ in nodes]
+        self.ref_doc_ids = [ref_doc_id for _, ref_doc_id in nodes]
+        mode = "r" if mmap else None
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode=mode)
+        self.postings = np.load(os.path.join(path, "postings.npy"), mmap_mode=mode)
+        self.freqs = np.load(os.path.join(path, "freqs.npy"), mmap_mode=mode)
+        self.lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode=mode)
+        self.total_length = int(self.lengths.sum())
+
+    @classmethod
+    def open(cls, name: str, path: str) -> "_Segment":
+        with open(os.path.join(path, "nodes.json"), encoding="utf-8") as f:
+            return cls(name, path, json.load(f))
+
+    @classmethod
+    def write(
+            cls,
+            name: str,
+            path: str,
+            nodes: List[List[str]],
+            arrays: Tuple[np.ndarray, np.ndarray, np.ndarray],
+            lengths: np.ndarray,
+    ) -> "_Segment":
+        tmp_path = f"{path}.tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        offsets, postings, freqs = arrays
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp_path, "postings.npy"), postings)
+        np.save(os.path.join(tmp_path, "freqs.npy"), freqs)
+        np.save(os.path.join(tmp_path, "lengths.npy"), lengths.astype(np.int32))
+        with open(os.path.join(tmp_path, "nodes.json"), "w", encoding="utf-8") as f:
+            json.dump(nodes, f, ensure_ascii=False)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return cls.open(name, path)
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def postings_of(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        if term_id + 1 >= len(self.offsets):
+            return self.postings[:0], self.freqs[:0]
+        start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+        return self.postings[start:end], self.freqs[start:end]
+
+    def doc_freq(self, term_id: int) -> int:
+        if term_id + 1 >= len(self.offsets):
+            return 0
+        return int(self.offsets[term_id + 1] - self.offsets[term_id])
+
+    def triples(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (термин, узел, частота) для каждого вхождения — используется при слиянии сегментов
+        term_ids = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        return term_ids, np.asarray(self.postings), np.asarray(self.freqs)
+
+
+class KeywordIndex:
+    """
+    Инвертированный индекс BM25 по узлам, записанным в векторное хранилище.
+    Хранится в STORAGE_DIR/keyword_index сегментами: новые узлы дописываются
+    отдельным сегментом, удалённые помечаются и вычищаются при слиянии сегментов.
+    """
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75, max_segments: int = 8):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.max_segments = max_segments
+        self._lock = threading.RLock()
+        self._vocab: Dict[str, int] = {}
+        self._terms: List[str] = []
+        self._segments: List[_Segment] = []
+        self._deleted: Dict[str, Set[int]] = {}
+        self._pending: Dict[str, _Entry] = {}
+        self._doc_nodes: Dict[str, List[Tuple[str, int]]] = {}
+        self._next_segment = 0
+        # Каталоги сегментов, заменённых слиянием; удаляются после записи метаданных
+        self._obsolete: List[str] = []
+
+    @classmethod
+    def from_env(cls, storage_dir: Optional[str] = None) -> "KeywordIndex":
+        storage_dir = storage_dir or os.environ.get("STORAGE_DIR", ".storage")
+        return cls(
+            os.path.join(storage_dir, KEYWORD_INDEX_DIR),
+            k1=float(os.getenv("BM25_K1", "1.2")),
+            b=float(os.getenv("BM25_B", "0.75")),
+            max_segments=int(os.getenv("KEYWORD_INDEX_MAX_SEGMENTS", "8")),
+        )
+
+    @classmethod
+    def load(cls, storage_dir: Optional[str] = None) -> "KeywordIndex":
+        index = cls.from_env(storage_dir)
+        meta_path = os.path.join(index.path, META_FILE)
+        if not os.path.exists(meta_path):
+            return index
+
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(os.path.join(index.path, VOCAB_FILE), encoding="utf-8") as f:
+            index._terms = json.load(f)
+        index._vocab = {term: term_id for term_id, term in enumerate(index._terms)}
+        index._next_segment = meta["next_segment"]
+        for name in meta["segments"]:
+            index._add_segment(_Segment.open(name, os.path.join(index.path, name)))
+        for name, positions in meta["deleted"].items():
+            index._deleted[name] = set(positions)
+            for position in positions:
+                index._unlink_doc_node(index._segment(name).ref_doc_ids[position], name, position)
+        return index
+
+    @property
+    def is_empty(self) -> bool:
+        return not self._doc_nodes and not self._pending
+
+    def __len__(self) -> int:
+        return sum(len(s) - len(self._deleted.get(s.name, ())) for s in self._segments) + len(self._pending)
+
+    def _segment(self, name: str) -> _Segment:
+        return next(segment for segment in self._segments if segment.name == name)
+
+    def _add_segment(self, segment: _Segment):
+        self._segments.append(segment)
+        for position, ref_doc_id in enumerate(segment.ref_doc_ids):
+            self._doc_nodes.setdefault(ref_doc_id, []).append((segment.name, position))
+
+    def _unlink_doc_node(self, ref_doc_id: str, name: str, position: int):
+        locations = self._doc_nodes.get(ref_doc_id)
+        if locations is None:
+            return
+        locations.remove((name, position))
+        if not locations:
+            del self._doc_nodes[ref_doc_id]
+
+    def _term_id(self, term: str) -> int:
+        term_id = self._vocab.get(term)
+        if term_id is None:
+            term_id = self._vocab[term] = len(self._terms)
+            self._terms.append(term)
+        return term_id
+
+    # Изменения
+
+    def add(self, nodes: Iterable[BaseNode]):
+        """
+        Узлы становятся доступны для поиска после persist()
+        """
+        entries = []
+        for node in nodes:
+            tokens = tokenize(node.get_content(metadata_mode=MetadataMode.NONE))
+            entries.append(_Entry(node.node_id, node.ref_doc_id or node.node_id, Counter(tokens), len(tokens)))
+        with self._lock:
+            for entry in entries:
+                self._pending[entry.node_id] = entry
+
+    def delete_documents(self, ref_doc_ids: Iterable[str]):
+        with self._lock:
+            ref_doc_ids = set(ref_doc_ids)
+            for node_id in [n for n, e in self._pending.items() if e.ref_doc_id in ref_doc_ids]:
+                del self._pending[node_id]
+            for ref_doc_id in ref_doc_ids:
+                for name, position in self._doc_nodes.pop(ref_doc_id, []):
+                    self._deleted.setdefault(name, set()).add(position)
+
+    def persist(self):
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            if self._pending:
+                self._flush_pending()
+            deleted = sum(len(positions) for positions in self._deleted.values())
+            total = sum(len(segment) for segment in self._segments)
+            if len(self._segments) > self.max_segments or (total and deleted / total > 0.25):
+                self._merge_segments()
+            self._write_meta()
+
+    def _new_segment_name(self) -> str:
+        name = f"segment-{self._next_segment:06d}"
+        self._next_segment += 1
+        return name
+
+    def _flush_pending(self):
+        entries = list(self._pending.values())
+        term_ids, doc_ids, freqs = [], [], []
+        for position, entry in enumerate(entries):
+            for term, count in entry.terms.items():
+                term_ids.append(self._term_id(term))
+                doc_ids.append(position)
+                freqs.append(count)
+
+        name = self._new_segment_name()
+        segment = _Segment.write(
+            name,
+            os.path.join(self.path, name),
+            [[entry.node_id, entry.ref_doc_id] for entry in entries],
+            _csr(
+                np.asarray(term_ids, dtype=np.int64),
+                np.asarray(doc_ids, dtype=np.int32),
+                np.asarray(freqs, dtype=np.int32),
+                len(self._terms),
+            ),
+            np.asarray([entry.length for entry in entries], dtype=np.int32),
+        )
+        self._add_segment(segment)
+        self._pending.clear()
+
+    def _merge_segments(self):
+        logger.info(f"Слияние сегментов индекса ключевых слов: {len(self._segments)}")
+        nodes: List[List[str]] = []
+        lengths, term_parts, doc_parts, freq_parts = [], [], [], []
+        for segment in self._segments:
+            deleted = self._deleted.get(segment.name, set())
+            live = np.ones(len(segment), dtype=bool)
+            live[list(deleted)] = False
+            # Новые позиции живых узлов после слияния, удалённые получают -1
+            remap = np.full(len(segment), -1, dtype=np.int64)
+            remap[live] = np.arange(len(nodes), len(nodes) + int(live.sum()))
+            nodes.extend(
+                [node_id, ref_doc_id]
+                for position, (node_id, ref_doc_id) in enumerate(zip(segment.node_ids, segment.ref_doc_ids))
+                if live[position]
+            )
+            lengths.append(np.asarray(segment.lengths)[live])
+
+            term_ids, doc_ids, freqs = segment.triples()
+            keep = live[doc_ids]
+            term_parts.append(term_ids[keep])
+            doc_parts.append(remap[doc_ids[keep]])
+            freq_parts.append(freqs[keep])
+
+        old_segments = self._segments
+        self._segments, self._deleted, self._doc_nodes = [], {}, {}
+        name = self._new_segment_name()
+        self._add_segment(_Segment.write(
+            name,
+            os.path.join(self.path, name),
+            nodes,
+            _csr(
+                np.concatenate(term_parts) if term_parts else np.zeros(0, dtype=np.int64),
+                np.concatenate(doc_parts) if doc_parts else np.zeros(0, dtype=np.int32),
+                np.concatenate(freq_parts) if freq_parts else np.zeros(0, dtype=np.int32),
+                len(self._terms),
+            ),
+            np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int32),
+        ))
+        self._obsolete.extend(segment.path for segment in old_segments)
+
+    def _write_meta(self):
+        vocab_tmp = os.path.join(self.path, f"{VOCAB_FILE}.tmp")
+        with open(vocab_tmp, "w", encoding="utf-8") as f:
+            json.dump(self._terms, f, ensure_ascii=False)
+        os.replace(vocab_tmp, os.path.join(self.path, VOCAB_FILE))
+
+        meta_tmp = os.path.join(self.path, f"{META_FILE}.tmp")
+        with open(meta_tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "next_segment": self._next_segment,
+                    "segments": [segment.name for segment in self._segments],
+                    "deleted": {name: sorted(positions) for name, positions in self._deleted.items() if positions},
+                },
+                f,
+            )
+        os.replace(meta_tmp, os.path.join(self.path, META_FILE))
+
+        for path in self._obsolete:
+            shutil.rmtree(path, ignore_errors=True)
+        self._obsolete = []
+
+    # Поиск
+
+    def search(self, query: str, top_k: int) -> List[Tuple[str, float]]:
+        """
+        Возвращает (id узла, оценка BM25) по убыванию оценки
+        """
+        with self._lock:
+            segments = list(self._segments)
+            deleted = {name: list(positions) for name, positions in self._deleted.items()}
+            term_ids = sorted({self._vocab[t] for t in tokenize(query) if t in self._vocab})
+
+        n_nodes = sum(len(s) - len(deleted.get(s.name, ())) for s in segments)
+        if not term_ids or not n_nodes:
+            return []
+        total_length = sum(
+            s.total_length - int(np.asarray(s.lengths)[deleted[s.name]].sum()) if s.name in deleted else s.total_length
+            for s in segments
+        )
+        avg_length = total_length / n_nodes or 1.0
+
+        # Частота термина считается с учётом помеченных удалёнными узлов до ближайшего слияния
+        idf = []
+        for term_id in term_ids:
+            df = sum(segment.doc_freq(term_id) for segment in segments)
+            idf.append(math.log(1 + (n_nodes - df + 0.5) / (df + 0.5)))
+
+        candidates: List[Tuple[float, str]] = []
+        for segment in segments:
+            scores = self._score_segment(segment, term_ids, idf, avg_length)
+            if segment.name in deleted:
+                scores[deleted[segment.name]] = 0.0
+            k = min(top_k, len(scores))
+            if not k:
+                continue
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates.extend((float(scores[i]), segment.node_ids[i]) for i in top if scores[i] > 0)
+
+        candidates.sort(reverse=True)
+        return [(node_id, score) for score, node_id in candidates[:top_k]]
+
+    def _score_segment(
+            self,
+            segment: _Segment,
+            term_ids: Sequence[int],
+            idf: Sequence[float],
+            avg_length: float,
+    ) -> np.ndarray:
+        scores = np.zeros(len(segment), dtype=np.float32)
+        for term_id, weight in zip(term_ids, idf):
+            docs, freqs = segment.postings_of(term_id)
+            if not len(docs):
+                continue
+            tf = np.asarray(freqs, dtype=np.float32)
+            norm = self.k1 * (1 - self.b + self.b * np.asarray(segment.lengths[docs], dtype=np.float32) / avg_length)
+            scores[docs] += weight * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+
+def load_keyword_index(storage_dir: Optional[str] = None) -> Optional[KeywordIndex]:
+    if not keyword_index_enabled():
+        return None
+    index = KeywordIndex.load(storage_dir)
+    if index.is_empty:
+        logger.warning("Индекс ключевых слов пуст, используется только векторный поиск")
+        return None
+    logger.info(f"Индекс ключевых слов загружен, узлов: {len(index)}")
+    return index
@@ -0,0 +1,556 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from llama_index.core.base.llms.generic_utils import (
+    astream_completion_response_to_chat_response,
+    completion_response_to_chat_response,
+)
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+
+from app.engine.prefix_cache import PrefixKVCache
+from app.engine.tracing import current_route, observe_queue_wait
+
+logger = logging.getLogger("uvicorn")
+
+_DONE = object()
+
+
+class LLMOverloadedError(RuntimeError):
+    """
+    Очередь запросов к модели заполнена, запрос отклонён
+    """
+
+
+class LLMSchedulerClosedError(LLMOverloadedError):
+    """
+    Очередь запросов к модели закрыта при остановке сервера, запрос не будет выполнен
+    """
+
+
+@dataclass
+class SchedulerConfig:
+    max_batch_size: int = 8
+    # Сколько первый запрос пакета ждёт попутчиков
+    max_wait_ms: float = 20.0
+    # Ограничение на размер пакета с учётом выравнивания: запросы * (самый длинный промпт + max_new_tokens)
+    max_batch_tokens: int = 16384
+    # Запросы сверх этого числа в очереди отклоняются
+    max_queue_size: int = 64
+
+    @classmethod
+    def from_env(cls) -> "SchedulerConfig":
+        return cls(
+            max_batch_size=int(os.getenv("LLM_BATCH_MAX_SIZE", "8")),
+            max_wait_ms=float(os.getenv("LLM_BATCH_MAX_WAIT_MS", "20")),
+            max_batch_tokens=int(os.getenv("LLM_BATCH_MAX_TOKENS", "16384")),
+            max_queue_size=int(os.getenv("LLM_QUEUE_MAX_SIZE", "64")),
+        )
+
+
+@dataclass
+class SchedulerMetrics:
+    submitted: int = 0
+    rejected: int = 0
+    completed: int = 0
+    failed: int = 0
+    cancelled: int = 0
+    batches: int = 0
+    batched_requests: int = 0
+    largest_batch: int = 0
+    peak_queue_depth: int = 0
+    queue_wait_seconds: float = 0.0
+    generate_seconds: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record_batch(self, size: int, waits: Sequence[float], seconds: float, failed: bool, cancelled: int = 0):
+        with self._lock:
+            self.batches += 1
+            self.batched_requests += size
+            self.largest_batch = max(self.largest_batch, size)
+            self.queue_wait_seconds += sum(waits)
+            self.generate_seconds += seconds
+            if failed:
+                self.failed += size
+            else:
+                # Остановленные во время генерации запросы не считаются выполненными
+                self.cancelled += cancelled
+                self.completed += size - cancelled
+
+    def snapshot(self, queue_depth: int) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queue_depth": queue_depth,
+                "peak_queue_depth": self.peak_queue_depth,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed,
+                "cancelled": self.cancelled,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_requests / self.batches if self.batches else 0.0,
+                "largest_batch": self.largest_batch,
+                "mean_queue_wait_ms": (
+                    self.queue_wait_seconds / self.batched_requests * 1000 if self.batched_requests else 0.0
+                ),
+                "mean_batch_generate_ms": self.generate_seconds / self.batches * 1000 if self.batches else 0.0,
+            }
+
+
+class _RequestFuture(Future):
+    """
+    Future запроса к модели: cancel() останавливает и запрос, уже выполняемый в пакете.
+    Такой запрос завершается на следующем шаге генерации с уже полученным текстом
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.stop = threading.Event()
+
+    def cancel(self) -> bool:
+        self.stop.set()
+        return super().cancel()
+
+
+@dataclass
+class _Request:
+    prompt: str
+    on_delta: Optional[Callable[[str], None]]
+    # Считается рабочим потоком: submit вызывается и из цикла событий
+    tokens: Optional[int] = None
+    future: _RequestFuture = field(default_factory=_RequestFuture)
+    enqueued_at: float = field(default_factory=time.monotonic)
+    # Маршрут запроса для метрик: рабочий поток не видит контекст вызывающего
+    route: str = field(default_factory=current_route)
+
+
+class BatchScheduler:
+    """
+    Очередь запросов к локальной модели: единственный рабочий поток собирает запросы
+    в пакеты (не дольше max_wait_ms и не больше max_batch_tokens), выполняет их одним
+    вызовом generate и возвращает результаты ожидающим вызовам через Future
+    """
+
+    def __init__(self, backend, config: Optional[SchedulerConfig] = None):
+        self.backend = backend
+        self.config = config or SchedulerConfig.from_env()
+        self.metrics = SchedulerMetrics()
+        self._pending: deque = deque()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._pending)
+
+    def submit(self, prompt: str, on_delta: Optional[Callable[[str], None]] = None) -> Future:
+        request = _Request(prompt, on_delta)
+        with self._condition:
+            if self._closed:
+                raise LLMSchedulerClosedError("Очередь запросов к модели закрыта")
+            if len(self._pending) >= self.config.max_queue_size:
+                with self.metrics._lock:
+                    self.metrics.rejected += 1
+                raise LLMOverloadedError(
+                    f"Очередь запросов к модели заполнена ({self.config.max_queue_size})"
+                )
+            self._pending.append(request)
+            with self.metrics._lock:
+                self.metrics.submitted += 1
+                self.metrics.peak_queue_depth = max(self.metrics.peak_queue_depth, len(self._pending))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="llm-scheduler", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return request.future
+
+    def close(self):
+        # Запросы, не попавшие в пакет, завершаются ошибкой, выполняемый пакет доделывается
+        with self._condition:
+            self._closed = True
+            pending = list(self._pending)
+            self._pending.clear()
+            self._condition.notify_all()
+        error = LLMSchedulerClosedError("Очередь запросов к модели закрыта")
+        for request in pending:
+            if request.future.set_running_or_notify_cancel():
+                request.future.set_exception(error)
+        with self.metrics._lock:
+            self.metrics.cancelled += len(pending)
+        if self._thread is not None:
+            self._thread.join()
+
+    def _count_tokens(self, request: _Request) -> int:
+        # Вызывается под self._condition: на время токенизации блокировка отпускается,
+        # чтобы submit не ждал токенизатор
+        if request.tokens is None:
+            self._condition.release()
+            try:
+                tokens = self.backend.count_tokens(request.prompt)
+            finally:
+                self._condition.acquire()
+            request.tokens = tokens
+        return request.tokens
+
+    def _next_batch(self) -> Optional[List[_Request]]:
+        max_new_tokens = self.backend.max_new_tokens
+        with self._condition:
+            while not self._pending and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return None
+
+            batch = [self._pending.popleft()]
+            longest = self._count_tokens(batch[0])
+            # Отсчёт от постановки в очередь: запросы, ждавшие предыдущий пакет, не задерживаются ещё раз
+            deadline = batch[0].enqueued_at + self.config.max_wait_ms / 1000
+            while len(batch) < self.config.max_batch_size:
+                if not self._pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or self._closed:
+                        break
+                    self._condition.wait(remaining)
+                    continue
+                if self._pending[0].tokens is None:
+                    # Пока блокировка была отпущена, очередь могла измениться: проверить заново
+                    self._count_tokens(self._pending[0])
+                    continue
+                candidate_longest = max(longest, self._pending[0].tokens)
+                if (len(batch) + 1) * (candidate_longest + max_new_tokens) > self.config.max_batch_tokens:
+                    break
+                batch.append(self._pending.popleft())
+                longest = candidate_longest
+
+        running = [request for request in batch if request.future.set_running_or_notify_cancel()]
+        if len(running) < len(batch):
+            with self.metrics._lock:
+                self.metrics.cancelled += len(batch) - len(running)
+        return running
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if not batch:
+                continue
+
+            started = time.monotonic()
+            waits = [started - request.enqueued_at for request in batch]
+            for request, wait in zip(batch, waits):
+                observe_queue_wait("llm", wait, route=request.route)
+            try:
+                texts = self.backend.generate(
+                    [request.prompt for request in batch],
+                    [request.on_delta for request in batch],
+                    [request.future.stop for request in batch],
+                )
+            except BaseException as e:
+                logger.error(f"Ошибка генерации пакета из {len(batch)} запросов: {e}")
+                self.metrics.record_batch(len(batch), waits, time.monotonic() - started, failed=True)
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+
+            stopped = sum(request.future.stop.is_set() for request in batch)
+            self.metrics.record_batch(len(batch), waits, time.monotonic() - started, failed=False, cancelled=stopped)
+            for request, text in zip(batch, texts):
+                request.future.set_result(text)
+
+
+class _BatchStreamer:
+    """
+    Стример для generate с пакетом: раздаёт новые токены каждой строки её обработчику
+    """
+
+    def __init__(self, tokenizer, callbacks: Sequence[Optional[Callable[[str], None]]], stop_ids: Sequence[int]):
+        self._tokenizer = tokenizer
+        self._callbacks = callbacks
+        self._stop_ids = set(stop_ids)
+        self._tokens: List[List[int]] = [[] for _ in callbacks]
+        self._texts = ["" for _ in callbacks]
+        self._finished = [callback is None for callback in callbacks]
+        self._prompt_skipped = False
+
+    def put(self, value):
+        # Первый вызов получает токены промпта
+        if not self._prompt_skipped:
+            self._prompt_skipped = True
+            return
+        for row, token in enumerate(value.reshape(-1).tolist()):
+            if self._finished[row]:
+                continue
+            if token in self._stop_ids:
+                self._finished[row] = True
+                continue
+            self._tokens[row].append(token)
+            text = self._tokenizer.decode(self._tokens[row], skip_special_tokens=True)
+            # Незавершённый многобайтовый символ дождётся следующего токена
+            if text.endswith("�"):
+                continue
+            delta = text[len(self._texts[row]):]
+            if delta:
+                self._texts[row] = text
+                self._callbacks[row](delta)
+
+    def end(self):
+        pass
+
+
+class _StoppedRows:
+    """
+    Критерий остановки generate: строки отменённых запросов считаются завершёнными,
+    пакет заканчивается, как только завершены все его строки
+    """
+
+    def __init__(self, stops: Sequence[threading.Event]):
+        self._stops = stops
+
+    def __call__(self, input_ids, scores, **kwargs):
+        import torch
+
+        return torch.tensor([stop.is_set() for stop in self._stops], dtype=torch.bool, device=input_ids.device)
+
+
+def _supports_prefix_cache(model) -> bool:
+    # Модель принимает DynamicCache в past_key_values (в разных версиях transformers признак называется по-разному)
+    supports = getattr(model, "_supports_default_dynamic_cache", None)
+    if callable(supports):
+        return bool(supports())
+    return bool(getattr(model, "_supports_cache_class", False))
+
+
+class HuggingFaceBatchBackend:
+    """
+    Пакетная генерация моделью и токенизатором из HuggingFaceLLM (промпты выравниваются слева).
+    С prefix_cache одиночный запрос берёт ключи и значения внимания общего начала промпта из кеша,
+    и модель обрабатывает только новую часть
+    """
+
+    def __init__(self, llm, prefix_cache: Optional[PrefixKVCache] = None):
+        self.prefix_cache = prefix_cache
+        self._model = llm._model
+        self._tokenizer = llm._tokenizer
+        self.max_new_tokens = llm.max_new_tokens
+        self._generate_kwargs = dict(llm.generate_kwargs)
+        self._outputs_to_remove = list(llm.tokenizer_outputs_to_remove)
+
+        self._tokenizer.padding_side = "left"
+        if self._tokenizer.pad_token is None:
+            self._tokenizer.pad_token = self._tokenizer.eos_token
+        # StopOnTokens из HuggingFaceLLM смотрит только на первую строку пакета,
+        # поэтому стоп-токены передаются через eos_token_id
+        self._stop_ids = list(llm.stopping_ids)
+        if self._tokenizer.eos_token_id is not None:
+            self._stop_ids.append(self._tokenizer.eos_token_id)
+
+        if self.prefix_cache is not None and not _supports_prefix_cache(self._model):
+            logger.warning("Модель не продолжает генерацию с переданного кеша внимания, кеш начал промптов отключён")
+            self.prefix_cache = None
+
+    def count_tokens(self, prompt: str) -> int:
+        return len(self._tokenizer(prompt)["input_ids"])
+
+    def _inputs(self, prompts: List[str]):
+        inputs = self._tokenizer(prompts, return_tensors="pt", padding=True)
+        inputs = inputs.to(self._model.device)
+        for key in self._outputs_to_remove:
+            inputs.pop(key, None)
+        return inputs
+
+    def _generate(
+            self,
+            inputs,
+            callbacks: List[Optional[Callable[[str], None]]],
+            stops: Optional[List[threading.Event]] = None,
+            **kwargs: Any,
+    ):
+        import torch
+        from transformers import StoppingCriteriaList
+
+        if stops:
+            kwargs["stopping_criteria"] = StoppingCriteriaList([_StoppedRows(stops)])
+        streamer = None
+        if any(callback is not None for callback in callbacks):
+            streamer = _BatchStreamer(self._tokenizer, callbacks, self._stop_ids)
+
+        with torch.inference_mode():
+            return self._model.generate(
+                **inputs,
+                max_new_tokens=self.max_new_tokens,
+                eos_token_id=self._stop_ids or None,
+                pad_token_id=self._tokenizer.pad_token_id,
+                streamer=streamer,
+                **self._generate_kwargs,
+                **kwargs,
+            )
+
+    def generate(
+            self,
+            prompts: List[str],
+            callbacks: List[Optional[Callable[[str], None]]],
+            stops: Optional[List[threading.Event]] = None,
+    ) -> List[str]:
+        # Выравнивание слева сдвигает общее начало промптов пакета, поэтому кеш начал — только для одиночных запросов
+        if self.prefix_cache is not None and len(prompts) == 1:
+            return [self._generate_with_prefix_cache(prompts[0], callbacks[0], stops)]
+
+        inputs = self._inputs(prompts)
+        tokens = self._generate(inputs, callbacks, stops)
+        prompt_length = inputs["input_ids"].shape[1]
+        return [
+            self._tokenizer.decode(row[prompt_length:], skip_special_tokens=True)
+            for row in tokens
+        ]
+
+    def _generate_with_prefix_cache(
+            self,
+            prompt: str,
+            callback: Optional[Callable[[str], None]],
+            stops: Optional[List[threading.Event]] = None,
+    ) -> str:
+        inputs = self._inputs([prompt])
+        token_ids = inputs["input_ids"][0].tolist()
+        past_key_values, reused = self.prefix_cache.lookup(token_ids)
+        output = self._generate(
+            inputs, [callback], stops, past_key_values=past_key_values, return_dict_in_generate=True,
+        )
+
+        self.prefix_cache.stats.record(len(token_ids), reused)
+        sequence = output.sequences[0]
+        # Сохраняется и ответ: следующая реплика разговора начинается с этого промпта и ответа
+        self.prefix_cache.store(sequence.tolist(), output.past_key_values)
+        return self._tokenizer.decode(sequence[len(token_ids):], skip_special_tokens=True)
+
+
+class BatchingLLM(CustomLLM):
+    """
+    LLM поверх BatchScheduler: одновременные запросы к локальной модели
+    выполняются общими пакетами, асинхронные методы не блокируют цикл событий
+    """
+
+    _llm: Any = PrivateAttr()
+    _scheduler: BatchScheduler = PrivateAttr()
+
+    def __init__(self, llm, scheduler: BatchScheduler, **kwargs: Any):
+        super().__init__(
+            system_prompt=llm.system_prompt,
+            messages_to_prompt=llm.messages_to_prompt,
+            callback_manager=llm.callback_manager,
+            **kwargs,
+        )
+        self._llm = llm
+        self._scheduler = scheduler
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "batching_llm"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return self._llm.metadata
+
+    @property
+    def scheduler(self) -> BatchScheduler:
+        return self._scheduler
+
+    def _full_prompt(self, prompt: str, formatted: bool) -> str:
+        # Та же подготовка промпта, что в HuggingFaceLLM.complete
+        if formatted:
+            return prompt
+        query_wrapper_prompt = getattr(self._llm, "query_wrapper_prompt", None)
+        if query_wrapper_prompt:
+            prompt = query_wrapper_prompt.format(query_str=prompt)
+        if self._llm.completion_to_prompt:
+            return self._llm.completion_to_prompt(prompt)
+        if self._llm.system_prompt:
+            return f"{self._llm.system_prompt} {prompt}"
+        return prompt
+
+    @llm_completion_callback()
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        future = self._scheduler.submit(self._full_prompt(prompt, formatted))
+        return CompletionResponse(text=future.result())
+
+    @llm_completion_callback()
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        deltas: queue.Queue = queue.Queue()
+        future = self._scheduler.submit(self._full_prompt(prompt, formatted), on_delta=deltas.put)
+        future.add_done_callback(lambda _: deltas.put(_DONE))
+
+        def gen() -> CompletionResponseGen:
+            text = ""
+            try:
+                while (delta := deltas.get()) is not _DONE:
+                    text += delta
+                    yield CompletionResponse(text=text, delta=delta)
+                future.result()
+            finally:
+                future.cancel()
+
+        return gen()
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        future = self._scheduler.submit(self._full_prompt(prompt, formatted))
+        return CompletionResponse(text=await asyncio.wrap_future(future))
+
+    @llm_completion_callback()
+    async def astream_complete(
+            self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        loop = asyncio.get_running_loop()
+        deltas: asyncio.Queue = asyncio.Queue()
+        future = self._scheduler.submit(
+            self._full_prompt(prompt, formatted),
+            on_delta=lambda delta: loop.call_soon_threadsafe(deltas.put_nowait, delta),
+        )
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(deltas.put_nowait, _DONE))
+
+        async def gen() -> CompletionResponseAsyncGen:
+            text = ""
+            try:
+                while (delta := await deltas.get()) is not _DONE:
+                    text += delta
+                    yield CompletionResponse(text=text, delta=delta)
+                future.result()
+            finally:
+                # Запрос, ещё не попавший в пакет, снимается с очереди
+                future.cancel()
+
+        return gen()
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        prompt = self.messages_to_prompt(messages)
+        completion_response = await self.acomplete(prompt, formatted=True, **kwargs)
+        return completion_response_to_chat_response(completion_response)
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        prompt = self.messages_to_prompt(messages)
+        completion_response_gen = await self.astream_complete(prompt, formatted=True, **kwargs)
+        return astream_completion_response_to_chat_response(completion_response_gen)
+
+
+def batching_enabled() -> bool:
+    return os.getenv("LLM_BATCHING", "True").lower() == "true"
@@ -1,5 +1,5 @@
 import logging
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterator, Optional, Tuple
 
 import yaml
 from llama_index.core import Document
@@ -7,6 +7,7 @@ from llama_index.core import Document
 from app.engine.loaders.db import DBLoaderConfig, get_db_documents
 from app.engine.loaders.file import FileLoaderConfig, get_file_documents
 from app.engine.loaders.web import WebLoaderConfig, get_web_documents
+from app.engine.manifest import SourceManifest
 
 logger = logging.getLogger(__name__)
 
@@ -17,24 +18,34 @@ def load_configs() -> Dict[str, Any]:
     return configs
 
 
-def get_documents() -> List[Document]:
-    documents = []
+def get_documents(manifest: Optional[SourceManifest] = None) -> Iterator[Document]:
+    for _, document in get_loader_documents(manifest):
+        yield document
+
+
+def get_loader_documents(manifest: Optional[SourceManifest] = None) -> Iterator[Tuple[str, Document]]:
+    # Документы отдаются по мере чтения вместе с типом загрузчика, весь корпус в памяти не собирается
     config = load_configs()
     for loader_type, loader_config in config.items():
         logger.info(
             f"Loading documents from loader: {loader_type}, config: {loader_config}"
         )
+        # private: true — документы загрузчика доступны только запросам с PRIVATE_ACCESS_TOKEN.
+        # У db это поле каждой базы в списке, см. DBLoaderConfig
+        private = isinstance(loader_config, dict) and bool(loader_config.pop("private", False))
         match loader_type:
             case "file":
-                document = get_file_documents(FileLoaderConfig(**loader_config))
+                documents = get_file_documents(FileLoaderConfig(**loader_config), manifest)
             case "web":
-                document = get_web_documents(WebLoaderConfig(**loader_config))
+                documents = get_web_documents(WebLoaderConfig(**loader_config), manifest)
             case "db":
-                document = get_db_documents(
-                    configs=[DBLoaderConfig(**cfg) for cfg in loader_config]
+                documents = get_db_documents(
+                    configs=[DBLoaderConfig(**cfg) for cfg in loader_config],
+                    manifest=manifest,
                 )
             case _:
                 raise ValueError(f"Invalid loader type: {loader_type}")
-        documents.extend(document)
-
-    return documents
+        for document in documents:
+            if private:
+                document.metadata["private"] = "true"
+            yield loader_type, document
@@ -0,0 +1,348 @@
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from urllib.parse import urldefrag, urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+
+from llama_index.core import Document
+
+from app.engine.manifest import SourceManifest
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class _PageParser(HTMLParser):
+    """
+    Текст страницы без script/style и ссылки из <a href>
+    """
+
+    _SKIP_TAGS = {"script", "style", "noscript", "template"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.links: List[str] = []
+        self._text: List[str] = []
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP_TAGS:
+            self._skip_depth += 1
+        elif tag == "a":
+            href = dict(attrs).get("href")
+            if href:
+                self.links.append(href)
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP_TAGS and self._skip_depth:
+            self._skip_depth -= 1
+
+    def handle_data(self, data):
+        if not self._skip_depth and data.strip():
+            self._text.append(data.strip())
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self._text)
+
+
+def parse_page(html: str) -> Tuple[str, List[str]]:
+    parser = _PageParser()
+    parser.feed(html)
+    parser.close()
+    return parser.text, parser.links
+
+
+@dataclass
+class CrawlStats:
+    fetched: int = 0
+    not_modified: int = 0
+    rendered: int = 0
+    failed: int = 0
+    started_at: float = field(default_factory=time.perf_counter)
+
+    def __str__(self) -> str:
+        elapsed = time.perf_counter() - self.started_at
+        pages = self.fetched + self.not_modified
+        rate = pages / elapsed if elapsed else 0.0
+        return (
+            f"страниц: {self.fetched} загружено, {self.not_modified} без изменений, "
+            f"{self.rendered} через браузер, {self.failed} ошибок, {rate:.1f} стр/с"
+        )
+
+
+class BrowserPool:
+    """
+    Небольшой пул переиспользуемых браузеров для страниц, которым нужен JavaScript
+    """
+
+    def __init__(self, size: int, driver_arguments: List[str]):
+        self.size = size
+        self.driver_arguments = driver_arguments
+        self._drivers: List = []
+        # Браузеры, созданные и создаваемые сейчас: место занимается до запуска браузера,
+        # иначе одновременные запросы запустили бы больше size браузеров
+        self._reserved = 0
+        self._available: Optional[asyncio.Queue] = None
+
+    def _create_driver(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.options import Options
+
+        options = Options()
+        for arg in self.driver_arguments:
+            options.add_argument(arg)
+        return webdriver.Chrome(options=options)
+
+    async def render(self, url: str) -> str:
+        if self._available is None:
+            self._available = asyncio.Queue()
+        if self._available.empty() and self._reserved < self.size:
+            self._reserved += 1
+            try:
+                driver = await asyncio.to_thread(self._create_driver)
+            except BaseException:
+                self._reserved -= 1
+                raise
+            self._drivers.append(driver)
+        else:
+            driver = await self._available.get()
+
+        try:
+            await asyncio.to_thread(driver.get, url)
+            return driver.page_source
+        finally:
+            self._available.put_nowait(driver)
+
+    def close(self):
+        for driver in self._drivers:
+            try:
+                driver.quit()
+            except Exception as e:
+                logger.warning(f"Не удалось закрыть браузер: {e}")
+        self._drivers.clear()
+        self._reserved = 0
+
+
+class Crawler:
+    """
+    Обход сайтов асинхронным HTTP-клиентом с общим пулом соединений.
+    Ограничивает число одновременных запросов к одному хосту, учитывает robots.txt,
+    глубину и префикс из CrawlUrl, повторные обходы выполняет условными GET.
+    """
+
+    def __init__(self, config, manifest: Optional[SourceManifest] = None):
+        self.config = config
+        self.manifest = manifest
+        self.stats = CrawlStats()
+        self.browsers = BrowserPool(config.browser_pool_size, config.driver_arguments or [])
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        self._robots: Dict[str, Optional[RobotFileParser]] = {}
+        self._robots_lock: Optional[asyncio.Lock] = None
+
+    def _host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.config.per_host_concurrency)
+        return self._host_limits[host]
+
+    async def _allowed(self, client, url: str) -> bool:
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        async with self._robots_lock:
+            if origin not in self._robots:
+                robots = None
+                try:
+                    response = await client.get(f"{origin}/robots.txt")
+                    if response.status_code == 200:
+                        robots = RobotFileParser()
+                        robots.parse(response.text.splitlines())
+                except Exception as e:
+                    logger.warning(f"Не удалось загрузить robots.txt для {origin}: {e}")
+                self._robots[origin] = robots
+        robots = self._robots[origin]
+        return robots is None or robots.can_fetch(self.config.user_agent, url)
+
+    async def _fetch(self, client, site, url: str) -> Optional[Tuple[Optional[str], List[str]]]:
+        """
+        Возвращает (текст или None, если страница не изменилась, ссылки)
+        или None, если по адресу не HTML-страница
+        """
+        headers = self.manifest.page_validators(url) if self.manifest is not None else {}
+        rendered = site.js_rendered or any(url.startswith(p) for p in site.js_rendered_prefixes)
+        async with self._host_limit(url):
+            # Страницу с JavaScript загружает браузер, HTTP-запрос только проверяет изменения и тип
+            response = await (client.head if rendered else client.get)(url, headers=headers)
+
+        if response.status_code == 304:
+            self.stats.not_modified += 1
+            return None, self.manifest.get_page(url).get("links", [])
+        # Сервер без HEAD: страница загружается браузером без условной проверки
+        head_unsupported = rendered and response.status_code in (405, 501)
+        if not head_unsupported:
+            response.raise_for_status()
+            if "html" not in response.headers.get("content-type", "html"):
+                return None
+
+        if rendered:
+            html = await self.browsers.render(url)
+            self.stats.rendered += 1
+        else:
+            html = response.text
+        self.stats.fetched += 1
+
+        text, hrefs = parse_page(html)
+        links = []
+        for href in hrefs:
+            link, _ = urldefrag(urljoin(url, href))
+            if link.startswith(site.prefix):
+                links.append(link)
+
+        if self.manifest is not None:
+            validators = {} if head_unsupported else response.headers
+            self.manifest.stage_page(
+                url,
+                site.prefix,
+                validators.get("etag"),
+                validators.get("last-modified"),
+                links,
+            )
+        return text, links
+
+    async def _crawl_site(self, client, site, emit):
+        import httpx
+
+        seen: Set[str] = {site.base_url}
+        # Страницы, загруженные или ответившие 304: остальные известные страницы сайта удаляются
+        visited: Set[str] = set()
+        incomplete = False
+        frontier: asyncio.Queue = asyncio.Queue()
+        frontier.put_nowait((site.base_url, 0))
+
+        async def worker():
+            nonlocal incomplete
+            while True:
+                url, depth = await frontier.get()
+                try:
+                    if site.respect_robots and not await self._allowed(client, url):
+                        continue
+                    page = await self._fetch(client, site, url)
+                    if page is None:
+                        continue
+                    visited.add(url)
+                    text, links = page
+                    if text is not None:
+                        await emit(Document(id_=url, text=text, metadata={"URL": url}))
+                    if depth < site.max_depth:
+                        for link in links:
+                            if link not in seen:
+                                seen.add(link)
+                                frontier.put_nowait((link, depth + 1))
+                except asyncio.CancelledError:
+                    raise
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code in (404, 410):
+                        logger.info(f"Страница удалена с сайта: {url}")
+                        continue
+                    incomplete = True
+                    self.stats.failed += 1
+                    logger.warning(f"Не удалось загрузить {url}: {e}")
+                except Exception as e:
+                    incomplete = True
+                    self.stats.failed += 1
+                    logger.warning(f"Не удалось загрузить {url}: {e}")
+                finally:
+                    frontier.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.config.per_host_concurrency)]
+        try:
+            await frontier.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        if self.manifest is None:
+            return
+        if incomplete:
+            # Недоступная страница не значит удалённую: её документы остаются до следующего обхода
+            logger.warning(f"Обход {site.base_url} завершён с ошибками, удаление страниц пропущено")
+            return
+        self.manifest.remove_unvisited_pages(site.prefix, visited)
+
+    async def crawl(self, emit):
+        import httpx
+
+        self._robots_lock = asyncio.Lock()
+        limits = httpx.Limits(
+            max_connections=self.config.concurrency,
+            max_keepalive_connections=self.config.concurrency,
+        )
+        async with httpx.AsyncClient(
+                limits=limits,
+                timeout=self.config.timeout,
+                follow_redirects=True,
+                headers={"User-Agent": self.config.user_agent},
+        ) as client:
+            try:
+                await asyncio.gather(*[
+                    self._crawl_site(client, site, emit) for site in self.config.urls
+                ])
+            finally:
+                await asyncio.to_thread(self.browsers.close)
+        logger.info(f"Обход завершён, {self.stats}")
+
+    def iter_documents(self, buffer_size: int = 64) -> Iterator[Document]:
+        """
+        Синхронный итератор документов: обход идёт в отдельном потоке со своим циклом событий,
+        ограниченный буфер приостанавливает его, пока документы не обработаны
+        """
+        loop = asyncio.new_event_loop()
+        documents: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+        error: List[BaseException] = []
+
+        finished = threading.Event()
+
+        async def run():
+            try:
+                await self.crawl(documents.put)
+            except asyncio.CancelledError:
+                raise
+            except BaseException as e:
+                error.append(e)
+            finally:
+                finished.set()
+            await documents.put(_DONE)
+
+        thread = threading.Thread(target=loop.run_forever, name="web-crawler", daemon=True)
+        thread.start()
+        crawl_future = asyncio.run_coroutine_threadsafe(run(), loop)
+        try:
+            while True:
+                document = asyncio.run_coroutine_threadsafe(documents.get(), loop).result()
+                if document is _DONE:
+                    break
+                if self.manifest is not None:
+                    yield from self.manifest.track(
+                        [document],
+                        self.manifest.commit_page(document.id_),
+                        source=("page", document.id_),
+                    )
+                else:
+                    yield document
+        finally:
+            # Потребитель мог остановиться раньше: обход отменяется, браузеры закрываются
+            if not crawl_future.done():
+                crawl_future.cancel()
+                finished.wait(timeout=self.config.timeout)
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+        if error:
+            raise error[0]
@@ -1,26 +1,204 @@
+import hashlib
 import logging
-from typing import List
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-from pydantic import BaseModel
+from llama_index.core import Document
+from pydantic import BaseModel, Field
+
+from app.engine.manifest import SourceManifest
 
 logger = logging.getLogger(__name__)
 
+_DONE = object()
+
+
+class DBQuery(BaseModel):
+    query: str
+    # Монотонно растущий столбец (id, updated_at) для инкрементальной выборки
+    watermark_column: Optional[str] = None
+    # Столбец с ключом строки, чтобы обновлённые строки заменяли старые документы
+    id_column: Optional[str] = None
+    # Столбцы, попадающие в текст документа (по умолчанию все, кроме metadata_columns)
+    text_columns: Optional[List[str]] = None
+    # Столбцы, копируемые в метаданные документа
+    metadata_columns: List[str] = Field(default_factory=list)
+
 
 class DBLoaderConfig(BaseModel):
     uri: str
-    queries: List[str]
+    queries: List[Union[str, DBQuery]]
+    # Строк в одной странице серверного курсора
+    page_size: int = Field(default=1000, ge=1)
+    # Соединений к этой базе, используемых одновременно
+    pool_size: int = Field(default=2, ge=1)
+    # Документы базы доступны только запросам с токеном PRIVATE_ACCESS_TOKEN
+    private: bool = False
+
+
+_engines: Dict[str, Any] = {}
+_engines_lock = threading.Lock()
+
+
+def _get_engine(config: DBLoaderConfig):
+    from sqlalchemy import create_engine
+
+    with _engines_lock:
+        if config.uri not in _engines:
+            _engines[config.uri] = create_engine(
+                config.uri,
+                pool_size=config.pool_size,
+                max_overflow=0,
+                pool_pre_ping=True,
+            )
+        return _engines[config.uri]
+
+
+def _source_key(uri: str, query: str) -> str:
+    return "db:" + hashlib.sha1(f"{uri}\n{query}".encode("utf-8")).hexdigest()[:16]
+
+
+def _row_document(key: str, db_query: DBQuery, row: Dict[str, Any]) -> Document:
+    if db_query.text_columns is not None:
+        text_columns = db_query.text_columns
+    else:
+        text_columns = [column for column in row.keys() if column not in db_query.metadata_columns]
+
+    doc_text = ", ".join(f"{column}: {row[column]}" for column in text_columns)
+    metadata = {column: row[column] for column in db_query.metadata_columns}
+
+    if db_query.id_column:
+        row_id = str(row[db_query.id_column])
+    else:
+        row_id = hashlib.sha1(doc_text.encode("utf-8")).hexdigest()
+    return Document(id_=f"{key}:{row_id}", text=doc_text, metadata=metadata)
+
+
+def _query_documents(
+        config: DBLoaderConfig,
+        db_query: DBQuery,
+        manifest: Optional[SourceManifest] = None,
+) -> Tuple[Iterator[Document], Optional[Callable[[], None]]]:
+    """
+    Строки запроса читаются серверным курсором страницами по page_size.
+    Возвращает документы и обновление водяного знака, которое применяется
+    после фиксации последнего из них (None без манифеста)
+    """
+    from sqlalchemy import text
+
+    key = _source_key(config.uri, db_query.query)
+    watermark = None
+
+    sql, params = db_query.query, {}
+    if db_query.watermark_column:
+        column = db_query.watermark_column
+        watermark = manifest.get_watermark(key) if manifest is not None else None
+        sql = f"SELECT * FROM ({db_query.query}) AS q"
+        if watermark is not None:
+            sql += f" WHERE {column} > :watermark"
+            params["watermark"] = watermark
+        sql += f" ORDER BY {column}"
+    elif manifest is not None:
+        # Без водяного знака запрос перечитывается целиком и заменяет прежние документы
+        manifest.mark_stale("query", key)
+
+    def rows() -> Iterator[Document]:
+        nonlocal watermark
+        with _get_engine(config).connect() as connection:
+            result = connection.execution_options(
+                stream_results=True,
+                yield_per=config.page_size,
+            ).execute(text(sql), params)
+            for page in result.mappings().partitions():
+                for row in page:
+                    if db_query.watermark_column:
+                        watermark = row[db_query.watermark_column]
+                    document = _row_document(key, db_query, row)
+                    if config.private:
+                        document.metadata["private"] = "true"
+                    yield document
+
+    if manifest is None:
+        return rows(), None
+
+    def save_watermark():
+        if db_query.watermark_column and watermark is not None:
+            manifest.set_watermark(key, watermark if isinstance(watermark, (int, float)) else str(watermark))
+
+    return rows(), save_watermark
+
 
+def get_db_documents(
+        configs: list[DBLoaderConfig],
+        manifest: Optional[SourceManifest] = None,
+) -> Iterator[Document]:
+    """
+    Запросы выполняются одновременно (не больше pool_size на одну базу),
+    документы передаются через ограниченную очередь страницами по page_size
+    """
+    tasks = [
+        (config, query if isinstance(query, DBQuery) else DBQuery(query=query))
+        for config in configs
+        for query in config.queries
+    ]
+    if not tasks:
+        return
 
-def get_db_documents(configs: list[DBLoaderConfig]):
-    from llama_index.readers.database import DatabaseReader
+    pages: queue.Queue = queue.Queue(maxsize=len(tasks) * 2)
+    stop = threading.Event()
+    limits = {config.uri: threading.Semaphore(config.pool_size) for config in configs}
 
-    docs = []
+    def produce(config: DBLoaderConfig, db_query: DBQuery):
+        with limits[config.uri]:
+            logger.info(f"Загрузка данных из базы данных с помощью запроса: {db_query.query}")
+            page: List[Document] = []
+            last_id = None
+            done = _DONE
+            try:
+                documents, apply = _query_documents(config, db_query, manifest)
+                for document in documents:
+                    if stop.is_set():
+                        return
+                    page.append(document)
+                    last_id = document.id_
+                    if len(page) >= config.page_size:
+                        pages.put(page)
+                        page = []
+                if page:
+                    pages.put(page)
+                if apply is not None:
+                    # Водяной знак передаётся потребителю вместе с признаком конца запроса
+                    done = (_DONE, last_id, apply)
+            finally:
+                pages.put(done)
 
-    for entry in configs:
-        loader = DatabaseReader(uri=entry.uri)
-        for query in entry.queries:
-            logger.info(f"Загрузка данных из базы данных с помощью запроса: {query}")
-            documents = loader.load_data(query=query)
-            docs.extend(documents)
+    with ThreadPoolExecutor(max_workers=sum(config.pool_size for config in configs)) as executor:
+        futures = [executor.submit(produce, config, db_query) for config, db_query in tasks]
+        try:
+            remaining = len(futures)
+            while remaining:
+                page = pages.get()
+                if page is _DONE:
+                    remaining -= 1
+                    continue
+                if isinstance(page, tuple):
+                    # Все страницы запроса уже отданы: обновление откладывается до фиксации последней строки
+                    # или применяется сразу в потоке потребителя, если строк не было
+                    _, last_id, apply = page
+                    manifest.defer(last_id, apply)
+                    remaining -= 1
+                    continue
+                yield from page
+        finally:
+            stop.set()
+            # Освободить производителей, ожидающих места в очереди
+            while any(not future.done() for future in futures):
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
 
-    return documents
+        for future in futures:
+            future.result()
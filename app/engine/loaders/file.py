@@ -1,8 +1,13 @@
 import logging
 import os
+from functools import partial
+from typing import Iterator, Optional
 
+from llama_index.core import Document
 from pydantic import BaseModel, validator
 
+from app.engine.manifest import SourceManifest
+
 logger = logging.getLogger(__name__)
 
 
@@ -17,9 +22,43 @@ class FileLoaderConfig(BaseModel):
         return v
 
 
-def get_file_documents(config: FileLoaderConfig):
+def _list_files(path: str) -> Iterator[str]:
+    # Скрытые файлы и каталоги пропускаются так же, как в SimpleDirectoryReader
+    if os.path.isfile(path):
+        yield path
+        return
+    for root, dirs, files in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        for name in sorted(files):
+            if not name.startswith("."):
+                yield os.path.join(root, name)
+
+
+def get_file_documents(
+        config: FileLoaderConfig,
+        manifest: Optional[SourceManifest] = None,
+) -> Iterator[Document]:
     from llama_index.core.readers import SimpleDirectoryReader
 
+    if manifest is not None and os.path.exists(config.path):
+        changed = manifest.changed_files(config.path, _list_files(config.path))
+        if not changed:
+            logger.info(f"Файлы в {config.path} не изменились")
+        else:
+            logger.info(f"Новых или изменённых файлов: {len(changed)}")
+        for path, entry in changed:
+            reader = SimpleDirectoryReader(
+                input_files=[os.path.abspath(path)],
+                filename_as_id=True,
+                raise_on_error=True,
+            )
+            yield from manifest.track(
+                reader.load_data(),
+                partial(manifest.set_file, path, entry),
+                source=("file", os.path.abspath(path)),
+            )
+        return
+
     try:
         file_extractor = None
         reader = SimpleDirectoryReader(
@@ -29,7 +68,6 @@ def get_file_documents(config: FileLoaderConfig):
             raise_on_error=True,
             file_extractor=file_extractor,
         )
-        return reader.load_data()
     except Exception as e:
         import sys
         import traceback
@@ -39,6 +77,10 @@ def get_file_documents(config: FileLoaderConfig):
             logger.warning(
                 f"Не удалось загрузить файловые документы, сообщение об ошибке: {e}. Вернуть в виде пустого списка документов."
             )
-            return []
+            return
         else:
             raise e
+
+    # Документы читаются по одному файлу, а не всем каталогом сразу
+    for documents in reader.iter_data():
+        yield from documents
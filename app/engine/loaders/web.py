@@ -1,20 +1,79 @@
-from typing import List, Optional
+import logging
+import urllib.error
+import urllib.request
+from functools import partial
+from typing import Iterator, List, Literal, Optional, Tuple
 
+from llama_index.core import Document
 from pydantic import BaseModel, Field
 
+from app.engine.manifest import SourceManifest
+
+logger = logging.getLogger(__name__)
+
 
 class CrawlUrl(BaseModel):
     base_url: str
     prefix: str
     max_depth: int = Field(default=1, ge=0)
+    respect_robots: bool = True
+    # Страницы, которые нужно отрисовать в браузере: весь сайт или адреса с этими префиксами
+    js_rendered: bool = False
+    js_rendered_prefixes: List[str] = Field(default_factory=list)
 
 
 class WebLoaderConfig(BaseModel):
     driver_arguments: Optional[List[str]] = Field(default_factory=list)
     urls: List[CrawlUrl]
+    # crawler — асинхронный HTTP-обходчик, selenium — прежний обход браузером каждой страницы
+    engine: Literal["crawler", "selenium"] = "crawler"
+    concurrency: int = Field(default=32, ge=1)
+    per_host_concurrency: int = Field(default=4, ge=1)
+    browser_pool_size: int = Field(default=2, ge=1)
+    timeout: float = 30.0
+    user_agent: str = "Server-with-AI crawler"
+
+
+def _check_site(url: CrawlUrl, manifest: SourceManifest) -> Tuple[bool, Optional[str], Optional[str]]:
+    # Условный HEAD к стартовой странице: 304 означает, что сайт не менялся
+    request = urllib.request.Request(
+        url.base_url,
+        method="HEAD",
+        headers=manifest.url_validators(url.base_url),
+    )
+    etag, last_modified = None, None
+    try:
+        with urllib.request.urlopen(request, timeout=30) as response:
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False, None, None
+    except urllib.error.URLError as e:
+        logger.warning(f"Не удалось проверить {url.base_url}: {e}")
+
+    return True, etag, last_modified
+
 
+def get_web_documents(
+        config: WebLoaderConfig,
+        manifest: Optional[SourceManifest] = None,
+) -> Iterator[Document]:
+    if config.engine == "crawler":
+        from app.engine.loaders.crawler import Crawler
 
-def get_web_documents(config: WebLoaderConfig):
+        if manifest is not None:
+            manifest.remove_pages_outside(url.prefix for url in config.urls)
+        yield from Crawler(config, manifest).iter_documents()
+        return
+
+    yield from _get_selenium_documents(config, manifest)
+
+
+def _get_selenium_documents(
+        config: WebLoaderConfig,
+        manifest: Optional[SourceManifest] = None,
+) -> Iterator[Document]:
     from llama_index.readers.web import WholeSiteReader
     from selenium import webdriver
     from selenium.webdriver.chrome.options import Options
@@ -24,13 +83,32 @@ def get_web_documents(config: WebLoaderConfig):
     for arg in driver_arguments:
         options.add_argument(arg)
 
-    docs = []
+    if manifest is not None:
+        manifest.remove_urls_outside(url.base_url for url in config.urls)
+
     for url in config.urls:
-        scraper = WholeSiteReader(
-            prefix=url.prefix,
-            max_depth=url.max_depth,
-            driver=webdriver.Chrome(options=options),
-        )
-        docs.extend(scraper.load_data(url.base_url))
-
-    return docs
+        if manifest is not None:
+            modified, etag, last_modified = _check_site(url, manifest)
+            if not modified:
+                logger.info(f"Сайт не изменился: {url.base_url}")
+                continue
+            manifest.mark_stale("url", url.prefix)
+
+        driver = webdriver.Chrome(options=options)
+        try:
+            scraper = WholeSiteReader(
+                prefix=url.prefix,
+                max_depth=url.max_depth,
+                driver=driver,
+            )
+            documents = scraper.load_data(url.base_url)
+        finally:
+            driver.quit()
+
+        if manifest is not None:
+            documents = manifest.track(
+                documents,
+                partial(manifest.update_url, url.base_url, url.prefix, etag, last_modified),
+                source=("url", url.prefix),
+            )
+        yield from documents
@@ -0,0 +1,303 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from llama_index.core import Document
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+
+
+def file_content_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SourceManifest:
+    """
+    Отпечатки источников данных с прошлой генерации индекса:
+    mtime/размер/хеш содержимого для файлов, ETag/Last-Modified для сайтов,
+    значение водяного знака для запросов к БД.
+    Хранится рядом с STORAGE_DIR. Отпечаток источника применяется только после фиксации
+    его последнего документа, поэтому прерванная генерация повторит лишь незавершённые источники.
+    Обходчик сайтов и запросы к БД обращаются к манифесту из своих потоков, поэтому
+    состояние читается и изменяется под блокировкой.
+    """
+
+    def __init__(self, path: str, data: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.path = path
+        data = data or {}
+        self.files: Dict[str, Dict[str, Any]] = data.get("files", {})
+        self.urls: Dict[str, Dict[str, Any]] = data.get("urls", {})
+        self.queries: Dict[str, Dict[str, Any]] = data.get("queries", {})
+        self.pages: Dict[str, Dict[str, Any]] = data.get("pages", {})
+        self._staged_pages: Dict[str, Dict[str, Any]] = {}
+        # id документов каждого источника ("file:<путь>", "url:<префикс>", "page:<url>")
+        self.documents: Dict[str, List[str]] = data.get("documents", {})
+        # Манифест прошлых версий не знает документов источников, см. index_documents
+        self.indexed = not data or "documents" in data
+        # id документов, которые нужно удалить из хранилищ перед загрузкой,
+        # и запросы к БД, строки которых заменяются целиком
+        self.stale_ids: List[str] = []
+        self.stale_queries: List[str] = []
+        # Обновления отпечатков, ожидающие фиксации документа с данным id
+        self._deferred: Dict[str, List[Callable[[], None]]] = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, storage_dir: str) -> "SourceManifest":
+        path = os.path.join(storage_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return cls(path)
+        with open(path, encoding="utf-8") as f:
+            return cls(path, json.load(f))
+
+    def save(self):
+        with self._lock:
+            payload = json.dumps(
+                {
+                    "files": self.files,
+                    "urls": self.urls,
+                    "queries": self.queries,
+                    "pages": self.pages,
+                    "documents": self.documents,
+                },
+                ensure_ascii=False,
+            )
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(payload)
+        os.replace(tmp_path, self.path)
+
+    def mark_stale(self, kind: str, key: str):
+        with self._lock:
+            if kind == "query":
+                # Строк запроса слишком много для манифеста, их id начинаются с ключа запроса
+                self.stale_queries.append(key)
+                return
+            self.stale_ids.extend(self.documents.pop(f"{kind}:{key}", []))
+
+    def take_stale(self) -> Tuple[List[str], List[str]]:
+        with self._lock:
+            stale_ids, self.stale_ids = self.stale_ids, []
+            stale_queries, self.stale_queries = self.stale_queries, []
+        return stale_ids, stale_queries
+
+    def index_documents(self, documents: Iterable[Tuple[str, Dict[str, Any]]]):
+        """
+        Однократно заполняет id документов источников по (id, метаданным) документов хранилища,
+        когда манифест записан прошлой версией
+        """
+        prefixes = {entry["prefix"] for entry in self.urls.values()}
+        for doc_id, metadata in documents:
+            file_path = metadata.get("file_path")
+            url = metadata.get("URL", doc_id)
+            if file_path:
+                source = f"file:{os.path.abspath(file_path)}"
+            elif url in self.pages:
+                source = f"page:{url}"
+            else:
+                prefix = next((prefix for prefix in prefixes if is_under_prefix(url, prefix)), None)
+                if prefix is None:
+                    continue
+                source = f"url:{prefix}"
+            self._add_document(source, doc_id)
+        self.indexed = True
+
+    def _add_document(self, source: str, doc_id: str):
+        with self._lock:
+            doc_ids = self.documents.setdefault(source, [])
+            if doc_id not in doc_ids:
+                doc_ids.append(doc_id)
+
+    def track(
+            self,
+            documents: Iterable[Document],
+            apply: Callable[[], None],
+            source: Optional[Tuple[str, str]] = None,
+    ) -> Iterator[Document]:
+        """
+        Пропускает документы источника, откладывая apply до фиксации последнего из них.
+        id документов запоминаются за источником source = (вид, ключ), см. mark_stale
+        """
+        last = None
+        for document in documents:
+            if source is not None:
+                self._add_document(f"{source[0]}:{source[1]}", document.id_)
+            if last is not None:
+                yield last
+            last = document
+        if last is None:
+            apply()
+            return
+        self.defer(last.id_, apply)
+        yield last
+
+    def defer(self, doc_id: Optional[str], apply: Callable[[], None]):
+        """
+        Откладывает apply до фиксации документа doc_id, источник без документов применяется сразу
+        """
+        if doc_id is None:
+            apply()
+            return
+        with self._lock:
+            self._deferred.setdefault(doc_id, []).append(apply)
+
+    def commit(self, doc_ids: Iterable[str]):
+        for doc_id in doc_ids:
+            with self._lock:
+                applies = self._deferred.pop(doc_id, [])
+            for apply in applies:
+                apply()
+
+    # Файлы
+
+    def changed_files(self, root: str, paths: Iterable[str]) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Возвращает новые и изменённые файлы с их новыми отпечатками,
+        удалённые файлы под root помечаются устаревшими.
+        Хеш содержимого считается только при изменении mtime или размера.
+        """
+        changed = []
+        seen = set()
+        for path in paths:
+            key = os.path.abspath(path)
+            seen.add(key)
+            stat = os.stat(path)
+            with self._lock:
+                entry = self.files.get(key)
+            if entry and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                continue
+
+            new_entry = {
+                "mtime": stat.st_mtime_ns,
+                "size": stat.st_size,
+                "hash": file_content_hash(path),
+            }
+            if entry and entry["hash"] == new_entry["hash"]:
+                self.set_file(key, new_entry)
+                continue
+
+            changed.append((path, new_entry))
+            if entry:
+                self.mark_stale("file", key)
+
+        root_key = os.path.join(os.path.abspath(root), "")
+        with self._lock:
+            for key in list(self.files):
+                if key.startswith(root_key) and key not in seen:
+                    logger.info(f"Файл удалён из источника: {key}")
+                    self.mark_stale("file", key)
+                    del self.files[key]
+
+        return changed
+
+    # Сайты
+
+    def url_validators(self, url: str) -> Dict[str, str]:
+        with self._lock:
+            entry = dict(self.urls.get(url, {}))
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def set_file(self, path: str, entry: Dict[str, Any]):
+        with self._lock:
+            self.files[os.path.abspath(path)] = entry
+
+    def update_url(self, url: str, prefix: str, etag: Optional[str], last_modified: Optional[str]):
+        with self._lock:
+            self.urls[url] = {"prefix": prefix, "etag": etag, "last_modified": last_modified}
+
+    def remove_urls_outside(self, base_urls: Iterable[str]):
+        base_urls = set(base_urls)
+        with self._lock:
+            for base_url, entry in list(self.urls.items()):
+                if base_url not in base_urls:
+                    logger.info(f"Сайт удалён из конфигурации: {base_url}")
+                    self.mark_stale("url", entry["prefix"])
+                    del self.urls[base_url]
+
+    # Страницы, загруженные обходчиком
+
+    def page_validators(self, url: str) -> Dict[str, str]:
+        entry = self.get_page(url)
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get_page(self, url: str) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.pages.get(url, {}))
+
+    def stage_page(
+            self,
+            url: str,
+            prefix: str,
+            etag: Optional[str],
+            last_modified: Optional[str],
+            links: List[str],
+    ):
+        # Ссылки сохраняются, чтобы продолжать обход через страницы, ответившие 304
+        with self._lock:
+            self._staged_pages[url] = {
+                "prefix": prefix,
+                "etag": etag,
+                "last_modified": last_modified,
+                "links": links,
+            }
+
+    def commit_page(self, url: str) -> Callable[[], None]:
+        def apply():
+            with self._lock:
+                entry = self._staged_pages.pop(url, None)
+                if entry is not None:
+                    self.pages[url] = entry
+
+        return apply
+
+    def remove_unvisited_pages(self, prefix: str, visited: Iterable[str]):
+        visited = set(visited)
+        with self._lock:
+            for url, entry in list(self.pages.items()):
+                if entry["prefix"] == prefix and url not in visited:
+                    logger.info(f"Страница больше не найдена: {url}")
+                    self.mark_stale("page", url)
+                    del self.pages[url]
+
+    def remove_pages_outside(self, prefixes: Iterable[str]):
+        prefixes = set(prefixes)
+        with self._lock:
+            for url, entry in list(self.pages.items()):
+                if entry["prefix"] not in prefixes:
+                    logger.info(f"Сайт удалён из конфигурации: {url}")
+                    self.mark_stale("page", url)
+                    del self.pages[url]
+
+    # Запросы к БД
+
+    def get_watermark(self, key: str) -> Any:
+        with self._lock:
+            return self.queries.get(key, {}).get("watermark")
+
+    def set_watermark(self, key: str, watermark: Any):
+        with self._lock:
+            self.queries[key] = {"watermark": watermark}
+
+def is_under_prefix(url: str, prefix: str) -> bool:
+    # Сравнение по границе сегмента пути: /docs не включает /docs-old
+    return url == prefix or url.startswith(prefix.rstrip("/") + "/")
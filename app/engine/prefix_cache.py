@@ -0,0 +1,183 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+@dataclass
+class PrefixCacheStats:
+    requests: int = 0
+    hits: int = 0
+    prompt_tokens: int = 0
+    # Токены промпта, взятые из кеша вместо повторной обработки моделью
+    reused_tokens: int = 0
+    evictions: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, prompt_tokens: int, reused_tokens: int):
+        with self._lock:
+            self.requests += 1
+            self.hits += reused_tokens > 0
+            self.prompt_tokens += prompt_tokens
+            self.reused_tokens += reused_tokens
+
+    def snapshot(self, entries: int, size_bytes: int) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hits": self.hits,
+                "prompt_tokens": self.prompt_tokens,
+                "reused_tokens": self.reused_tokens,
+                "reused_ratio": self.reused_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+                "entries": entries,
+                "size_mb": size_bytes / 1024 / 1024,
+                "evictions": self.evictions,
+            }
+
+
+def _kv_layers(cache) -> Iterator[Tuple[Any, Any]]:
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        # transformers >= 4.56: тензоры хранятся в слоях кеша
+        for layer in layers:
+            yield getattr(layer, "keys", None), getattr(layer, "values", None)
+    else:
+        yield from zip(cache.key_cache, cache.value_cache)
+
+
+def _kv_tensors(cache) -> Iterator[Any]:
+    for keys, values in _kv_layers(cache):
+        yield keys
+        yield values
+
+
+def _prefix_copy(cache, length: int):
+    """
+    Новый кеш того же класса с копиями первых length позиций каждого слоя
+    (тензоры [пакет, головы, позиции, размерность]): копируется только нужное начало
+    """
+    prefix = type(cache)()
+    for layer_idx, (keys, values) in enumerate(_kv_layers(cache)):
+        if keys is None:
+            break
+        prefix.update(keys[..., :length, :].clone(), values[..., :length, :].clone(), layer_idx)
+    return prefix
+
+
+def kv_cache_nbytes(cache) -> int:
+    return sum(tensor.nbytes for tensor in _kv_tensors(cache) if tensor is not None)
+
+
+@dataclass
+class _Entry:
+    cache: Any
+    # Хеши блоков последовательности: по ним запись находится и для промптов с общим началом
+    hashes: List[bytes]
+    nbytes: int
+
+
+class PrefixKVCache:
+    """
+    Кеш ключей и значений внимания (past_key_values) для общих начал промптов: системный промпт
+    с описанием инструментов и история разговора. Последовательность токенов делится на блоки
+    по block_tokens, хеш блока включает хеш предыдущего, поэтому совпадение хеша означает совпадение
+    всего начала. Промпт находит самую длинную сохранённую последовательность с тем же началом,
+    и модель обрабатывает только оставшиеся токены. Записи вытесняются по давности использования
+    при превышении max_bytes (память устройства модели).
+    Используется только из потока планировщика
+    """
+
+    def __init__(self, max_bytes: int, block_tokens: int = 64):
+        self.max_bytes = max_bytes
+        self.block_tokens = block_tokens
+        self._entries: "OrderedDict[bytes, _Entry]" = OrderedDict()
+        # Хеш блока → записи, в которых этот блок есть (в порядке добавления)
+        self._index: Dict[bytes, Dict[bytes, None]] = {}
+        self._size = 0
+        self.stats = PrefixCacheStats()
+
+    @classmethod
+    def from_env(cls) -> Optional["PrefixKVCache"]:
+        if not prefix_cache_enabled():
+            return None
+        return cls(
+            max_bytes=int(float(os.getenv("PREFIX_CACHE_MAX_MB", "1024")) * 1024 * 1024),
+            block_tokens=int(os.getenv("PREFIX_CACHE_BLOCK_TOKENS", "64")),
+        )
+
+    def _block_hashes(self, token_ids: Sequence[int]) -> List[bytes]:
+        hashes = []
+        digest = b""
+        for start in range(0, len(token_ids) - self.block_tokens + 1, self.block_tokens):
+            block = np.asarray(token_ids[start:start + self.block_tokens], dtype=np.int64).tobytes()
+            digest = hashlib.sha1(digest + block).digest()
+            hashes.append(digest)
+        return hashes
+
+    def lookup(self, token_ids: Sequence[int]) -> Tuple[Optional[Any], int]:
+        """
+        Копия кеша для самого длинного сохранённого начала промпта и его длина в токенах.
+        Хотя бы один токен промпта остаётся модели: по нему считается первый токен ответа
+        """
+        hashes = self._block_hashes(token_ids[:len(token_ids) - 1])
+        for blocks in range(len(hashes), 0, -1):
+            holders = self._index.get(hashes[blocks - 1])
+            if not holders:
+                continue
+            entry_key = next(reversed(holders))
+            self._entries.move_to_end(entry_key)
+            length = blocks * self.block_tokens
+            # generate дописывает в переданный кеш, сохранённая запись не должна меняться
+            return _prefix_copy(self._entries[entry_key].cache, length), length
+        return None, 0
+
+    def store(self, token_ids: Sequence[int], cache):
+        """
+        Сохранить кеш последовательности (промпт и сгенерированный ответ) целыми блоками.
+        cache после generate больше не используется и обрезается на месте
+        """
+        if cache is None or not hasattr(cache, "crop"):
+            # Кеш в виде кортежей тензоров (старые версии transformers) не обрезается
+            return
+        length = min(cache.get_seq_length(), len(token_ids)) // self.block_tokens * self.block_tokens
+        if not length:
+            return
+        hashes = self._block_hashes(token_ids[:length])
+        if hashes[-1] in self._index:
+            # Эта последовательность уже есть целиком в другой записи
+            self._entries.move_to_end(next(reversed(self._index[hashes[-1]])))
+            return
+        cache.crop(length)
+        nbytes = kv_cache_nbytes(cache)
+        if nbytes > self.max_bytes:
+            return
+        key = hashes[-1]
+        self._entries[key] = _Entry(cache, hashes, nbytes)
+        self._size += nbytes
+        for digest in hashes:
+            self._index.setdefault(digest, {})[key] = None
+        while self._size > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        key, entry = self._entries.popitem(last=False)
+        self._size -= entry.nbytes
+        for digest in entry.hashes:
+            # Общие блоки остаются доступны через другие записи, в которых они есть
+            holders = self._index[digest]
+            del holders[key]
+            if not holders:
+                del self._index[digest]
+        with self.stats._lock:
+            self.stats.evictions += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return self.stats.snapshot(entries=len(self._entries), size_bytes=self._size)
+
+
+def prefix_cache_enabled() -> bool:
+    return os.getenv("PREFIX_CACHE_ENABLED", "False").lower() == "true"
@@ -0,0 +1,172 @@
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.tools import BaseTool
+
+from app.engine.filters import build_filters
+from app.engine.index import IndexConfig, get_index
+from app.engine.keyword_index import KeywordIndex, load_keyword_index
+from app.engine.reranker import rerank_settings
+from app.engine.tools import ToolFactory
+from app.engine.tools.query_engine import get_query_engine_tool
+from app.engine.vectordb import list_collections
+
+logger = logging.getLogger("uvicorn")
+
+
+class EngineRegistry:
+    """
+    Общие для всех запросов компоненты движка: индекс, индекс ключевых слов, инструмент запроса к индексу
+    и инструменты из config/tools.yaml. Создаются один раз за время жизни приложения,
+    пересоздаются через reload().
+    Индекс и инструмент запроса по части коллекций создаются при первом обращении и тоже переиспользуются.
+    Общие инструменты запроса ищут только среди открытых документов (private = "false").
+    Инструмент запроса собирается для маршрута (agent или chat) с его настройками переранжирования.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._index: Optional[VectorStoreIndex] = None
+        self._keyword_index: Optional[KeywordIndex] = None
+        self._query_engine_tool: Optional[BaseTool] = None
+        self._configured_tools: List[BaseTool] = []
+        self._collections: List[str] = []
+        self._indexes: Dict[Tuple[str, ...], VectorStoreIndex] = {}
+        self._query_tools: Dict[Tuple[Optional[Tuple[str, ...]], bool, str], BaseTool] = {}
+
+    def load(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._build()
+
+    def reload(self):
+        with self._lock:
+            logger.info("Перезагрузка индекса и инструментов…")
+            self._build()
+
+    def _build(self):
+        collections = list_collections()
+        index = get_index(IndexConfig())
+        keyword_index = load_keyword_index()
+        query_engine_tool = (
+            get_query_engine_tool(index, keyword_index, rerank=rerank_settings("agent"), filters=build_filters())
+            if index is not None else None
+        )
+        configured_tools: List[BaseTool] = ToolFactory.from_env()
+
+        self._index = index
+        self._keyword_index = keyword_index
+        self._query_engine_tool = query_engine_tool
+        self._configured_tools = configured_tools
+        self._collections = collections
+        self._indexes = {}
+        self._query_tools = {}
+        self._loaded = True
+
+        logger.info(
+            f"Движок загружен, коллекций: {len(collections)}, инструментов: "
+            f"{len(configured_tools) + (query_engine_tool is not None)}"
+        )
+
+
+    @property
+    def index(self) -> Optional[VectorStoreIndex]:
+        self.load()
+        return self._index
+
+    @property
+    def collections(self) -> List[str]:
+        self.load()
+        return list(self._collections)
+
+    def scoped(self, collections: Optional[Sequence[str]] = None) -> bool:
+        # Выбрана часть коллекций: общий индекс ключевых слов находит и узлы вне неё
+        self.load()
+        return collections is not None and set(collections) != set(self._collections)
+
+    def get_index(self, collections: Optional[Sequence[str]] = None) -> Optional[VectorStoreIndex]:
+        # Без выбора коллекций — общий индекс по всем
+        self.load()
+        if collections is None:
+            return self._index
+        key = tuple(sorted(set(collections)))
+        index = self._indexes.get(key)
+        if index is None:
+            with self._lock:
+                index = self._indexes.get(key)
+                if index is None:
+                    index = self._indexes[key] = get_index(IndexConfig(collections=list(key)))
+        return index
+
+    def get_query_engine_tool(
+            self,
+            collections: Optional[Sequence[str]] = None,
+            filters: Optional[Dict[str, Any]] = None,
+            include_private: bool = False,
+            route: str = "agent",
+    ) -> Optional[BaseTool]:
+        """
+        Инструмент запроса к индексу по выбранным коллекциям с фильтрами метаданных из запроса.
+        Инструменты без фильтров переиспользуются, с фильтрами — создаются на запрос
+        """
+        index = self.get_index(collections)
+        if index is None:
+            return None
+        scoped_store = self.scoped(collections)
+        if filters:
+            return get_query_engine_tool(
+                index,
+                self._keyword_index,
+                rerank=rerank_settings(route),
+                filters=build_filters(filters, include_private),
+                scoped_store=scoped_store,
+            )
+        if collections is None and not include_private and route == "agent":
+            return self._query_engine_tool
+
+        key = (tuple(sorted(set(collections))) if collections is not None else None, include_private, route)
+        tool = self._query_tools.get(key)
+        if tool is None:
+            with self._lock:
+                tool = self._query_tools.get(key)
+                if tool is None:
+                    tool = self._query_tools[key] = get_query_engine_tool(
+                        index,
+                        self._keyword_index,
+                        rerank=rerank_settings(route),
+                        filters=build_filters(include_private=include_private),
+                        scoped_store=scoped_store,
+                    )
+        return tool
+
+    @property
+    def keyword_index(self) -> Optional[KeywordIndex]:
+        self.load()
+        return self._keyword_index
+
+    @property
+    def query_engine_tool(self) -> Optional[BaseTool]:
+        self.load()
+        return self._query_engine_tool
+
+    @property
+    def configured_tools(self) -> List[BaseTool]:
+        self.load()
+        return list(self._configured_tools)
+
+    def get_tools(self) -> List[BaseTool]:
+        self.load()
+        tools: List[BaseTool] = []
+        if self._query_engine_tool is not None:
+            tools.append(self._query_engine_tool)
+        tools.extend(self._configured_tools)
+        return tools
+
+
+engine_registry = EngineRegistry()
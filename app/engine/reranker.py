@@ -0,0 +1,297 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field, fields, replace
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence
+
+import yaml
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from app.engine.retriever import record_retrieval_timings
+from app.engine.tracing import RERANK_FALLBACKS, current_route
+
+logger = logging.getLogger("uvicorn")
+
+RERANK_CONFIG_PATH = "config/rerank.yaml"
+
+
+@dataclass(frozen=True)
+class RerankSettings:
+    """
+    Переранжирование на маршруте: сколько кандидатов взять из поиска, сколько лучших передать в синтез
+    и сколько миллисекунд можно ждать кросс-энкодер, прежде чем вернуть порядок поиска
+    """
+
+    candidates: int = 30
+    top_n: int = 4
+    budget_ms: float = 250
+
+    @classmethod
+    def from_env(cls, **overrides: Any) -> "RerankSettings":
+        unknown = set(overrides) - {f.name for f in fields(cls)}
+        if unknown:
+            raise ValueError(f"Неизвестные параметры переранжирования в {RERANK_CONFIG_PATH}: {', '.join(sorted(unknown))}")
+        settings = cls(
+            candidates=int(os.getenv("RERANK_CANDIDATES", "30")),
+            top_n=int(os.getenv("RERANK_TOP_N", "4")),
+            budget_ms=float(os.getenv("RERANK_BUDGET_MS", "250")),
+        )
+        return replace(settings, **overrides)
+
+
+@lru_cache(maxsize=1)
+def load_rerank_routes() -> Dict[str, Dict[str, Any]]:
+    if not os.path.exists(RERANK_CONFIG_PATH):
+        return {}
+    with open(RERANK_CONFIG_PATH) as f:
+        configs = yaml.safe_load(f) or {}
+    return {route: config or {} for route, config in configs.items()}
+
+
+def rerank_settings(route: str) -> Optional[RerankSettings]:
+    # Маршруты без записи в config/rerank.yaml работают без переранжирования
+    if os.getenv("RERANK_ENABLED", "False").lower() != "true":
+        return None
+    config = load_rerank_routes().get(route)
+    if config is None:
+        return None
+    return RerankSettings.from_env(**config)
+
+
+@dataclass
+class RerankStats:
+    cache_hits: int = 0
+    scored: int = 0
+    reranked: int = 0
+    fallbacks: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, cache_hits: int = 0, scored: int = 0, reranked: int = 0, fallbacks: int = 0):
+        with self._lock:
+            self.cache_hits += cache_hits
+            self.scored += scored
+            self.reranked += reranked
+            self.fallbacks += fallbacks
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.cache_hits + self.scored
+            return {
+                "cache_hits": self.cache_hits,
+                "scored": self.scored,
+                "cache_hit_rate": self.cache_hits / total if total else 0.0,
+                "reranked": self.reranked,
+                "fallbacks": self.fallbacks,
+            }
+
+
+class CrossEncoderReranker:
+    """
+    Кросс-энкодер, общий для процесса. Пары (запрос, фрагмент) оцениваются пакетами в отдельном потоке,
+    оценки кешируются в LRU по модели, запросу и тексту фрагмента.
+    Модель загружается при первом обращении
+    """
+
+    def __init__(
+            self,
+            model_name: str,
+            batch_size: int = 16,
+            max_length: int = 512,
+            device: Optional[str] = None,
+            cache_size: int = 20000,
+            workers: int = 1,
+    ):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.device = device
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._cache: "OrderedDict[bytes, float]" = OrderedDict()
+        self._cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        # Запросы сверх числа потоков ждут в очереди, а ожидание входит в бюджет
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rerank")
+        self.stats = RerankStats()
+
+    @classmethod
+    def from_env(cls) -> "CrossEncoderReranker":
+        return cls(
+            model_name=os.getenv("RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"),
+            batch_size=int(os.getenv("RERANK_BATCH_SIZE", "16")),
+            max_length=int(os.getenv("RERANK_MAX_LENGTH", "512")),
+            device=os.getenv("RERANK_DEVICE") or None,
+            cache_size=int(os.getenv("RERANK_CACHE_SIZE", "20000")),
+            workers=int(os.getenv("RERANK_WORKERS", "1")),
+        )
+
+    def load(self):
+        if self._model is not None:
+            return self._model
+        with self._model_lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+
+                logger.info(f"Загрузка модели переранжирования {self.model_name}")
+                self._model = CrossEncoder(self.model_name, max_length=self.max_length, device=self.device)
+        return self._model
+
+    def _key(self, query: str, text: str) -> bytes:
+        return hashlib.sha1(f"{self.model_name}\n{query}\n{text}".encode("utf-8")).digest()
+
+    def cached_scores(self, query: str, texts: Sequence[str]) -> List[Optional[float]]:
+        keys = [self._key(query, text) for text in texts]
+        with self._cache_lock:
+            scores = []
+            for key in keys:
+                score = self._cache.get(key)
+                if score is not None:
+                    self._cache.move_to_end(key)
+                scores.append(score)
+        return scores
+
+    def _remember(self, items: Sequence[tuple]):
+        with self._cache_lock:
+            for key, score in items:
+                self._cache[key] = score
+                self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _score(self, query: str, texts: Sequence[str], deadline: float) -> Optional[List[float]]:
+        scores = self.cached_scores(query, texts)
+        missing = [i for i, score in enumerate(scores) if score is None]
+        self.stats.add(cache_hits=len(texts) - len(missing), scored=len(missing))
+        model = self.load()
+        for start in range(0, len(missing), self.batch_size):
+            # Ответ уже отдан в порядке поиска: оставшиеся пакеты не считаются
+            if time.monotonic() > deadline:
+                return None
+            batch = missing[start:start + self.batch_size]
+            predicted = model.predict(
+                [(query, texts[i]) for i in batch],
+                batch_size=self.batch_size,
+                show_progress_bar=False,
+            )
+            items = []
+            for i, score in zip(batch, predicted):
+                scores[i] = float(score)
+                items.append((self._key(query, texts[i]), scores[i]))
+            self._remember(items)
+        return scores
+
+    def submit(self, query: str, texts: Sequence[str], deadline: float) -> concurrent.futures.Future:
+        return self._executor.submit(self._score, query, list(texts), deadline)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_reranker: Optional[CrossEncoderReranker] = None
+_reranker_lock = threading.Lock()
+
+
+def get_reranker() -> CrossEncoderReranker:
+    global _reranker
+    if _reranker is None:
+        with _reranker_lock:
+            if _reranker is None:
+                _reranker = CrossEncoderReranker.from_env()
+    return _reranker
+
+
+def close_reranker():
+    if _reranker is not None:
+        _reranker.close()
+
+
+class RerankingRetriever(BaseRetriever):
+    """
+    Широкий набор кандидатов из поиска переупорядочивается кросс-энкодером, в синтез уходят лучшие top_n.
+    Не уложившись в бюджет (или при ошибке модели), возвращает первые top_n в порядке поиска
+    """
+
+    def __init__(self, retriever: BaseRetriever, reranker: CrossEncoderReranker, settings: RerankSettings):
+        self._retriever = retriever
+        self._reranker = reranker
+        self._settings = settings
+        super().__init__(callback_manager=retriever.callback_manager)
+
+    @staticmethod
+    def _texts(nodes: List[NodeWithScore]) -> List[str]:
+        return [node.node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+
+    def _ranked(self, nodes: List[NodeWithScore], scores: Optional[List[float]]) -> List[NodeWithScore]:
+        if scores is None:
+            return self._fallback(nodes, "budget")
+        self._reranker.stats.add(reranked=1)
+        order = sorted(range(len(nodes)), key=lambda i: scores[i], reverse=True)[:self._settings.top_n]
+        return [NodeWithScore(node=nodes[i].node, score=scores[i]) for i in order]
+
+    def _fallback(self, nodes: List[NodeWithScore], reason: str) -> List[NodeWithScore]:
+        if reason == "budget":
+            logger.warning(f"Переранжирование не уложилось в {self._settings.budget_ms:.0f} мс, порядок поиска")
+        self._reranker.stats.add(fallbacks=1)
+        RERANK_FALLBACKS.labels(current_route(), reason).inc()
+        return nodes[:self._settings.top_n]
+
+    def _cached(self, query: str, nodes: List[NodeWithScore], texts: List[str]) -> Optional[List[NodeWithScore]]:
+        # Все пары уже оценены: поток и модель не нужны
+        scores = self._reranker.cached_scores(query, texts)
+        if any(score is None for score in scores):
+            return None
+        self._reranker.stats.add(cache_hits=len(scores))
+        return self._ranked(nodes, scores)
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = self._retriever.retrieve(query_bundle)
+        if len(nodes) <= 1:
+            return nodes
+
+        start = time.perf_counter()
+        query, texts = query_bundle.query_str, self._texts(nodes)
+        budget = self._settings.budget_ms / 1000
+        result = self._cached(query, nodes, texts)
+        if result is None:
+            future = self._reranker.submit(query, texts, time.monotonic() + budget)
+            try:
+                result = self._ranked(nodes, future.result(timeout=budget))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                result = self._fallback(nodes, "budget")
+            except Exception as e:
+                logger.warning(f"Ошибка переранжирования, порядок поиска: {e}")
+                result = self._fallback(nodes, "error")
+
+        record_retrieval_timings("Переранжирование", {"rerank": time.perf_counter() - start})
+        return result
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        nodes = await self._retriever.aretrieve(query_bundle)
+        if len(nodes) <= 1:
+            return nodes
+
+        start = time.perf_counter()
+        query, texts = query_bundle.query_str, self._texts(nodes)
+        budget = self._settings.budget_ms / 1000
+        result = self._cached(query, nodes, texts)
+        if result is None:
+            # Модель работает в своём потоке, цикл событий не блокируется
+            future = self._reranker.submit(query, texts, time.monotonic() + budget)
+            try:
+                result = self._ranked(nodes, await asyncio.wait_for(asyncio.wrap_future(future), budget))
+            except asyncio.TimeoutError:
+                result = self._fallback(nodes, "budget")
+            except Exception as e:
+                logger.warning(f"Ошибка переранжирования, порядок поиска: {e}")
+                result = self._fallback(nodes, "error")
+
+        record_retrieval_timings("Переранжирование", {"rerank": time.perf_counter() - start})
+        return result
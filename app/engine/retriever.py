@@ -0,0 +1,191 @@
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from llama_index.core import VectorStoreIndex
+from llama_index.core.base.base_retriever import BaseRetriever
+from llama_index.core.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.core.schema import BaseNode, NodeWithScore, QueryBundle
+from llama_index.core.vector_stores.types import MetadataFilters
+
+from app.engine.keyword_index import KeywordIndex
+from app.engine.tracing import observe_retrieval_stages
+
+logger = logging.getLogger("uvicorn")
+
+# Словарь, в который гибридный поиск записывает длительность стадий (мс) текущего запроса
+_retrieval_timings: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "retrieval_timings", default=None,
+)
+
+
+@contextmanager
+def track_retrieval_timings() -> Iterator[Dict[str, float]]:
+    timings: Dict[str, float] = {}
+    token = _retrieval_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _retrieval_timings.reset(token)
+
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={ms:.1f}" for stage, ms in timings.items())
+
+
+def record_retrieval_timings(title: str, timings: Dict[str, float]):
+    # Длительности стадий (с) — в метрики, журнал и заголовок Server-Timing текущего запроса
+    observe_retrieval_stages(timings)
+    timings = {stage: seconds * 1000 for stage, seconds in timings.items()}
+    logger.info(f"{title}: " + ", ".join(f"{stage} {ms:.1f} мс" for stage, ms in timings.items()))
+    target = _retrieval_timings.get()
+    if target is not None:
+        target.update(timings)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Векторный поиск и BM25 по индексу ключевых слов, объединённые
+    методом reciprocal rank fusion: оценка узла — сумма 1 / (rrf_k + ранг) по обоим спискам.
+    Фильтры метаданных применяются в векторном хранилище: к векторному поиску и к кандидатам BM25.
+    Индекс ключевых слов общий для всех коллекций, поэтому при поиске по части коллекций
+    (scoped_store) кандидаты BM25 тоже проверяются по хранилищу
+    """
+
+    def __init__(
+            self,
+            index: VectorStoreIndex,
+            keyword_index: KeywordIndex,
+            similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K,
+            candidates_top_k: int = 20,
+            rrf_k: int = 60,
+            filters: Optional[MetadataFilters] = None,
+            scoped_store: bool = False,
+            **kwargs,
+    ):
+        self._vector_store = index.vector_store
+        self._filters = filters
+        self._scoped_store = scoped_store
+        self._vector_retriever = index.as_retriever(
+            similarity_top_k=max(candidates_top_k, similarity_top_k),
+            filters=filters,
+            **kwargs,
+        )
+        self._keyword_index = keyword_index
+        self._similarity_top_k = similarity_top_k
+        self._candidates_top_k = max(candidates_top_k, similarity_top_k)
+        self._rrf_k = rrf_k
+        super().__init__(callback_manager=index._callback_manager)
+
+    @classmethod
+    def from_env(cls, index: VectorStoreIndex, keyword_index: KeywordIndex, **kwargs) -> "HybridRetriever":
+        return cls(
+            index,
+            keyword_index,
+            candidates_top_k=int(os.getenv("HYBRID_CANDIDATES_TOP_K", "20")),
+            rrf_k=int(os.getenv("HYBRID_RRF_K", "60")),
+            **kwargs,
+        )
+
+    def _keyword_search(self, query: str) -> Tuple[List[Tuple[str, float]], float]:
+        start = time.perf_counter()
+        hits = self._keyword_index.search(query, self._candidates_top_k)
+        return hits, time.perf_counter() - start
+
+    def _fuse(
+            self,
+            vector_nodes: List[NodeWithScore],
+            keyword_hits: List[Tuple[str, float]],
+    ) -> Tuple[List[str], Dict[str, float]]:
+        scores: Dict[str, float] = {}
+        for rank, node in enumerate(vector_nodes):
+            scores[node.node.node_id] = scores.get(node.node.node_id, 0.0) + 1.0 / (self._rrf_k + rank + 1)
+        for rank, (node_id, _) in enumerate(keyword_hits):
+            scores[node_id] = scores.get(node_id, 0.0) + 1.0 / (self._rrf_k + rank + 1)
+        ranked = sorted(scores, key=scores.get, reverse=True)[:self._similarity_top_k]
+        return ranked, scores
+
+    def _filter_keyword_hits(
+            self,
+            keyword_hits: List[Tuple[str, float]],
+            vector_nodes: List[NodeWithScore],
+    ) -> Tuple[List[Tuple[str, float]], Dict[str, BaseNode]]:
+        """
+        С фильтрами или выбранными коллекциями кандидаты BM25, не найденные векторным поиском,
+        загружаются из хранилища с тем же условием where: не найденные в нём в объединение не попадают
+        и не занимают места в top-k
+        """
+        if self._filters is None and not self._scoped_store:
+            return keyword_hits, {}
+        known = {node.node.node_id for node in vector_nodes}
+        missing = [node_id for node_id, _ in keyword_hits if node_id not in known]
+        fetched: Dict[str, BaseNode] = {}
+        if missing:
+            fetched = {node.node_id: node for node in self._vector_store.get_nodes(node_ids=missing, filters=self._filters)}
+        return [hit for hit in keyword_hits if hit[0] in known or hit[0] in fetched], fetched
+
+    def _hydrate(
+            self,
+            ranked: List[str],
+            scores: Dict[str, float],
+            vector_nodes: List[NodeWithScore],
+            fetched: Optional[Dict[str, BaseNode]] = None,
+    ):
+        # Узлы, найденные только по ключевым словам, загружаются из векторного хранилища
+        known = {node.node.node_id: node.node for node in vector_nodes}
+        known.update(fetched or {})
+        missing = [node_id for node_id in ranked if node_id not in known]
+        if missing:
+            for node in self._vector_store.get_nodes(node_ids=missing):
+                known[node.node_id] = node
+        return [
+            NodeWithScore(node=known[node_id], score=scores[node_id])
+            for node_id in ranked
+            if node_id in known
+        ]
+
+    def _retrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        timings: Dict[str, float] = {}
+
+        start = time.perf_counter()
+        vector_nodes = self._vector_retriever.retrieve(query_bundle)
+        timings["vector"] = time.perf_counter() - start
+
+        keyword_hits, timings["bm25"] = self._keyword_search(query_bundle.query_str)
+
+        start = time.perf_counter()
+        keyword_hits, fetched = self._filter_keyword_hits(keyword_hits, vector_nodes)
+        ranked, scores = self._fuse(vector_nodes, keyword_hits)
+        nodes = self._hydrate(ranked, scores, vector_nodes, fetched)
+        timings["fusion"] = time.perf_counter() - start
+
+        record_retrieval_timings("Гибридный поиск", timings)
+        return nodes
+
+    async def _aretrieve(self, query_bundle: QueryBundle) -> List[NodeWithScore]:
+        timings: Dict[str, float] = {}
+
+        async def vector_search():
+            start = time.perf_counter()
+            nodes = await self._vector_retriever.aretrieve(query_bundle)
+            timings["vector"] = time.perf_counter() - start
+            return nodes
+
+        # Стадии выполняются одновременно: BM25 в пуле потоков, пока идёт векторный поиск
+        vector_nodes, (keyword_hits, timings["bm25"]) = await asyncio.gather(
+            vector_search(),
+            asyncio.to_thread(self._keyword_search, query_bundle.query_str),
+        )
+
+        start = time.perf_counter()
+        keyword_hits, fetched = await asyncio.to_thread(self._filter_keyword_hits, keyword_hits, vector_nodes)
+        ranked, scores = self._fuse(vector_nodes, keyword_hits)
+        nodes = await asyncio.to_thread(self._hydrate, ranked, scores, vector_nodes, fetched)
+        timings["fusion"] = time.perf_counter() - start
+
+        record_retrieval_timings("Гибридный поиск", timings)
+        return nodes
@@ -6,11 +6,15 @@ import yaml
 from llama_index.core.tools.function_tool import FunctionTool
 from llama_index.core.tools.tool_spec.base import BaseToolSpec
 
+from app.engine.tools.execution import ToolExecutionConfig, make_async_tool
+
 
 class ToolFactory:
     @staticmethod
     def load_tools(tool_name: str, config: dict) -> List[FunctionTool]:
         source_package = "app.engine.tools"
+        config = dict(config or {})
+        execution_config = ToolExecutionConfig.from_config(config)
         try:
             if "ToolSpec" in tool_name:
                 tool_package, tool_cls_name = tool_name.split(".")
@@ -18,7 +22,7 @@ class ToolFactory:
                 module = importlib.import_module(module_name)
                 tool_class = getattr(module, tool_cls_name)
                 tool_spec: BaseToolSpec = tool_class(**config)
-                return tool_spec.to_tool_list()
+                tools = tool_spec.to_tool_list()
             else:
                 module = importlib.import_module(f"{source_package}.{tool_name}")
                 tools = module.get_tools(**config)
@@ -26,7 +30,8 @@ class ToolFactory:
                     raise ValueError(
                         f"Модуль {module} не содержит действительных инструментов"
                     )
-                return tools
+            # Блокирующие сетевые вызовы выполняются вне цикла событий
+            return [make_async_tool(tool, execution_config) for tool in tools]
         except ImportError as e:
             raise ValueError(f"Не удалось импортировать инструмент {tool_name}: {e}")
         except AttributeError as e:
@@ -0,0 +1,211 @@
+import asyncio
+import contextvars
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from llama_index.core.tools.function_tool import FunctionTool
+
+from app.engine.tracing import observe_queue_wait
+
+logger = logging.getLogger("uvicorn")
+
+# Ключи config/tools.yaml, задающие выполнение инструментов, а не их параметры
+EXECUTION_KEYS = ("timeout", "max_concurrency", "cache_ttl", "cache_size")
+
+
+@dataclass
+class ToolExecutionConfig:
+    timeout: float = 30.0
+    max_concurrency: int = 4
+    # 0 — результаты не кешируются
+    cache_ttl: float = 300.0
+    cache_size: int = 256
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> "ToolExecutionConfig":
+        """
+        Забирает из config ключи EXECUTION_KEYS, недостающие берутся из окружения
+        """
+        defaults = cls(
+            timeout=float(os.getenv("TOOLS_TIMEOUT", "30")),
+            max_concurrency=int(os.getenv("TOOLS_MAX_CONCURRENCY", "4")),
+            cache_ttl=float(os.getenv("TOOLS_CACHE_TTL", "300")),
+            cache_size=int(os.getenv("TOOLS_CACHE_SIZE", "256")),
+        )
+        return cls(**{
+            key: config.pop(key) if key in config else getattr(defaults, key)
+            for key in EXECUTION_KEYS
+        })
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def get_tool_executor() -> ThreadPoolExecutor:
+    # Общий ограниченный пул для блокирующих тел всех инструментов
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("TOOLS_THREAD_POOL_SIZE", "8")),
+                thread_name_prefix="tool",
+            )
+        return _executor
+
+
+class _TTLCache:
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        return " ".join(value.split())
+    return value
+
+
+class ToolRunner:
+    """
+    Выполнение синхронного тела инструмента: в общем пуле потоков,
+    не больше max_concurrency вызовов одновременно, с таймаутом и кешем
+    результатов по (инструмент, нормализованные аргументы).
+    Вызов, превысивший таймаут, занимает место до фактического завершения потока,
+    поэтому зависший инструмент не может занять весь пул
+    """
+
+    def __init__(self, name: str, fn, config: ToolExecutionConfig):
+        self.name = name
+        self.fn = fn
+        self.config = config
+        self._signature = inspect.signature(fn)
+        self._cache = _TTLCache(config.cache_ttl, config.cache_size) if config.cache_ttl > 0 else None
+        self._thread_limit = threading.BoundedSemaphore(config.max_concurrency)
+        # Семафор asyncio привязан к циклу событий, поэтому свой для каждого цикла
+        self._loop_limits: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def _cache_key(self, args, kwargs) -> str:
+        bound = self._signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = {key: _normalize(value) for key, value in bound.arguments.items()}
+        return json.dumps(arguments, sort_keys=True, ensure_ascii=False, default=str)
+
+    def _cached(self, args, kwargs) -> Tuple[Optional[str], bool, Any]:
+        if self._cache is None:
+            return None, False, None
+        key = self._cache_key(args, kwargs)
+        found, value = self._cache.get(key)
+        return key, found, value
+
+    def _timeout_error(self) -> TimeoutError:
+        return TimeoutError(f"Инструмент {self.name} не ответил за {self.config.timeout:g} с")
+
+    def call(self, *args, **kwargs):
+        key, found, value = self._cached(args, kwargs)
+        if found:
+            return value
+        waiting_since = time.perf_counter()
+        self._thread_limit.acquire()
+        observe_queue_wait(f"tool:{self.name}", time.perf_counter() - waiting_since)
+        # Трасса запроса доступна и в потоке инструмента
+        context = contextvars.copy_context()
+        try:
+            future = get_tool_executor().submit(context.run, self.fn, *args, **kwargs)
+        except BaseException:
+            self._thread_limit.release()
+            raise
+        future.add_done_callback(lambda _: self._thread_limit.release())
+        try:
+            value = future.result(timeout=self.config.timeout)
+        except FutureTimeoutError:
+            raise self._timeout_error()
+        if key is not None:
+            self._cache.put(key, value)
+        return value
+
+    async def acall(self, *args, **kwargs):
+        key, found, value = self._cached(args, kwargs)
+        if found:
+            return value
+
+        loop = asyncio.get_running_loop()
+        limit = self._loop_limits.get(loop)
+        if limit is None:
+            limit = self._loop_limits[loop] = asyncio.Semaphore(self.config.max_concurrency)
+
+        waiting_since = time.perf_counter()
+        await limit.acquire()
+        observe_queue_wait(f"tool:{self.name}", time.perf_counter() - waiting_since)
+        context = contextvars.copy_context()
+        try:
+            future = get_tool_executor().submit(context.run, self.fn, *args, **kwargs)
+        except BaseException:
+            limit.release()
+            raise
+        future.add_done_callback(lambda _: _release_in_loop(loop, limit))
+        try:
+            value = await asyncio.wait_for(asyncio.wrap_future(future), self.config.timeout)
+        except asyncio.TimeoutError:
+            # Поток дорабатывает в фоне, агент получает ошибку сразу
+            logger.warning(f"Инструмент {self.name} превысил таймаут {self.config.timeout:g} с")
+            raise self._timeout_error()
+        if key is not None:
+            self._cache.put(key, value)
+        return value
+
+
+def _release_in_loop(loop: asyncio.AbstractEventLoop, limit: asyncio.Semaphore):
+    # Поток инструмента завершается вне цикла событий, семафор освобождается в его потоке
+    try:
+        loop.call_soon_threadsafe(limit.release)
+    except RuntimeError:
+        # Цикл уже закрыт вместе со своим семафором
+        pass
+
+
+def make_async_tool(tool: FunctionTool, config: ToolExecutionConfig) -> FunctionTool:
+    """
+    Тот же инструмент (имя, описание, схема аргументов), но асинхронный вызов
+    не блокирует цикл событий
+    """
+    runner = ToolRunner(tool.metadata.name, tool.fn, config)
+    return FunctionTool(
+        fn=runner.call,
+        metadata=tool.metadata,
+        async_fn=runner.acall,
+        partial_params=tool.partial_params,
+    )
@@ -1,13 +1,46 @@
+from typing import Optional
+
 from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.settings import Settings
 from llama_index.core.tools.query_engine import QueryEngineTool
 
+from app.engine.keyword_index import KeywordIndex
+from app.engine.reranker import RerankSettings, RerankingRetriever, get_reranker
+from app.engine.retriever import HybridRetriever
+
+
+def create_query_engine(
+        index,
+        keyword_index: Optional[KeywordIndex] = None,
+        rerank: Optional[RerankSettings] = None,
+        **kwargs,
+) -> BaseQueryEngine:
+    # Индекс охватывает не все коллекции корпуса
+    scoped_store = kwargs.pop("scoped_store", False)
+    if keyword_index is None and rerank is None:
+        return index.as_query_engine(**kwargs)
+
+    retriever_kwargs = {}
+    for key in ("similarity_top_k", "filters"):
+        if key in kwargs:
+            retriever_kwargs[key] = kwargs.pop(key)
+    if rerank is not None:
+        # Поиск отдаёт широкий набор кандидатов, в синтез попадают только лучшие после кросс-энкодера
+        retriever_kwargs["similarity_top_k"] = max(rerank.candidates, retriever_kwargs.get("similarity_top_k", 0))
 
-def create_query_engine(index, **kwargs) -> BaseQueryEngine:
-    return index.as_query_engine(**kwargs)
+    if keyword_index is None:
+        retriever = index.as_retriever(**retriever_kwargs)
+    else:
+        retriever = HybridRetriever.from_env(index, keyword_index, scoped_store=scoped_store, **retriever_kwargs)
+    if rerank is not None:
+        retriever = RerankingRetriever(retriever, get_reranker(), rerank)
+    return RetrieverQueryEngine.from_args(retriever, llm=Settings.llm, **kwargs)
 
 
 def get_query_engine_tool(
         index,
+        keyword_index: Optional[KeywordIndex] = None,
         **kwargs,
 ) -> QueryEngineTool:
     name = "query_index"
@@ -16,7 +49,7 @@ def get_query_engine_tool(
         "Используйте этот инструмент для извлечения текстовой информации о законах и юридических вопросах из индекса."
     )
 
-    query_engine = create_query_engine(index, **kwargs)
+    query_engine = create_query_engine(index, keyword_index, **kwargs)
 
     return QueryEngineTool.from_defaults(
         query_engine=query_engine,
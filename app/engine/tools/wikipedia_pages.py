@@ -0,0 +1,229 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from llama_index.core.settings import Settings
+
+_SECTION_RE = re.compile(r"^(={2,})\s*(.+?)\s*\1\s*$", re.MULTILINE)
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def _api(lang: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    # MediaWiki API напрямую: язык задаётся адресом, а не глобальным состоянием,
+    # поэтому запросы на разных языках безопасно выполнять параллельно
+    import httpx
+
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(
+                timeout=float(os.getenv("WIKIPEDIA_TIMEOUT", "10")),
+                headers={"User-Agent": os.getenv("WIKIPEDIA_USER_AGENT", "Server-with-AI")},
+            )
+    response = _client.get(
+        f"https://{lang}.wikipedia.org/w/api.php",
+        params={**params, "format": "json", "formatversion": 2},
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+@dataclass
+class WikipediaPage:
+    title: str
+    revision: int
+    # (заголовок раздела, текст); у вступления заголовок пустой
+    sections: List[List[str]]
+    checked_at: float
+
+
+def split_sections(text: str) -> List[List[str]]:
+    sections = []
+    position, heading = 0, ""
+    for match in _SECTION_RE.finditer(text):
+        body = text[position:match.start()].strip()
+        if body:
+            sections.append([heading, body])
+        heading, position = match.group(2), match.end()
+    body = text[position:].strip()
+    if body:
+        sections.append([heading, body])
+    return sections
+
+
+class WikipediaPageCache:
+    """
+    Страницы в STORAGE_CACHE_DIR/wikipedia по (язык, название) вместе с номером ревизии.
+    В пределах ttl страница берётся без обращения к сети, затем сверяется только номер
+    ревизии и текст загружается заново лишь при его изменении.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.path = path
+        self.ttl = ttl
+
+    @classmethod
+    def from_env(cls) -> "WikipediaPageCache":
+        return cls(
+            os.path.join(os.getenv("STORAGE_CACHE_DIR", ".cache"), "wikipedia"),
+            ttl=float(os.getenv("WIKIPEDIA_CACHE_TTL", "86400")),
+        )
+
+    def _file(self, lang: str, title: str) -> str:
+        digest = hashlib.sha1(title.strip().encode("utf-8")).hexdigest()
+        return os.path.join(self.path, lang, f"{digest}.json")
+
+    def get(self, lang: str, title: str) -> Optional[WikipediaPage]:
+        path = self._file(lang, title)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding="utf-8") as f:
+            return WikipediaPage(**json.load(f))
+
+    def put(self, lang: str, title: str, page: WikipediaPage):
+        path = self._file(lang, title)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(page.__dict__, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+_cache: Optional[WikipediaPageCache] = None
+
+
+def _get_cache() -> WikipediaPageCache:
+    global _cache
+    if _cache is None:
+        _cache = WikipediaPageCache.from_env()
+    return _cache
+
+
+def _query_page(lang: str, title: str, with_text: bool) -> Optional[Dict[str, Any]]:
+    params = {
+        "action": "query",
+        "prop": "extracts|revisions" if with_text else "revisions",
+        "rvprop": "ids",
+        "titles": title,
+        "redirects": 1,
+    }
+    if with_text:
+        params["explaintext"] = 1
+    pages = _api(lang, params).get("query", {}).get("pages", [])
+    if not pages or pages[0].get("missing") or pages[0].get("invalid"):
+        return None
+    return pages[0]
+
+
+def get_page(lang: str, title: str) -> Optional[WikipediaPage]:
+    cache = _get_cache()
+    now = time.time()
+
+    cached = cache.get(lang, title)
+    if cached is not None and now - cached.checked_at < cache.ttl:
+        return cached
+
+    if cached is not None:
+        current = _query_page(lang, title, with_text=False)
+        if current is None:
+            return None
+        if current["revisions"][0]["revid"] == cached.revision:
+            cached.checked_at = now
+            cache.put(lang, title, cached)
+            return cached
+
+    data = _query_page(lang, title, with_text=True)
+    if data is None:
+        return None
+    page = WikipediaPage(
+        title=data["title"],
+        revision=data["revisions"][0]["revid"],
+        sections=split_sections(data.get("extract", "")),
+        checked_at=now,
+    )
+    cache.put(lang, title, page)
+    return page
+
+
+def search_titles(lang: str, query: str, limit: int = 1) -> List[str]:
+    data = _api(lang, {"action": "query", "list": "search", "srsearch": query, "srlimit": limit})
+    return [result["title"] for result in data.get("query", {}).get("search", [])]
+
+
+def _passages(page: WikipediaPage, passage_tokens: int) -> List[List[str]]:
+    """
+    Абзацы разделов, объединённые во фрагменты не длиннее passage_tokens.
+    Более длинный абзац делится по предложениям, а слишком длинное предложение — по словам
+    """
+    from llama_index.core.node_parser import SentenceSplitter
+
+    tokenizer = Settings.tokenizer
+    splitter = SentenceSplitter(chunk_size=passage_tokens, chunk_overlap=0, tokenizer=tokenizer)
+    passages = []
+    for heading, text in page.sections:
+        current: List[str] = []
+        current_tokens = 0
+        for paragraph in (p.strip() for p in text.split("\n")):
+            if not paragraph:
+                continue
+            tokens = len(tokenizer(paragraph))
+            if tokens > passage_tokens:
+                if current:
+                    passages.append([heading, "\n".join(current)])
+                    current, current_tokens = [], 0
+                passages.extend([heading, chunk] for chunk in splitter.split_text(paragraph))
+                continue
+            if current and current_tokens + tokens > passage_tokens:
+                passages.append([heading, "\n".join(current)])
+                current, current_tokens = [], 0
+            current.append(paragraph)
+            current_tokens += tokens
+        if current:
+            passages.append([heading, "\n".join(current)])
+    return passages
+
+
+def select_passages(page: WikipediaPage, query: str) -> str:
+    """
+    Фрагменты страницы, наиболее близкие к запросу по эмбеддингам, в пределах
+    WIKIPEDIA_TOKEN_BUDGET токенов и не больше WIKIPEDIA_TOP_K, в порядке следования в статье
+    """
+    top_k = int(os.getenv("WIKIPEDIA_TOP_K", "5"))
+    budget = int(os.getenv("WIKIPEDIA_TOKEN_BUDGET", "1024"))
+    passages = _passages(page, int(os.getenv("WIKIPEDIA_PASSAGE_TOKENS", "256")))
+    if not passages:
+        return page.title
+
+    embed_model = Settings.embed_model
+    query_vector = np.asarray(embed_model.get_query_embedding(query), dtype=np.float32)
+    matrix = np.asarray(
+        embed_model.get_text_embedding_batch([f"{heading}\n{text}" for heading, text in passages]),
+        dtype=np.float32,
+    )
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query_vector) or 1.0)
+    scores = matrix @ query_vector / np.where(norms == 0, 1.0, norms)
+
+    tokenizer = Settings.tokenizer
+    selected, used = [], 0
+    for index in np.argsort(-scores):
+        tokens = len(tokenizer(passages[index][1]))
+        if used + tokens > budget:
+            continue
+        selected.append(int(index))
+        used += tokens
+        if len(selected) >= top_k:
+            break
+
+    parts = [page.title]
+    for index in sorted(selected):
+        heading, text = passages[index]
+        parts.append(f"## {heading}\n{text}" if heading else text)
+    return "\n\n".join(parts)
@@ -1,26 +1,23 @@
-﻿from typing import Any, Dict
+﻿from typing import List, Optional
 
 from llama_index.core.tools import FunctionTool
 
+from app.engine.tools.wikipedia_pages import get_page, search_titles, select_passages
 
-def load_data(
-        page: str, lang: str = "ru", **load_kwargs: Dict[str, Any]
-) -> str:
-    import wikipedia
-    wikipedia.set_lang(lang)
-    try:
-        wikipedia_page = wikipedia.page(page, **load_kwargs, auto_suggest=False)
-    except wikipedia.PageError:
+
+def load_data(page: str, lang: str = "ru", query: Optional[str] = None) -> str:
+    wikipedia_page = get_page(lang, page)
+    if wikipedia_page is None:
         return "Невозможно загрузить страницу. Попробуйте искать вместо этого."
-    return wikipedia_page.content
+    # Вместо всей статьи возвращаются наиболее близкие к запросу фрагменты в пределах бюджета токенов
+    return select_passages(wikipedia_page, query or page)
 
 
 def search_data(query: str, lang: str = "ru") -> str:
-    import wikipedia
-    pages = wikipedia.search(query)
+    pages: List[str] = search_titles(lang, query)
     if len(pages) == 0:
         return "Нет результатов поиска."
-    return load_data(pages[0], lang)
+    return load_data(pages[0], lang, query=query)
 
 
 def get_tools(**kwargs):
@@ -28,7 +25,10 @@ def get_tools(**kwargs):
         FunctionTool.from_defaults(
             fn=load_data,
             name="wikipedia_load_data",
-            description="Получить страницу Википедии.",
+            description=(
+                "Получить страницу Википедии. "
+                "Необязательный query указывает, какие разделы страницы нужны."
+            ),
         ),
         FunctionTool.from_defaults(
             fn=search_data,
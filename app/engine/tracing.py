@@ -0,0 +1,319 @@
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.exception import ExceptionEvent
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatEndEvent,
+    LLMChatInProgressEvent,
+    LLMChatStartEvent,
+    LLMCompletionEndEvent,
+    LLMCompletionInProgressEvent,
+    LLMCompletionStartEvent,
+)
+from llama_index.core.settings import Settings
+from prometheus_client import Counter, Histogram
+
+logger = logging.getLogger("uvicorn")
+
+_FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_SLOW_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+REQUEST_SECONDS = Histogram(
+    "app_request_seconds", "Длительность HTTP-запроса (для потоков — до последнего байта)",
+    ["route", "method", "status"], buckets=_SLOW_BUCKETS,
+)
+VECTOR_STORE_CONNECT_SECONDS = Histogram(
+    "app_vector_store_connect_seconds", "Подключение к векторному хранилищу",
+    buckets=_FAST_BUCKETS,
+)
+RETRIEVAL_SECONDS = Histogram(
+    "app_retrieval_seconds", "Поиск фрагментов по индексу",
+    ["route"], buckets=_FAST_BUCKETS,
+)
+RETRIEVAL_STAGE_SECONDS = Histogram(
+    "app_retrieval_stage_seconds", "Стадии гибридного поиска и переранжирования",
+    ["route", "stage"], buckets=_FAST_BUCKETS,
+)
+RERANK_FALLBACKS = Counter(
+    "app_rerank_fallbacks", "Переранжирование не уложилось в бюджет или завершилось ошибкой",
+    ["route", "reason"],
+)
+EMBEDDING_SECONDS = Histogram(
+    "app_embedding_seconds", "Вычисление эмбеддингов (с учётом кеша)",
+    ["route", "model"], buckets=_FAST_BUCKETS,
+)
+LLM_SECONDS = Histogram(
+    "app_llm_seconds", "Вызов LLM целиком",
+    ["route", "model"], buckets=_SLOW_BUCKETS,
+)
+LLM_TIME_TO_FIRST_TOKEN_SECONDS = Histogram(
+    "app_llm_time_to_first_token_seconds", "Время до первого токена потокового ответа LLM",
+    ["route", "model"], buckets=_SLOW_BUCKETS,
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "app_llm_tokens_per_second", "Скорость генерации после первого токена",
+    ["route", "model"], buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500),
+)
+LLM_OUTPUT_TOKENS = Counter(
+    "app_llm_output_tokens", "Сгенерированные токены",
+    ["route", "model"],
+)
+TOOL_SECONDS = Histogram(
+    "app_tool_seconds", "Вызов инструмента агента",
+    ["route", "tool", "status"], buckets=_SLOW_BUCKETS,
+)
+AGENT_STEP_SECONDS = Histogram(
+    "app_agent_step_seconds", "Шаг агента",
+    ["route"], buckets=_SLOW_BUCKETS,
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "app_queue_wait_seconds", "Ожидание в очереди планировщика LLM или лимита инструмента",
+    ["route", "queue"], buckets=_FAST_BUCKETS,
+)
+
+
+@dataclass
+class _LLMCall:
+    started_at: float
+    model: str
+    first_token_at: Optional[float] = None
+
+
+@dataclass
+class RequestTrace:
+    """
+    Трасса HTTP-запроса: идентификатор попадает в журнал всех событий запроса
+    и в заголовок X-Trace-Id ответа
+    """
+
+    trace_id: str
+    # ASGI scope: маршрут становится известен после маршрутизации
+    scope: Dict[str, Any] = field(default_factory=dict)
+    llm_calls: Dict[str, _LLMCall] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def route(self) -> str:
+        route = self.scope.get("route")
+        # Непойманные маршрутом пути не размножают метки
+        return getattr(route, "path", None) or "unmatched"
+
+
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar(
+    "current_trace", default=None,
+)
+
+
+def new_trace_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def start_trace(trace: RequestTrace) -> contextvars.Token:
+    return _current_trace.set(trace)
+
+
+def end_trace(token: contextvars.Token):
+    _current_trace.reset(token)
+
+
+def current_trace() -> Optional[RequestTrace]:
+    return _current_trace.get()
+
+
+def current_route() -> str:
+    # Вне HTTP-запроса (генерация индекса, прогрев) метка маршрута пустая
+    trace = _current_trace.get()
+    return trace.route if trace is not None else ""
+
+
+def _trace_prefix() -> str:
+    trace = _current_trace.get()
+    return f"[{trace.trace_id}] " if trace is not None else ""
+
+
+def observe_queue_wait(queue: str, seconds: float, route: Optional[str] = None):
+    QUEUE_WAIT_SECONDS.labels(current_route() if route is None else route, queue).observe(seconds)
+
+
+def observe_retrieval_stages(timings: Dict[str, float]):
+    route = current_route()
+    for stage, seconds in timings.items():
+        RETRIEVAL_STAGE_SECONDS.labels(route, stage).observe(seconds)
+
+
+class TracingHandler(BaseCallbackHandler):
+    """
+    Длительности событий llama_index (поиск, эмбеддинги, вызовы инструментов, шаги агента)
+    в гистограммы с маршрутом текущего запроса; события пишутся в журнал с идентификатором трассы
+    """
+
+    _max_open_events = 10000
+
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self._open: "OrderedDict[str, Tuple[float, CBEventType, Optional[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def on_event_start(
+            self,
+            event_type: CBEventType,
+            payload: Optional[Dict[str, Any]] = None,
+            event_id: str = "",
+            parent_id: str = "",
+            **kwargs: Any,
+    ) -> str:
+        label = None
+        if payload:
+            if event_type == CBEventType.FUNCTION_CALL:
+                label = getattr(payload.get(EventPayload.TOOL), "name", None)
+            elif event_type == CBEventType.EMBEDDING:
+                label = (payload.get(EventPayload.SERIALIZED) or {}).get("model_name")
+        with self._lock:
+            parent = self._open.get(parent_id)
+            # Вложенное событие того же типа (векторный поиск внутри гибридного) уже учтено внешним
+            if parent is not None and parent[1] == event_type:
+                return event_id
+            self._open[event_id] = (time.perf_counter(), event_type, label)
+            # События, начатые без окончания (прерванные потоки), не копятся бесконечно
+            while len(self._open) > self._max_open_events:
+                self._open.popitem(last=False)
+        return event_id
+
+    def on_event_end(
+            self,
+            event_type: CBEventType,
+            payload: Optional[Dict[str, Any]] = None,
+            event_id: str = "",
+            **kwargs: Any,
+    ) -> None:
+        with self._lock:
+            started = self._open.pop(event_id, None)
+        if started is None:
+            return
+        started_at, _, label = started
+        seconds = time.perf_counter() - started_at
+        route = current_route()
+
+        match event_type:
+            case CBEventType.RETRIEVE:
+                RETRIEVAL_SECONDS.labels(route).observe(seconds)
+            case CBEventType.EMBEDDING:
+                EMBEDDING_SECONDS.labels(route, label or "").observe(seconds)
+            case CBEventType.FUNCTION_CALL:
+                status = "error" if payload and EventPayload.EXCEPTION in payload else "ok"
+                TOOL_SECONDS.labels(route, label or "", status).observe(seconds)
+            case CBEventType.AGENT_STEP:
+                AGENT_STEP_SECONDS.labels(route).observe(seconds)
+            case _:
+                return
+
+        logger.debug(f"{_trace_prefix()}{event_type.value} {label or ''} {seconds * 1000:.1f} мс")
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(
+            self,
+            trace_id: Optional[str] = None,
+            trace_map: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
+        pass
+
+
+def _response_text(response: Any) -> str:
+    if response is None:
+        return ""
+    message = getattr(response, "message", None)
+    if message is not None:
+        return message.content or ""
+    return getattr(response, "text", "") or ""
+
+
+class LLMEventHandler(BaseEventHandler):
+    """
+    Время до первого токена и скорость генерации LLM. Обработчики CallbackManager
+    не видят отдельных фрагментов потокового ответа, поэтому используются события
+    инструментирования llama_index. Вложенные вызовы (chat поверх complete) учитываются один раз.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LLMEventHandler"
+
+    def handle(self, event: BaseEvent, **kwargs: Any) -> None:
+        trace = current_trace()
+        if trace is None or event.span_id is None:
+            return
+
+        now = time.perf_counter()
+        if isinstance(event, (LLMChatStartEvent, LLMCompletionStartEvent)):
+            with trace._lock:
+                if not trace.llm_calls:
+                    trace.llm_calls[event.span_id] = _LLMCall(now, Settings.llm.metadata.model_name or "")
+        elif isinstance(event, (LLMChatInProgressEvent, LLMCompletionInProgressEvent)):
+            call = trace.llm_calls.get(event.span_id)
+            if call is not None and call.first_token_at is None:
+                call.first_token_at = now
+        elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            with trace._lock:
+                call = trace.llm_calls.pop(event.span_id, None)
+            if call is not None:
+                self._record(trace, call, now, _response_text(event.response))
+        elif isinstance(event, ExceptionEvent):
+            with trace._lock:
+                trace.llm_calls.pop(event.span_id, None)
+
+    @staticmethod
+    def _record(trace: RequestTrace, call: _LLMCall, ended_at: float, text: str):
+        route = trace.route
+        seconds = ended_at - call.started_at
+        tokens = len(Settings.tokenizer(text)) if text else 0
+
+        LLM_SECONDS.labels(route, call.model).observe(seconds)
+        LLM_OUTPUT_TOKENS.labels(route, call.model).inc(tokens)
+
+        decode_started_at, decode_tokens = call.started_at, tokens
+        if call.first_token_at is not None:
+            LLM_TIME_TO_FIRST_TOKEN_SECONDS.labels(route, call.model).observe(call.first_token_at - call.started_at)
+            decode_started_at, decode_tokens = call.first_token_at, tokens - 1
+        decode_seconds = ended_at - decode_started_at
+        if decode_tokens > 0 and decode_seconds > 0:
+            LLM_TOKENS_PER_SECOND.labels(route, call.model).observe(decode_tokens / decode_seconds)
+
+        logger.debug(f"[{trace.trace_id}] llm {call.model} {seconds * 1000:.1f} мс, токенов: {tokens}")
+
+
+_tracing_handler: Optional[TracingHandler] = None
+_init_lock = threading.Lock()
+
+
+def init_tracing() -> TracingHandler:
+    global _tracing_handler
+    with _init_lock:
+        if _tracing_handler is None:
+            _tracing_handler = TracingHandler()
+            get_dispatcher().add_event_handler(LLMEventHandler())
+        return _tracing_handler
+
+
+def traced_callback_manager(callback_manager: Optional[CallbackManager] = None) -> CallbackManager:
+    """
+    CallbackManager запроса с обработчиком трассировки
+    """
+    handler = init_tracing()
+    if callback_manager is None:
+        return CallbackManager(handlers=[handler])
+    if handler not in callback_manager.handlers:
+        callback_manager.add_handler(handler)
+    return callback_manager
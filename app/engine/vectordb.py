@@ -1,25 +1,343 @@
+import asyncio
+import contextvars
+import hashlib
+import logging
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    MetadataFilters,
+    VectorStoreQuery,
+    VectorStoreQueryResult,
+)
 from llama_index.vector_stores.chroma import ChromaVectorStore
 
+logger = logging.getLogger("uvicorn")
 
-def get_vector_store():
-    collection_name = os.getenv("CHROMA_COLLECTION", "default")
-    chroma_path = os.getenv("CHROMA_PATH")
+# Имя коллекции Chroma: 3–63 символа [a-zA-Z0-9._-], начинается и заканчивается буквой или цифрой
+_COLLECTION_NAME_RE = re.compile(r"[^a-zA-Z0-9_-]+")
 
-    if chroma_path:
-        store = ChromaVectorStore.from_params(
-            persist_dir=chroma_path,
-            collection_name=collection_name
-        )
+
+class UnknownCollectionError(ValueError):
+    pass
+
+
+def base_collection_name() -> str:
+    return os.getenv("CHROMA_COLLECTION", "default")
+
+
+def shard_collection_name(shard: Optional[str]) -> str:
+    """
+    Коллекция части корпуса: CHROMA_COLLECTION-<shard>, без shard — сама CHROMA_COLLECTION
+    """
+    base = base_collection_name()
+    value = str(shard or "").lower()
+    if not value:
+        return base
+    slug = _COLLECTION_NAME_RE.sub("-", value).strip("-_")
+    if slug != value:
+        # Недопустимые символы (например, кириллица) заменены, хеш различает такие значения
+        digest = hashlib.sha1(value.encode("utf-8")).hexdigest()[:8]
+        slug = f"{slug[:40]}-{digest}".lstrip("-")
+    return f"{base}-{slug}"[:63].rstrip("-_")
+
+
+def route_collection(metadata: Dict[str, Any], shard_by: str, loader_type: Optional[str] = None) -> str:
+    """
+    Коллекция документа или его узла согласно INGEST_SHARD_BY:
+    none — CHROMA_COLLECTION, loader — по типу загрузчика (CHROMA_COLLECTION-file, -web, -db),
+    metadata:<поле> — по значению поля метаданных
+    """
+    if shard_by == "none":
+        shard = None
+    elif shard_by == "loader":
+        shard = loader_type or metadata.get("source")
+    elif shard_by.startswith("metadata:"):
+        shard = metadata.get(shard_by.removeprefix("metadata:"))
     else:
-        if not os.getenv("CHROMA_HOST") or not os.getenv("CHROMA_PORT"):
+        raise ValueError(f"Неизвестный способ разбиения на коллекции: {shard_by}")
+    return shard_collection_name(shard)
+
+
+@dataclass
+class VectorStoreConfig:
+    collection_name: str
+    path: Optional[str]
+    host: Optional[str]
+    port: str
+
+    @classmethod
+    def from_env(cls, collection_name: Optional[str] = None) -> "VectorStoreConfig":
+        config = cls(
+            collection_name=collection_name or base_collection_name(),
+            path=os.getenv("CHROMA_PATH"),
+            host=os.getenv("CHROMA_HOST"),
+            port=os.getenv("CHROMA_PORT", "8001"),
+        )
+        if not config.path and (not config.host or not os.getenv("CHROMA_PORT")):
             raise ValueError(
                 "Пожалуйста, предоставьте CHROMA_PATH или CHROMA_HOST и CHROMA_PORT"
             )
-        store = ChromaVectorStore.from_params(
-            host=os.getenv("CHROMA_HOST"),
-            port=os.getenv("CHROMA_PORT", "8001"),
-            collection_name=collection_name,
+        return config
+
+    @property
+    def client_key(self) -> Tuple[str, ...]:
+        if self.path:
+            return "path", os.path.abspath(self.path)
+        return "http", self.host, self.port
+
+
+class AsyncChromaVectorStore(ChromaVectorStore):
+    """
+    ChromaVectorStore, у которого асинхронные методы выполняются в пуле потоков менеджера.
+    У исходного класса они вызывают синхронные методы прямо в цикле событий.
+    """
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "AsyncChromaVectorStore"
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        return await vector_store_manager.run(self.query, query, **kwargs)
+
+    async def async_add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        return await vector_store_manager.run(self.add, nodes, **kwargs)
+
+    async def adelete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        await vector_store_manager.run(self.delete, ref_doc_id, **delete_kwargs)
+
+    async def aget_nodes(
+            self,
+            node_ids: Optional[List[str]] = None,
+            filters: Optional[MetadataFilters] = None,
+    ) -> List[BaseNode]:
+        return await vector_store_manager.run(self.get_nodes, node_ids, filters)
+
+
+class VectorStoreManager:
+    """
+    Клиенты Chroma на весь процесс: локальное хранилище открывается, а удалённый сервер
+    подключается один раз, коллекции переиспользуются всеми запросами и перезагрузками движка.
+    Закрывается при остановке приложения.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients: Dict[Tuple[str, ...], Any] = {}
+        self._stores: Dict[Tuple[Tuple[str, ...], str], AsyncChromaVectorStore] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _create_client(self, config: VectorStoreConfig):
+        import chromadb
+
+        if config.path:
+            logger.info(f"Открытие локального хранилища Chroma: {config.path}")
+            return chromadb.PersistentClient(path=config.path)
+
+        logger.info(f"Подключение к серверу Chroma {config.host}:{config.port}")
+        return chromadb.HttpClient(host=config.host, port=config.port)
+
+    def get_store(self, collection_name: Optional[str] = None) -> AsyncChromaVectorStore:
+        config = VectorStoreConfig.from_env(collection_name)
+        key = (config.client_key, config.collection_name)
+        store = self._stores.get(key)
+        if store is not None:
+            return store
+
+        with self._lock:
+            store = self._stores.get(key)
+            if store is None:
+                collection = self._get_client(config).get_or_create_collection(config.collection_name)
+                store = self._stores[key] = AsyncChromaVectorStore(chroma_collection=collection)
+            return store
+
+    def _get_client(self, config: VectorStoreConfig):
+        client = self._clients.get(config.client_key)
+        if client is None:
+            client = self._clients[config.client_key] = self._create_client(config)
+        return client
+
+    def list_collections(self) -> List[str]:
+        """
+        Коллекции корпуса: из CHROMA_COLLECTIONS или все коллекции хранилища
+        с именем CHROMA_COLLECTION и CHROMA_COLLECTION-*
+        """
+        configured = os.getenv("CHROMA_COLLECTIONS")
+        if configured:
+            return [name.strip() for name in configured.split(",") if name.strip()]
+
+        base = base_collection_name()
+        config = VectorStoreConfig.from_env()
+        with self._lock:
+            collections = self._get_client(config).list_collections()
+        # chromadb до 0.6 возвращает объекты коллекций, начиная с 0.6 — имена
+        names = [getattr(collection, "name", collection) for collection in collections]
+        return sorted(name for name in names if name == base or name.startswith(f"{base}-"))
+
+    def get_collections_store(self, collections: Optional[Sequence[str]] = None) -> BasePydanticVectorStore:
+        """
+        Хранилище для поиска по нескольким коллекциям (по умолчанию — по всем коллекциям корпуса).
+        Для одной коллекции возвращается её хранилище без обёртки
+        """
+        # До первой генерации индекса коллекций нет, используется пустая CHROMA_COLLECTION
+        known = self.list_collections() or [base_collection_name()]
+        if collections is None:
+            collections = known
+        unknown = sorted(set(collections) - set(known))
+        if unknown:
+            raise UnknownCollectionError(f"Неизвестные коллекции: {', '.join(unknown)}")
+        if not collections:
+            raise UnknownCollectionError("Не выбрано ни одной коллекции")
+        if len(collections) == 1:
+            return self.get_store(collections[0])
+        return ShardedVectorStore({name: self.get_store(name) for name in collections})
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=int(os.getenv("CHROMA_QUERY_WORKERS", "8")),
+                        thread_name_prefix="chroma",
+                    )
+        return self._executor
+
+    def map(self, fn, items: Sequence) -> List:
+        # Синхронный вариант для кода, который выполняется вне цикла событий
+        context = contextvars.copy_context()
+        return list(self._get_executor().map(lambda item: context.copy().run(fn, item), items))
+
+    async def run(self, fn, *args, **kwargs):
+        # Контекст копируется, чтобы трасса запроса была видна в потоке пула
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), lambda: context.run(fn, *args, **kwargs))
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            clients = list(self._clients.values())
+            self._clients.clear()
+            self._stores.clear()
+
+        if executor is not None:
+            executor.shutdown(wait=True)
+        if clients:
+            # Останавливает компоненты всех клиентов Chroma процесса,
+            # локальное хранилище при этом сбрасывается на диск
+            clients[0].clear_system_cache()
+            logger.info("Клиенты Chroma закрыты")
+
+
+class ShardedVectorStore(BasePydanticVectorStore):
+    """
+    Поиск по нескольким коллекциям (частям корпуса): запрос выполняется во всех коллекциях
+    одновременно, результаты объединяются по оценке сходства в общий top-k.
+    Оценки сравнимы, потому что все коллекции построены одной моделью эмбеддингов.
+    Добавляемый узел записывается в коллекцию своей части по правилу INGEST_SHARD_BY.
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = True
+
+    _shards: Dict[str, ChromaVectorStore] = PrivateAttr()
+    _shard_by: str = PrivateAttr()
+
+    def __init__(self, shards: Dict[str, ChromaVectorStore], shard_by: Optional[str] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._shards = shards
+        self._shard_by = shard_by or os.getenv("INGEST_SHARD_BY", "none")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ShardedVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    @property
+    def shards(self) -> Dict[str, ChromaVectorStore]:
+        return dict(self._shards)
+
+    def _route(self, nodes: List[BaseNode]) -> List[Tuple[ChromaVectorStore, List[BaseNode]]]:
+        groups: Dict[str, List[BaseNode]] = {}
+        for node in nodes:
+            groups.setdefault(route_collection(node.metadata, self._shard_by), []).append(node)
+        unknown = sorted(set(groups) - set(self._shards))
+        if unknown:
+            raise UnknownCollectionError(f"Узлы относятся к невыбранным коллекциям: {', '.join(unknown)}")
+        return [(self._shards[name], group) for name, group in groups.items()]
+
+    def add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        vector_store_manager.map(lambda item: item[0].add(item[1], **kwargs), self._route(nodes))
+        return [node.node_id for node in nodes]
+
+    async def async_add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        await asyncio.gather(*(shard.async_add(group, **kwargs) for shard, group in self._route(nodes)))
+        return [node.node_id for node in nodes]
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        vector_store_manager.map(lambda shard: shard.delete(ref_doc_id, **delete_kwargs), list(self._shards.values()))
+
+    async def adelete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        await asyncio.gather(*(shard.adelete(ref_doc_id, **delete_kwargs) for shard in self._shards.values()))
+
+    @staticmethod
+    def _merge(results: List[VectorStoreQueryResult], top_k: int) -> VectorStoreQueryResult:
+        hits = []
+        for result in results:
+            hits.extend(zip(result.similarities or [], result.nodes or [], result.ids or []))
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        hits = hits[:top_k]
+        return VectorStoreQueryResult(
+            similarities=[similarity for similarity, _, _ in hits],
+            nodes=[node for _, node, _ in hits],
+            ids=[node_id for _, _, node_id in hits],
         )
-    return store
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        results = vector_store_manager.map(lambda shard: shard.query(query, **kwargs), list(self._shards.values()))
+        return self._merge(results, query.similarity_top_k)
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        results = await asyncio.gather(*(shard.aquery(query, **kwargs) for shard in self._shards.values()))
+        return self._merge(list(results), query.similarity_top_k)
+
+    def get_nodes(
+            self,
+            node_ids: Optional[List[str]] = None,
+            filters: Optional[MetadataFilters] = None,
+    ) -> List[BaseNode]:
+        found = vector_store_manager.map(lambda shard: shard.get_nodes(node_ids, filters), list(self._shards.values()))
+        return [node for nodes in found for node in nodes]
+
+    async def aget_nodes(
+            self,
+            node_ids: Optional[List[str]] = None,
+            filters: Optional[MetadataFilters] = None,
+    ) -> List[BaseNode]:
+        found = await asyncio.gather(*(shard.aget_nodes(node_ids, filters) for shard in self._shards.values()))
+        return [node for nodes in found for node in nodes]
+
+
+vector_store_manager = VectorStoreManager()
+
+
+def get_vector_store(collection_name: Optional[str] = None) -> AsyncChromaVectorStore:
+    return vector_store_manager.get_store(collection_name)
+
+
+def get_collections_store(collections: Optional[Sequence[str]] = None) -> BasePydanticVectorStore:
+    return vector_store_manager.get_collections_store(collections)
+
+
+def list_collections() -> List[str]:
+    return vector_store_manager.list_collections()
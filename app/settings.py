@@ -1,24 +1,36 @@
 ﻿import logging
 import os
+from contextlib import nullcontext
+from typing import Callable, ContextManager, Optional
 
 from llama_index.core.settings import Settings
 
 logger = logging.getLogger("uvicorn")
 
 
-def init_settings():
+def init_settings(phase: Optional[Callable[[str], ContextManager]] = None):
+    # phase("llm") и phase("embed_model") оборачивают загрузку моделей, чтобы измерить стадии запуска
+    phase = phase or (lambda name: nullcontext())
+
+    from app.engine.tracing import traced_callback_manager
+
+    # Задаётся до моделей: они получают CallbackManager при присваивании в Settings
+    Settings.callback_manager = traced_callback_manager()
+
     model_provider = os.getenv("LLM_PROVIDER", "huggingface")
     logger.info(f"Инициализация настроек с поставщиком моделей: {model_provider}")
 
-    match model_provider:
-        case "huggingface":
-            _init_huggingface()
-        case "lm-studio":
-            _init_lm_studio()
+    with phase("llm"):
+        match model_provider:
+            case "huggingface":
+                _init_huggingface()
+            case "lm-studio":
+                _init_lm_studio()
 
     logger.info("Поставщик моделей инициализирован")
 
-    _init_embed_model()
+    with phase("embed_model"):
+        _init_embed_model()
 
     Settings.chunk_size = int(os.getenv("CHUNK_SIZE", "1024"))
     Settings.chunk_overlap = int(os.getenv("CHUNK_OVERLAP", "20"))
@@ -29,12 +41,30 @@ def _init_huggingface():
 
     logger.info("Инициализация Huggingface LLM")
 
-    Settings.llm = HuggingFaceLLM(
+    llm = HuggingFaceLLM(
         model_name=os.getenv("LLM_MODEL"),
         tokenizer_name=os.getenv("LLM_MODEL"),
         max_new_tokens=int(os.getenv("LLM_MAX_NEW_TOKENS", "256")),
     )
 
+    from app.engine.llm_scheduler import (
+        BatchScheduler,
+        BatchingLLM,
+        HuggingFaceBatchBackend,
+        batching_enabled,
+    )
+    from app.engine.prefix_cache import PrefixKVCache
+
+    prefix_cache = PrefixKVCache.from_env()
+    if batching_enabled():
+        # Одновременные запросы к модели объединяются в пакеты, общие начала промптов одиночных запросов
+        # берутся из кеша
+        llm = BatchingLLM(llm, BatchScheduler(HuggingFaceBatchBackend(llm, prefix_cache)))
+    elif prefix_cache is not None:
+        logger.warning("Кеш начал промптов работает только с LLM_BATCHING=True и не используется")
+
+    Settings.llm = llm
+
 
 def _init_lm_studio():
     from llama_index.llms.lmstudio import LMStudio
@@ -54,9 +84,15 @@ def _init_embed_model():
 
     from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
-    Settings.embed_model = HuggingFaceEmbedding(
+    embed_model = HuggingFaceEmbedding(
         model_name=os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2"),
         backend=os.getenv("EMBEDDING_BACKEND", "torch"),
+        embed_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")),
     )
 
+    from app.engine.embedding_cache import CachedEmbedding
+
+    # Повторяющиеся запросы и неизменённые фрагменты не пересчитываются моделью
+    Settings.embed_model = CachedEmbedding.from_env(embed_model)
+
     logger.info("Embed модель инициализирована")
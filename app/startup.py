@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, Optional
+
+from llama_index.core.settings import Settings
+
+logger = logging.getLogger("uvicorn")
+
+
+@dataclass
+class StartupConfig:
+    # background — порт открывается сразу, модели загружаются в фоне; blocking — сервер ждёт загрузки
+    mode: str = "background"
+    warmup: bool = True
+    warmup_query: str = "Что такое договор?"
+    warmup_prompt: str = "Ответь одним словом: да или нет?"
+
+    @classmethod
+    def from_env(cls) -> "StartupConfig":
+        return cls(
+            mode=os.getenv("STARTUP_MODE", "background"),
+            warmup=os.getenv("WARMUP_ENABLED", "True").lower() == "true",
+            warmup_query=os.getenv("WARMUP_QUERY", cls.warmup_query),
+            warmup_prompt=os.getenv("WARMUP_PROMPT", cls.warmup_prompt),
+        )
+
+
+@dataclass
+class StartupStatus:
+    """
+    Состояние запуска: starting (загрузка моделей и индекса), warming (прогрев), ready или failed.
+    Длительность каждой стадии сохраняется для /health/ready и журнала
+    """
+
+    state: str = "starting"
+    phase: Optional[str] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+    error: Optional[str] = None
+    started_at: float = field(default_factory=time.monotonic)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    @property
+    def failed(self) -> bool:
+        return self.state == "failed"
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "status": self.state,
+                "phase": self.phase,
+                "phases_ms": {name: round(seconds * 1000, 1) for name, seconds in self.timings.items()},
+                "uptime_s": round(time.monotonic() - self.started_at, 1),
+                "error": self.error,
+            }
+
+
+startup_status = StartupStatus()
+
+# Модели загружены в главном процессе serve.py до fork: рабочие процессы их не загружают
+_models_preloaded = False
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    with startup_status._lock:
+        startup_status.phase = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with startup_status._lock:
+            startup_status.timings[name] = elapsed
+        logger.info(f"Запуск: {name} — {elapsed:.2f} с")
+
+
+def preload_models():
+    """
+    Загрузка моделей до fork рабочих процессов: веса остаются общими страницами памяти (copy-on-write).
+    Индекс и клиенты Chroma открывает каждый процесс сам, после fork
+    """
+    global _models_preloaded
+    from app.settings import init_settings
+
+    with startup_phase("settings"):
+        init_settings(phase=startup_phase)
+    if os.getenv("RERANK_ENABLED", "False").lower() == "true":
+        from app.engine.reranker import get_reranker
+
+        with startup_phase("reranker"):
+            get_reranker().load()
+    _models_preloaded = True
+
+
+def load_engine():
+    from app.engine.registry import engine_registry
+    from app.settings import init_settings
+
+    if not _models_preloaded:
+        with startup_phase("settings"):
+            init_settings(phase=startup_phase)
+    with startup_phase("engine"):
+        engine_registry.load()
+
+
+def warmup(config: StartupConfig):
+    """
+    Прогрев: эмбеддинг запроса моделью в обход кеша, поиск по индексу (Chroma загружает HNSW в память),
+    кросс-энкодер и короткая генерация. Ошибка прогрева не мешает готовности
+    """
+    from app.engine.embedding_cache import CachedEmbedding
+    from app.engine.registry import engine_registry
+
+    def step(name: str, fn):
+        try:
+            with startup_phase(name):
+                fn()
+        except Exception as e:
+            logger.warning(f"Прогрев {name} не выполнен: {e}")
+
+    def embed():
+        embed_model = Settings.embed_model
+        if isinstance(embed_model, CachedEmbedding):
+            embed_model = embed_model.inner
+        embed_model.get_query_embedding(config.warmup_query)
+
+    def retrieval():
+        index = engine_registry.index
+        if index is not None:
+            index.as_retriever().retrieve(config.warmup_query)
+
+    def rerank():
+        from app.engine.reranker import get_reranker
+
+        get_reranker().load().predict([(config.warmup_query, config.warmup_query)], show_progress_bar=False)
+
+    step("warmup_embed", embed)
+    step("warmup_retrieval", retrieval)
+    if os.getenv("RERANK_ENABLED", "False").lower() == "true":
+        step("warmup_rerank", rerank)
+    step("warmup_llm", lambda: Settings.llm.complete(config.warmup_prompt))
+
+
+async def start(config: StartupConfig):
+    # Загрузка блокирующая, поэтому идёт в потоке: цикл событий тем временем отвечает на /health
+    try:
+        with startup_phase("total"):
+            await asyncio.to_thread(load_engine)
+            if config.warmup:
+                startup_status.state = "warming"
+                await asyncio.to_thread(warmup, config)
+    except Exception as e:
+        with startup_status._lock:
+            startup_status.state = "failed"
+            startup_status.error = str(e)
+        logger.exception("Ошибка запуска сервера")
+        raise
+    with startup_status._lock:
+        startup_status.state = "ready"
+        startup_status.phase = None
+    logger.info(f"Сервер готов: {startup_status.snapshot()['phases_ms']}")
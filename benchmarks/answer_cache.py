@@ -0,0 +1,75 @@
+"""
+Доля попаданий и задержка семантического кеша ответов на воспроизведённом журнале запросов.
+Журнал: текстовый файл, один запрос на строку, в порядке поступления.
+
+    python -m benchmarks.answer_cache --log queries.txt --threshold 0.9 --answer-latency 2.0
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from dotenv import load_dotenv
+
+
+async def replay(queries, cache, answer_latency: float):
+    hit_timings, miss_timings = [], []
+    for query in queries:
+        start = time.perf_counter()
+        lookup = await cache.lookup(query)
+        if not lookup.hit:
+            # Имитация извлечения и генерации ответа
+            await asyncio.sleep(answer_latency)
+            await cache.store(query, f"answer: {query}", lookup.embedding)
+            miss_timings.append(time.perf_counter() - start)
+        else:
+            hit_timings.append(time.perf_counter() - start)
+    return hit_timings, miss_timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log", required=True)
+    parser.add_argument("--threshold", type=float, default=0.95)
+    parser.add_argument("--ttl", type=float, default=3600)
+    parser.add_argument("--max-size", type=int, default=1024)
+    parser.add_argument("--answer-latency", type=float, default=1.0)
+    parser.add_argument("--real-embeddings", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    from llama_index.core.settings import Settings
+
+    from app.api.services.answer_cache import SemanticAnswerCache
+    from benchmarks.mocks import HashingEmbedding
+
+    if args.real_embeddings:
+        from app.settings import _init_embed_model
+        _init_embed_model()
+    else:
+        Settings.embed_model = HashingEmbedding()
+
+    with open(args.log, encoding="utf-8") as f:
+        queries = [line.strip() for line in f if line.strip()]
+
+    cache = SemanticAnswerCache(
+        name="benchmark",
+        threshold=args.threshold,
+        ttl=args.ttl,
+        max_size=args.max_size,
+    )
+    hits, misses = asyncio.run(replay(queries, cache, args.answer_latency))
+
+    print(f"queries={len(queries)} hit_rate={cache.hit_rate:.2%}")
+    if hits:
+        print(f"hit  mean={statistics.mean(hits) * 1000:8.2f}ms")
+    if misses:
+        print(f"miss mean={statistics.mean(misses) * 1000:8.2f}ms")
+    total = sum(hits) + sum(misses)
+    uncached = len(queries) * args.answer_latency
+    print(f"total={total:.2f}s without cache≈{uncached:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
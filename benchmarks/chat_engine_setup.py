@@ -0,0 +1,69 @@
+"""
+Сравнение задержки подготовки движка чата на один запрос:
+сборка индекса и инструментов на каждый запрос против общего EngineRegistry.
+
+    python -m benchmarks.chat_engine_setup --iterations 50
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from typing import Callable, List
+
+from dotenv import load_dotenv
+
+
+def _measure(fn: Callable[[], object], iterations: int) -> List[float]:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def _report(name: str, timings: List[float]):
+    timings = sorted(timings)
+    p95 = timings[max(int(len(timings) * 0.95) - 1, 0)]
+    print(
+        f"{name:<12} mean={statistics.mean(timings):8.2f}ms "
+        f"p50={statistics.median(timings):8.2f}ms p95={p95:8.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    load_dotenv()
+    os.environ.setdefault("CHROMA_PATH", tempfile.mkdtemp(prefix="bench-chroma-"))
+
+    from llama_index.core import MockEmbedding
+    from llama_index.core.agent import AgentRunner
+    from llama_index.core.llms import MockLLM
+    from llama_index.core.settings import Settings
+
+    from app.engine.engine import get_chat_engine
+    from app.engine.index import get_index
+    from app.engine.registry import engine_registry
+    from app.engine.tools import ToolFactory
+    from app.engine.tools.query_engine import get_query_engine_tool
+
+    Settings.llm = MockLLM()
+    Settings.embed_model = MockEmbedding(embed_dim=384)
+
+    def per_request_setup():
+        tools = [get_query_engine_tool(get_index())]
+        tools.extend(ToolFactory.from_env())
+        return AgentRunner.from_llm(llm=Settings.llm, tools=tools)
+
+    engine_registry.load()
+
+    _report("before", _measure(per_request_setup, args.iterations))
+    _report("after", _measure(get_chat_engine, args.iterations))
+
+
+if __name__ == "__main__":
+    main()
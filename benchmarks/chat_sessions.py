@@ -0,0 +1,123 @@
+"""
+Длинный разговор с агентом: полная история в каждом запросе (как раньше передавал клиент)
+против серверной сессии с ограниченным буфером и кратким содержанием старых реплик.
+Модель подменена DeterministicLLM, задержка до первого токена растёт с длиной промпта.
+
+    python -m benchmarks.chat_sessions --turns 60 --token-limit 1024
+"""
+import argparse
+import asyncio
+import random
+import time
+from typing import Dict, List
+
+from llama_index.core.callbacks import CallbackManager, TokenCountingHandler
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.settings import Settings
+
+from app.api.services.sessions import ChatSessions, MemorySessionStore
+from app.engine.engine import create_agent
+from benchmarks.mocks import DeterministicLLM
+from benchmarks.suite import summarize, synthetic_text
+
+
+def _questions(turns: int, words: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    return [synthetic_text(rng, words) + "?" for _ in range(turns)]
+
+
+async def _ask(question: str, history: List[ChatMessage], counter: TokenCountingHandler):
+    counter.reset_counts()
+    agent = create_agent([], callback_manager=CallbackManager([counter]))
+    start = time.perf_counter()
+    response = await agent.achat(question, history)
+    return response.response, time.perf_counter() - start, counter.prompt_llm_token_count
+
+
+async def run_full_history(questions: List[str], counter: TokenCountingHandler) -> Dict[str, List[float]]:
+    history: List[ChatMessage] = []
+    latencies, prompt_tokens = [], []
+    for question in questions:
+        answer, seconds, tokens = await _ask(question, history, counter)
+        history.append(ChatMessage(role=MessageRole.USER, content=question))
+        history.append(ChatMessage(role=MessageRole.ASSISTANT, content=answer))
+        latencies.append(seconds)
+        prompt_tokens.append(tokens)
+    return {"latencies": latencies, "prompt_tokens": prompt_tokens}
+
+
+async def run_session(questions: List[str], counter: TokenCountingHandler, token_limit: int,
+                      summarize_history: bool) -> Dict[str, List[float]]:
+    sessions = ChatSessions(MemorySessionStore(16, 3600), token_limit, summarize=summarize_history)
+    session_id = sessions.new_session_id()
+    latencies, prompt_tokens = [], []
+    compaction_seconds = 0.0
+    for question in questions:
+        async with sessions.turn(session_id) as session:
+            answer, seconds, tokens = await _ask(question, session.history(), counter)
+            session.add_exchange(question, answer)
+        latencies.append(seconds)
+        prompt_tokens.append(tokens)
+        # Сжатие идёт в фоне между репликами; его время учитывается отдельно
+        start = time.perf_counter()
+        await sessions.wait_compactions()
+        compaction_seconds += time.perf_counter() - start
+    session = await sessions.get(session_id)
+    return {
+        "latencies": latencies,
+        "prompt_tokens": prompt_tokens,
+        "compaction_seconds": compaction_seconds,
+        "summarized_messages": session.summarized_messages,
+    }
+
+
+def _report(name: str, result: Dict, tail: int):
+    latency = summarize(result["latencies"])
+    last = result["prompt_tokens"][-tail:]
+    line = (
+        f"{name:<20} промпт: среднее {sum(result['prompt_tokens']) / len(result['prompt_tokens']):>8.0f}, "
+        f"последние {tail}: {sum(last) / len(last):>8.0f}, макс {max(result['prompt_tokens']):>7} ток. | "
+        f"задержка p50 {latency['p50_ms']:>7.1f} мс, p95 {latency['p95_ms']:>7.1f} мс, "
+        f"всего {sum(result['latencies']):>6.2f} с"
+    )
+    if "compaction_seconds" in result:
+        line += (
+            f" | сжатие {result['compaction_seconds']:.2f} с, "
+            f"свёрнуто реплик {result['summarized_messages']}"
+        )
+    print(line)
+
+
+async def main_async(args):
+    Settings.llm = DeterministicLLM(
+        max_tokens=args.max_tokens,
+        first_token_latency=args.first_token_latency,
+        prompt_token_latency=args.prompt_token_latency,
+        token_latency=args.token_latency,
+    )
+    counter = TokenCountingHandler()
+    questions = _questions(args.turns, args.question_words, args.seed)
+
+    print(f"Реплик: {args.turns}, слов в вопросе: {args.question_words}, буфер сессии: {args.token_limit} ток.")
+    _report("полная история", await run_full_history(questions, counter), args.tail)
+    _report("сессия", await run_session(questions, counter, args.token_limit, True), args.tail)
+    _report("сессия без сводки", await run_session(questions, counter, args.token_limit, False), args.tail)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=60)
+    parser.add_argument("--question-words", type=int, default=40)
+    parser.add_argument("--token-limit", type=int, default=1024)
+    parser.add_argument("--tail", type=int, default=10, help="по скольким последним репликам считать промпт")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--first-token-latency", type=float, default=0.02)
+    parser.add_argument("--prompt-token-latency", type=float, default=0.0002)
+    parser.add_argument("--token-latency", type=float, default=0.002)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Сравнение двух прогонов benchmarks.suite по совпадающим измерениям: задержки и пиковая память
+не должны вырасти, пропускная способность — упасть больше чем на --tolerance.
+Код возврата 1 при ухудшении, чтобы сравнение можно было использовать как регрессионную проверку.
+
+    python -m benchmarks.compare baseline.json current.json --tolerance 0.15
+"""
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Tuple
+
+# Поля, определяющие измерение в каждой части
+KEYS = {
+    "api": ("route", "concurrency"),
+    "ingestion": ("documents",),
+    "retrieval": ("collection_size", "mode"),
+}
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "first_byte_p50_ms", "seconds", "peak_rss_mb")
+HIGHER_IS_BETTER = ("throughput_rps", "docs_per_sec")
+
+
+def _index(report: Dict[str, Any], part: str) -> Dict[Tuple, Dict[str, Any]]:
+    return {tuple(row[key] for key in KEYS[part]): row for row in report.get(part, [])}
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    rows = []
+    for part in KEYS:
+        before, after = _index(baseline, part), _index(current, part)
+        for key in sorted(before.keys() & after.keys(), key=str):
+            for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+                if metric not in before[key] or metric not in after[key] or not before[key][metric]:
+                    continue
+                change = after[key][metric] / before[key][metric] - 1
+                worse = -change if metric in HIGHER_IS_BETTER else change
+                rows.append({
+                    "part": part,
+                    "key": "/".join(str(value) for value in key),
+                    "metric": metric,
+                    "baseline": before[key][metric],
+                    "current": after[key][metric],
+                    "change": change,
+                    "regression": worse > tolerance,
+                })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--only-regressions", action="store_true")
+    args = parser.parse_args()
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.current, encoding="utf-8") as f:
+        current = json.load(f)
+
+    rows = compare(baseline, current, args.tolerance)
+    print(f"{'part':<10} {'measurement':<48} {'metric':<18} {'baseline':>10} {'current':>10} {'change':>8}")
+    for row in rows:
+        if args.only_regressions and not row["regression"]:
+            continue
+        print(
+            f"{row['part']:<10} {row['key']:<48} {row['metric']:<18} {row['baseline']:>10.2f} "
+            f"{row['current']:>10.2f} {row['change']:>+8.1%}{'  !' if row['regression'] else ''}"
+        )
+
+    regressions = sum(row["regression"] for row in rows)
+    print(f"\nИзмерений: {len(rows)}, ухудшений больше {args.tolerance:.0%}: {regressions}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Пропускная способность обходчика сайтов на локальном HTTP-сервере с синтетическим сайтом.
+Второй проход повторяет обход с манифестом и проверяет условные GET (304).
+
+    python -m benchmarks.crawler --pages 2000 --links 5 --latency 0.02
+"""
+import argparse
+import hashlib
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_handler(pages: int, links: int, latency: float):
+    rng = random.Random(0)
+    site = {
+        i: [rng.randrange(pages) for _ in range(links)]
+        for i in range(pages)
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/robots.txt":
+                self._send(200, b"User-agent: *\nDisallow: /private/\n", "text/plain")
+                return
+            try:
+                page = int(self.path.strip("/").split("/")[-1] or 0)
+            except ValueError:
+                self._send(404, b"", "text/plain")
+                return
+            time.sleep(latency)
+
+            body = "".join(
+                f'<a href="/site/{target}">Страница {target}</a>' for target in site.get(page, [])
+            )
+            html = f"<html><body><h1>Страница {page}</h1><p>Статья {page} закона.</p>{body}</body></html>"
+            payload = html.encode("utf-8")
+            etag = '"' + hashlib.md5(payload).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self._send(304, b"", "text/html", etag)
+            else:
+                self._send(200, payload, "text/html; charset=utf-8", etag)
+
+        def _send(self, status, payload, content_type, etag=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            if etag:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+def crawl(config, manifest):
+    from app.engine.loaders.crawler import Crawler
+
+    crawler = Crawler(config, manifest)
+    start = time.perf_counter()
+    doc_ids = [document.id_ for document in crawler.iter_documents()]
+    manifest.commit(doc_ids)
+    documents = len(doc_ids)
+    elapsed = time.perf_counter() - start
+    pages = crawler.stats.fetched + crawler.stats.not_modified
+    print(
+        f"documents={documents} pages={pages} not_modified={crawler.stats.not_modified} "
+        f"time={elapsed:.2f}s rate={pages / elapsed:.1f} pages/s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--links", type=int, default=5)
+    parser.add_argument("--depth", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--per-host", type=int, default=8)
+    args = parser.parse_args()
+
+    from app.engine.loaders.web import CrawlUrl, WebLoaderConfig
+    from app.engine.manifest import SourceManifest
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.pages, args.links, args.latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}/site/"
+
+    config = WebLoaderConfig(
+        urls=[CrawlUrl(base_url=f"{base}0", prefix=base, max_depth=args.depth)],
+        concurrency=args.concurrency,
+        per_host_concurrency=args.per_host,
+    )
+    manifest = SourceManifest.load(tempfile.mkdtemp(prefix="bench-manifest-"))
+
+    try:
+        print("first crawl:")
+        crawl(config, manifest)
+        print("conditional recrawl:")
+        crawl(config, manifest)
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Скорость потоковой загрузки строк из SQLite и пиковая память процесса.
+
+    python -m benchmarks.db_loader --rows 2000000 --page-size 5000 --tables 2
+"""
+import argparse
+import os
+import resource
+import sqlite3
+import tempfile
+import time
+
+
+def create_database(path: str, rows: int, tables: int):
+    connection = sqlite3.connect(path)
+    for table in range(tables):
+        connection.execute(
+            f"CREATE TABLE articles_{table} (id INTEGER PRIMARY KEY, title TEXT, body TEXT, updated_at INTEGER)"
+        )
+        connection.executemany(
+            f"INSERT INTO articles_{table} VALUES (?, ?, ?, ?)",
+            (
+                (i, f"Статья {i}", f"Текст статьи {i} о правах и обязанностях.", i)
+                for i in range(rows)
+            ),
+        )
+    connection.commit()
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--tables", type=int, default=2)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--pool-size", type=int, default=2)
+    args = parser.parse_args()
+
+    from app.engine.loaders.db import DBLoaderConfig, DBQuery, get_db_documents
+    from app.engine.manifest import SourceManifest
+
+    directory = tempfile.mkdtemp(prefix="bench-db-")
+    path = os.path.join(directory, "bench.sqlite")
+    start = time.perf_counter()
+    create_database(path, args.rows, args.tables)
+    print(f"database: {args.rows * args.tables} rows in {time.perf_counter() - start:.1f}s")
+
+    configs = [
+        DBLoaderConfig(
+            uri=f"sqlite:///{path}",
+            page_size=args.page_size,
+            pool_size=args.pool_size,
+            queries=[
+                DBQuery(
+                    query=f"SELECT id, title, body, updated_at FROM articles_{table}",
+                    watermark_column="updated_at",
+                    id_column="id",
+                    metadata_columns=["title"],
+                )
+                for table in range(args.tables)
+            ],
+        )
+    ]
+
+    for run in ("full", "incremental"):
+        manifest = SourceManifest.load(directory)
+        start = time.perf_counter()
+        doc_ids = [document.id_ for document in get_db_documents(configs, manifest)]
+        elapsed = time.perf_counter() - start
+        manifest.commit(doc_ids)
+        manifest.save()
+        rate = len(doc_ids) / elapsed if elapsed else 0.0
+        print(f"{run}: {len(doc_ids)} documents, {elapsed:.1f}s, {rate:.0f} rows/s")
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"peak RSS: {peak_rss:.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Хранилище документов генерации: SimpleDocumentStore (JSON целиком в памяти) и SQLiteDocumentStore.
+Для каждого размера корпуса в отдельном процессе измеряются время открытия, пиковая память,
+чтение хешей по ключу, получение всех хешей и сохранение изменённой части.
+
+    python -m benchmarks.docstore --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+_WORDS = ["статья", "кодекс", "закон", "пункт", "часть", "договор", "суд", "налог", "имущество", "право"]
+
+
+def write_json_docstore(path: str, size: int, text_words: int):
+    # Тот же формат, что у SimpleDocumentStore.persist, без построения объектов Document
+    from llama_index.core import Document
+    from llama_index.core.storage.docstore.utils import doc_to_json
+
+    rng = random.Random(0)
+    data, metadata = {}, {}
+    for i in range(size):
+        doc = Document(text=" ".join(rng.choices(_WORDS, k=text_words)), id_=f"doc-{i}")
+        data[doc.id_] = doc_to_json(doc)
+        metadata[doc.id_] = {"doc_hash": doc.hash}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"docstore/data": data, "docstore/metadata": metadata, "docstore/ref_doc_info": {}}, f)
+
+
+def _rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure(backend: str, storage_dir: str, size: int, lookups: int, update: int) -> dict:
+    from llama_index.core import Document
+    from llama_index.core.storage.docstore import SimpleDocumentStore
+
+    from app.engine.docstore import SQLiteDocumentStore
+
+    rss_before = _rss_mb()
+    start = time.perf_counter()
+    if backend == "sqlite":
+        store = SQLiteDocumentStore.from_env(storage_dir)
+    else:
+        store = SimpleDocumentStore.from_persist_dir(storage_dir)
+    load = time.perf_counter() - start
+
+    rng = random.Random(1)
+    ids = [f"doc-{rng.randrange(size)}" for _ in range(lookups)]
+    start = time.perf_counter()
+    for doc_id in ids:
+        store.get_document_hash(doc_id)
+    lookup = (time.perf_counter() - start) / lookups
+
+    start = time.perf_counter()
+    hashes = store.get_all_document_hashes()
+    all_hashes = time.perf_counter() - start
+    assert len(hashes) == size
+
+    # Изменение части корпуса: новые версии документов и их хеши, затем сохранение
+    changed = [Document(text=f"изменённый документ {i}", id_=f"doc-{i}") for i in rng.sample(range(size), update)]
+    start = time.perf_counter()
+    if backend == "sqlite":
+        with store.transaction():
+            store.add_documents(changed)
+            store.set_document_hashes({doc.id_: doc.hash for doc in changed})
+    else:
+        store.add_documents(changed)
+        store.set_document_hashes({doc.id_: doc.hash for doc in changed})
+        store.persist(os.path.join(storage_dir, "docstore.json"))
+    commit = time.perf_counter() - start
+
+    return {
+        "backend": backend,
+        "size": size,
+        "load_s": load,
+        "rss_mb": _rss_mb(),
+        "rss_delta_mb": _rss_mb() - rss_before,
+        "lookup_us": lookup * 1e6,
+        "all_hashes_s": all_hashes,
+        "commit_s": commit,
+    }
+
+
+def _migrate(storage_dir: str):
+    from app.engine.docstore import SQLiteDocumentStore
+
+    SQLiteDocumentStore.from_env(storage_dir)
+
+
+def run(size: int, lookups: int, update: int, text_words: int) -> list:
+    context = multiprocessing.get_context("spawn")
+    directory = tempfile.mkdtemp(prefix="docstore-")
+    results = []
+    try:
+        json_dir = os.path.join(directory, "json")
+        sqlite_dir = os.path.join(directory, "sqlite")
+        os.makedirs(json_dir)
+        start = time.perf_counter()
+        write_json_docstore(os.path.join(json_dir, "docstore.json"), size, text_words)
+        print(f"{size}: корпус записан за {time.perf_counter() - start:.1f}s, "
+              f"docstore.json {os.path.getsize(os.path.join(json_dir, 'docstore.json')) / 1024 / 1024:.0f} МБ")
+
+        # Перенос JSON в SQLite (однократно при первом запуске генерации)
+        shutil.copytree(json_dir, sqlite_dir)
+        with context.Pool(1) as pool:
+            start = time.perf_counter()
+            pool.apply(_migrate, (sqlite_dir,))
+            print(f"{size}: перенос в SQLite за {time.perf_counter() - start:.1f}s")
+
+        for backend, storage_dir in (("json", json_dir), ("sqlite", sqlite_dir)):
+            # Отдельный процесс: пиковая память не зависит от предыдущих прогонов
+            with context.Pool(1) as pool:
+                result = pool.apply(_measure, (backend, storage_dir, size, lookups, update))
+            results.append(result)
+            print(
+                f"{backend:>6} {size:>8}: load={result['load_s']:.2f}s rss={result['rss_mb']:.0f}MB "
+                f"(+{result['rss_delta_mb']:.0f}MB) lookup={result['lookup_us']:.1f}us "
+                f"all_hashes={result['all_hashes_s']:.2f}s commit={result['commit_s']:.2f}s"
+            )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--lookups", type=int, default=1000)
+    parser.add_argument("--update", type=int, default=500, help="Изменённых документов при сохранении")
+    parser.add_argument("--text-words", type=int, default=80)
+    parser.add_argument("--output", help="JSON с результатами")
+    args = parser.parse_args()
+
+    os.environ.pop("DOCSTORE_SQLITE_PATH", None)
+    results = []
+    for size in args.sizes:
+        results.extend(run(size, args.lookups, min(args.update, size), args.text_words))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
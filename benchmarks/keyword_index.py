@@ -0,0 +1,83 @@
+"""
+Построение, поиск и инкрементальное обновление индекса ключевых слов BM25
+на синтетическом корпусе.
+
+    python -m benchmarks.keyword_index --nodes 200000 --batch 5000 --queries 200
+"""
+import argparse
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+
+_WORDS = [
+    "статья", "кодекс", "закон", "пункт", "часть", "договор", "ответственность", "суд",
+    "налог", "имущество", "право", "обязанность", "срок", "лицо", "орган", "решение",
+]
+
+
+def make_nodes(start: int, count: int, rng: random.Random):
+    nodes = []
+    for i in range(start, start + count):
+        words = rng.choices(_WORDS, k=60) + [str(rng.randint(1, 500))]
+        node = TextNode(id_=f"node-{i}", text=" ".join(words))
+        node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=f"doc-{i // 4}")
+        nodes.append(node)
+    return nodes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nodes", type=int, default=200_000)
+    parser.add_argument("--batch", type=int, default=5_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=20)
+    parser.add_argument("--max-segments", type=int, default=8)
+    args = parser.parse_args()
+
+    from app.engine.keyword_index import KEYWORD_INDEX_DIR, KeywordIndex
+
+    rng = random.Random(0)
+    directory = tempfile.mkdtemp(prefix="keyword-index-")
+    try:
+        index = KeywordIndex(os.path.join(directory, KEYWORD_INDEX_DIR), max_segments=args.max_segments)
+        start = time.perf_counter()
+        for offset in range(0, args.nodes, args.batch):
+            index.add(make_nodes(offset, min(args.batch, args.nodes - offset), rng))
+            index.persist()
+        build = time.perf_counter() - start
+        print(f"build: {args.nodes} узлов за {build:.2f}s, {args.nodes / build:.0f} узлов/с")
+
+        start = time.perf_counter()
+        index = KeywordIndex.load(directory)
+        print(f"load: {(time.perf_counter() - start) * 1000:.1f}ms, сегментов: {len(index._segments)}")
+
+        timings = []
+        for _ in range(args.queries):
+            query = f"{rng.choice(_WORDS)} {rng.randint(1, 500)}"
+            start = time.perf_counter()
+            index.search(query, args.top_k)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(
+            f"search: mean={statistics.mean(timings) * 1000:.2f}ms "
+            f"p95={timings[int(len(timings) * 0.95) - 1] * 1000:.2f}ms"
+        )
+
+        # Изменение 1% документов: удаление прежних узлов и дозапись новых
+        changed = [f"doc-{i}" for i in rng.sample(range(args.nodes // 4), max(args.nodes // 400, 1))]
+        start = time.perf_counter()
+        index.delete_documents(changed)
+        index.add(make_nodes(args.nodes, len(changed) * 4, rng))
+        index.persist()
+        print(f"update: {len(changed)} документов за {(time.perf_counter() - start) * 1000:.1f}ms")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
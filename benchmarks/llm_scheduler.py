@@ -0,0 +1,127 @@
+"""
+Нагрузочный тест планировщика пакетных запросов к локальной модели:
+пропускная способность и задержка p50/p95 при разном числе одновременных запросов,
+с пакетами и без них (max_batch_size=1).
+
+По умолчанию модель имитируется: время пакета = prefill + шаг * max_new_tokens * (1 + batch_cost * (размер - 1)).
+С --real используется HuggingFaceLLM из настроек .env.
+
+    python -m benchmarks.llm_scheduler --concurrency 1 4 8 16 32 --requests 64
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+from dotenv import load_dotenv
+
+
+class SimulatedBackend:
+    def __init__(self, max_new_tokens: int, prefill: float, step: float, batch_cost: float):
+        self.max_new_tokens = max_new_tokens
+        self.prefill = prefill
+        self.step = step
+        self.batch_cost = batch_cost
+
+    def count_tokens(self, prompt: str) -> int:
+        return len(prompt.split())
+
+    def generate(
+            self,
+            prompts: List[str],
+            callbacks: List[Optional[Callable[[str], None]]],
+            stops: Optional[List[threading.Event]] = None,
+    ) -> List[str]:
+        stops = stops or [threading.Event() for _ in prompts]
+        scale = 1 + self.batch_cost * (len(prompts) - 1)
+        time.sleep(self.prefill * scale)
+        for _ in range(self.max_new_tokens):
+            # Пакет завершается, когда отменены все его запросы
+            if all(stop.is_set() for stop in stops):
+                break
+            time.sleep(self.step * scale)
+            for callback, stop in zip(callbacks, stops):
+                if callback is not None and not stop.is_set():
+                    callback("x")
+        return [f"ответ на: {prompt[:20]}" for prompt in prompts]
+
+
+async def load(llm, concurrency: int, requests: int) -> List[float]:
+    latencies: List[float] = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await llm.acomplete(f"Вопрос номер {i} о статье {i % 50} кодекса")
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*[one(i) for i in range(requests)])
+    return latencies
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--prefill", type=float, default=0.05)
+    parser.add_argument("--step", type=float, default=0.01)
+    parser.add_argument("--batch-cost", type=float, default=0.15)
+    parser.add_argument("--real", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv()
+
+    from llama_index.core.llms.mock import MockLLM
+
+    from app.engine.llm_scheduler import BatchScheduler, BatchingLLM, HuggingFaceBatchBackend, SchedulerConfig
+
+    if args.real:
+        from llama_index.llms.huggingface import HuggingFaceLLM
+
+        base_llm = HuggingFaceLLM(
+            model_name=os.getenv("LLM_MODEL"),
+            tokenizer_name=os.getenv("LLM_MODEL"),
+            max_new_tokens=args.max_new_tokens,
+        )
+        backend = HuggingFaceBatchBackend(base_llm)
+    else:
+        base_llm = MockLLM(max_tokens=args.max_new_tokens)
+        backend = SimulatedBackend(args.max_new_tokens, args.prefill, args.step, args.batch_cost)
+
+    print(f"{'batch':>5} {'conc':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'mean batch':>10} {'peak queue':>10}")
+    for max_batch_size in (1, args.max_batch_size):
+        for concurrency in args.concurrency:
+            config = SchedulerConfig(
+                max_batch_size=max_batch_size,
+                max_wait_ms=args.max_wait_ms,
+                max_queue_size=max(concurrency, 1) * 2,
+            )
+            scheduler = BatchScheduler(backend, config)
+            llm = BatchingLLM(base_llm, scheduler)
+
+            start = time.perf_counter()
+            latencies = asyncio.run(load(llm, concurrency, args.requests))
+            elapsed = time.perf_counter() - start
+            metrics = scheduler.metrics.snapshot(scheduler.queue_depth)
+            scheduler.close()
+
+            print(
+                f"{max_batch_size:>5} {concurrency:>5} {args.requests / elapsed:>8.2f} "
+                f"{percentile(latencies, 0.5) * 1000:>9.1f} {percentile(latencies, 0.95) * 1000:>9.1f} "
+                f"{metrics['mean_batch_size']:>10.2f} {metrics['peak_queue_depth']:>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
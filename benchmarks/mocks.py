@@ -0,0 +1,208 @@
+import asyncio
+import hashlib
+import re
+import time
+from typing import Any, List, Sequence
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.llms.generic_utils import (
+    astream_completion_response_to_chat_response,
+    completion_response_to_chat_response,
+)
+from llama_index.core.base.llms.types import (
+    ChatMessage,
+    ChatResponse,
+    ChatResponseAsyncGen,
+    CompletionResponse,
+    CompletionResponseAsyncGen,
+    CompletionResponseGen,
+    LLMMetadata,
+)
+from llama_index.core.llms.callbacks import llm_chat_callback, llm_completion_callback
+from llama_index.core.llms.custom import CustomLLM
+from pydantic import PrivateAttr
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+_REACT_PREFIX = "Thought: I can answer without using any more tools.\nAnswer:"
+_ANSWER_WORDS = [
+    "статья", "кодекс", "закон", "пункт", "часть", "договор", "ответственность", "суд",
+    "налог", "имущество", "право", "обязанность", "срок", "лицо", "орган", "решение",
+]
+
+
+class HashingEmbedding(BaseEmbedding):
+    """
+    Детерминированная замена модели эмбеддингов для офлайн бенчмарков:
+    мешок слов и триграмм символов, разложенный хешированием по embed_dim измерениям.
+    """
+
+    embed_dim: int = 384
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "HashingEmbedding"
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.embed_dim, dtype=np.float32)
+        for token in _TOKEN_RE.findall(text.lower()):
+            features = [token] + [token[i:i + 3] for i in range(max(len(token) - 2, 1))]
+            for feature in features:
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                bucket = int.from_bytes(digest[:4], "little") % self.embed_dim
+                sign = 1.0 if digest[4] & 1 else -1.0
+                vector[bucket] += sign
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._embed(query)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class DeterministicLLM(CustomLLM):
+    """
+    Детерминированная замена LLM для офлайн бенчмарков: ответ из max_tokens слов, выбранных
+    по хешу промпта, с задержкой до первого токена (растёт с длиной промпта) и на каждый следующий токен.
+    Ответ оформлен как итог ReAct, поэтому агент завершает работу за один шаг.
+    """
+
+    max_tokens: int = 32
+    first_token_latency: float = 0.0
+    # Обработка промпта: задержка на каждое слово промпта до первого токена
+    prompt_token_latency: float = 0.0
+    token_latency: float = 0.0
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "DeterministicLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(num_output=self.max_tokens, model_name="deterministic")
+
+    def _tokens(self, prompt: str) -> List[str]:
+        seed = int.from_bytes(hashlib.blake2b(prompt.encode("utf-8"), digest_size=8).digest(), "little")
+        rng = np.random.default_rng(seed)
+        words = [_ANSWER_WORDS[i] for i in rng.integers(0, len(_ANSWER_WORDS), self.max_tokens)]
+        return [_REACT_PREFIX] + [f" {word}" for word in words]
+
+    def _first_token_delay(self, prompt: str) -> float:
+        return self.first_token_latency + self.prompt_token_latency * len(_TOKEN_RE.findall(prompt))
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        tokens = self._tokens(prompt)
+        time.sleep(self._first_token_delay(prompt) + self.token_latency * (len(tokens) - 1))
+        return CompletionResponse(text="".join(tokens))
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        def gen() -> CompletionResponseGen:
+            text = ""
+            for i, token in enumerate(self._tokens(prompt)):
+                time.sleep(self._first_token_delay(prompt) if i == 0 else self.token_latency)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+    # Асинхронные методы не блокируют цикл событий, как BatchingLLM и клиенты внешних моделей
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        tokens = self._tokens(prompt)
+        await asyncio.sleep(self._first_token_delay(prompt) + self.token_latency * (len(tokens) - 1))
+        return CompletionResponse(text="".join(tokens))
+
+    @llm_completion_callback()
+    async def astream_complete(
+            self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        async def gen() -> CompletionResponseAsyncGen:
+            text = ""
+            for i, token in enumerate(self._tokens(prompt)):
+                await asyncio.sleep(self._first_token_delay(prompt) if i == 0 else self.token_latency)
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+    @llm_chat_callback()
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        completion_response = await self.acomplete(self.messages_to_prompt(messages), formatted=True)
+        return completion_response_to_chat_response(completion_response)
+
+    @llm_chat_callback()
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponseAsyncGen:
+        completion_response_gen = await self.astream_complete(self.messages_to_prompt(messages), formatted=True)
+        return astream_completion_response_to_chat_response(completion_response_gen)
+
+
+class CpuBoundLLM(DeterministicLLM):
+    """
+    Замена локальной модели для бенчмарка prefork: веса weights_mb мегабайт в памяти процесса
+    и вычисления на Python на каждый токен, которые удерживают GIL, как генерация на CPU.
+    Асинхронные методы выполняются в потоке и не блокируют цикл событий, но потоки одного процесса
+    работают по очереди
+    """
+
+    weights_mb: int = 0
+    # Итераций вычислений на один токен
+    token_work: int = 20000
+
+    _weights: Any = PrivateAttr(default=None)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CpuBoundLLM"
+
+    def model_post_init(self, __context: Any) -> None:
+        # Страницы заполняются сразу, как при загрузке настоящих весов
+        self._weights = np.ones(self.weights_mb * 1024 * 1024 // 4, dtype=np.float32)
+
+    def _generate(self, prompt: str) -> List[str]:
+        tokens = self._tokens(prompt)
+        acc = 0
+        for i in range(len(tokens)):
+            if self._weights.size:
+                # Чтение весов не копирует общие после fork страницы
+                acc += int(self._weights[i * 4096 % self._weights.size])
+            for j in range(self.token_work):
+                acc = (acc * 31 + j) & 0xFFFF
+        return tokens
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(text="".join(self._generate(prompt)))
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+        def gen() -> CompletionResponseGen:
+            text = ""
+            for token in self._generate(prompt):
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
+
+    @llm_completion_callback()
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return await asyncio.to_thread(self.complete, prompt, formatted=formatted)
+
+    @llm_completion_callback()
+    async def astream_complete(
+            self, prompt: str, formatted: bool = False, **kwargs: Any
+    ) -> CompletionResponseAsyncGen:
+        tokens = await asyncio.to_thread(self._generate, prompt)
+
+        async def gen() -> CompletionResponseAsyncGen:
+            text = ""
+            for token in tokens:
+                text += token
+                yield CompletionResponse(text=text, delta=token)
+
+        return gen()
@@ -0,0 +1,145 @@
+"""
+Время до первого токена локальной модели HuggingFace с кешем начал промптов (PrefixKVCache) и без него
+на разговорах из 1, 5 и 20 реплик. Реплики отправляются по очереди, как в чате, ответы модели
+добавляются в историю; измеряется последняя реплика. Перед разговорами в кеш попадает системный
+промпт другого разговора, как на работающем сервере. Без кеша тот же промпт последней реплики
+обрабатывается целиком.
+
+Нужны torch, transformers и llama-index-llms-huggingface; модель загружается из HuggingFace Hub.
+
+    python -m benchmarks.prefix_cache --model Qwen/Qwen2.5-0.5B-Instruct --turns 1 5 20 --repeats 3
+"""
+import argparse
+import json
+import os
+import random
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+from dotenv import load_dotenv
+
+_QUESTIONS = [
+    "Что грозит за кражу интеллектуальной собственности?",
+    "Как расторгнуть договор аренды досрочно?",
+    "Какой срок исковой давности по долгам?",
+    "Можно ли вернуть товар без чека?",
+    "Кто отвечает за ущерб при заливе квартиры?",
+    "Как оформить наследство без завещания?",
+    "Какие права у работника при сокращении?",
+    "Что делать, если не выплачивают зарплату?",
+    "Нужно ли платить налог с продажи машины?",
+    "Как оспорить штраф ГИБДД?",
+]
+
+
+def load_llm(model: str, max_new_tokens: int):
+    from llama_index.llms.huggingface import HuggingFaceLLM
+
+    return HuggingFaceLLM(
+        model_name=model,
+        tokenizer_name=model,
+        max_new_tokens=max_new_tokens,
+        generate_kwargs={"do_sample": False},
+    )
+
+
+def timed_generate(backend, prompt: str) -> Dict[str, Any]:
+    first_token: List[float] = []
+
+    def on_delta(_: str):
+        if not first_token:
+            first_token.append(time.perf_counter())
+
+    start = time.perf_counter()
+    text = backend.generate([prompt], [on_delta])[0]
+    end = time.perf_counter()
+    return {"text": text, "ttft_ms": ((first_token[0] if first_token else end) - start) * 1000}
+
+
+def conversation(llm, backend, system_prompt: str, turns: int, rng: random.Random) -> Dict[str, Any]:
+    """
+    Разговор из turns реплик через backend с кешем: промпт последней реплики и её замеры
+    """
+    from llama_index.core.llms import ChatMessage, MessageRole
+
+    messages = [ChatMessage(role=MessageRole.SYSTEM, content=system_prompt)]
+    result: Dict[str, Any] = {}
+    for _ in range(turns):
+        messages.append(ChatMessage(role=MessageRole.USER, content=rng.choice(_QUESTIONS)))
+        prompt = llm.messages_to_prompt(messages)
+        reused_before = backend.prefix_cache.stats.reused_tokens
+        result = timed_generate(backend, prompt)
+        result["prompt"] = prompt
+        result["reused_tokens"] = backend.prefix_cache.stats.reused_tokens - reused_before
+        messages.append(ChatMessage(role=MessageRole.ASSISTANT, content=result["text"]))
+    return result
+
+
+def run(llm, turns: int, repeats: int, system_prompt: str, args) -> Dict[str, Any]:
+    from app.engine.llm_scheduler import HuggingFaceBatchBackend
+    from app.engine.prefix_cache import PrefixKVCache
+
+    cache = PrefixKVCache(max_bytes=args.cache_mb * 1024 * 1024, block_tokens=args.block_tokens)
+    cached = HuggingFaceBatchBackend(llm, cache)
+    if cached.prefix_cache is None:
+        raise SystemExit("Модель не поддерживает кеш начал промптов")
+    uncached = HuggingFaceBatchBackend(llm, None)
+    rng = random.Random(turns)
+
+    # Системный промпт уже в кеше после другого разговора
+    conversation(llm, cached, system_prompt, 1, random.Random(-1))
+
+    ttft_on, ttft_off, prompt_tokens, reused = [], [], [], []
+    for _ in range(repeats):
+        last = conversation(llm, cached, system_prompt, turns, rng)
+        ttft_on.append(last["ttft_ms"])
+        reused.append(last["reused_tokens"])
+        prompt_tokens.append(cached.count_tokens(last["prompt"]))
+        ttft_off.append(timed_generate(uncached, last["prompt"])["ttft_ms"])
+
+    return {
+        "turns": turns,
+        "prompt_tokens": float(np.median(prompt_tokens)),
+        "reused_tokens": float(np.median(reused)),
+        "ttft_off_ms": float(np.median(ttft_off)),
+        "ttft_on_ms": float(np.median(ttft_on)),
+        "speedup": float(np.median(ttft_off) / np.median(ttft_on)),
+        "cache": cache.snapshot(),
+    }
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default=os.getenv("LLM_MODEL"))
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 5, 20])
+    parser.add_argument("--repeats", type=int, default=3, help="Разговоров на каждое число реплик")
+    parser.add_argument("--max-new-tokens", type=int, default=64, help="Длина ответов в истории")
+    parser.add_argument("--cache-mb", type=int, default=1024)
+    parser.add_argument("--block-tokens", type=int, default=int(os.getenv("PREFIX_CACHE_BLOCK_TOKENS", "64")))
+    parser.add_argument("--output", help="JSON с результатами")
+    args = parser.parse_args()
+
+    from app.engine.llm_scheduler import HuggingFaceBatchBackend
+
+    llm = load_llm(args.model, args.max_new_tokens)
+    # Прогрев: первые вызовы generate медленнее из-за инициализации ядер
+    timed_generate(HuggingFaceBatchBackend(llm), "Привет")
+
+    results = []
+    print(f"{'turns':>5} {'prompt':>7} {'reused':>7} {'TTFT off ms':>12} {'TTFT on ms':>11} {'speedup':>8}")
+    for turns in args.turns:
+        result = run(llm, turns, args.repeats, os.getenv("SYSTEM_PROMPT", ""), args)
+        results.append(result)
+        print(
+            f"{turns:>5} {result['prompt_tokens']:>7.0f} {result['reused_tokens']:>7.0f} "
+            f"{result['ttft_off_ms']:>12.1f} {result['ttft_on_ms']:>11.1f} {result['speedup']:>7.1f}x"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
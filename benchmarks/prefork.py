@@ -0,0 +1,191 @@
+"""
+Один процесс (python main.py) против serve.py с несколькими рабочими процессами: пропускная способность
+/api/query/complete при одновременных запросах и память всех процессов сервера.
+LLM заменена CpuBoundLLM: веса --weights-mb в памяти и вычисления на Python, удерживающие GIL.
+
+Память: RSS учитывает общие после fork страницы в каждом процессе, PSS делит их между процессами,
+поэтому сумма PSS — реальный расход памяти сервером.
+
+    python -m benchmarks.prefork --workers 4 --weights-mb 512 --concurrency 16 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from benchmarks.suite import _free_port, load_route, make_queries, use_workspace
+
+
+def use_cpu_bound_models(weights_mb: int, max_tokens: int, token_work: int):
+    # init_settings вызывается при запуске сервера (в главном процессе serve.py или в lifespan main.py)
+    import app.settings
+    from app.engine.tracing import traced_callback_manager
+    from benchmarks.mocks import CpuBoundLLM, HashingEmbedding
+
+    def init_settings(phase=None):
+        from llama_index.core.settings import Settings
+
+        Settings.callback_manager = traced_callback_manager()
+        Settings.llm = CpuBoundLLM(weights_mb=weights_mb, max_tokens=max_tokens, token_work=token_work)
+        Settings.embed_model = HashingEmbedding()
+
+    app.settings.init_settings = init_settings
+
+
+def serve_mode(args):
+    if args.serve == "single":
+        import uvicorn
+
+        use_cpu_bound_models(args.weights_mb, args.max_tokens, args.token_work)
+        uvicorn.run("main:app", host="127.0.0.1", port=int(os.environ["APP_PORT"]), log_level="warning")
+    else:
+        # serve импортируется первым: каталог метрик процессов задаётся до импорта приложения
+        import serve
+
+        use_cpu_bound_models(args.weights_mb, args.max_tokens, args.token_work)
+        raise SystemExit(serve.main())
+
+
+def process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return pids
+    for child in children:
+        pids.extend(process_tree(child))
+    return pids
+
+
+def memory_mb(pid: int) -> Dict[str, float]:
+    # Rss и Pss из smaps_rollup (Linux 4.14+) в килобайтах
+    totals = {"rss_mb": 0.0, "pss_mb": 0.0}
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/smaps_rollup") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in ("Rss", "Pss"):
+                        totals[f"{key.lower()}_mb"] += int(value.split()[0]) / 1024
+        except FileNotFoundError:
+            continue
+    return totals
+
+
+async def wait_ready(base_url: str, process: subprocess.Popen, timeout: float):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("Сервер бенчмарка завершился при запуске")
+            try:
+                if (await client.get("/health/ready")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"Сервер бенчмарка не запустился за {timeout:g} с")
+
+
+def run(mode: str, workers: int, preload: bool, args, workdir: str) -> Dict[str, Any]:
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    name = f"{mode}-{workers}-{int(preload)}"
+    use_workspace(workdir, name, None)
+    env = {
+        **os.environ,
+        "APP_HOST": "127.0.0.1",
+        "APP_PORT": str(port),
+        "SERVER_WORKERS": str(workers),
+        "SERVER_PRELOAD": str(preload),
+        # Запросы повторяются, с кешем ответов измерялся бы только кеш
+        "ANSWER_CACHE_ENABLED": "False",
+        "WARMUP_ENABLED": "False",
+        "STARTUP_MODE": "background",
+    }
+    command = [
+        sys.executable, "-m", "benchmarks.prefork", "--serve", mode, "--weights-mb", str(args.weights_mb),
+        "--max-tokens", str(args.max_tokens), "--token-work", str(args.token_work),
+    ]
+    # Журнал сервера не смешивается с выводом бенчмарка
+    log_path = os.path.join(workdir, f"{name}.log")
+    with open(log_path, "wb") as log:
+        process = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        start = time.perf_counter()
+        try:
+            asyncio.run(wait_ready(base_url, process, args.ready_timeout))
+        except (RuntimeError, TimeoutError):
+            with open(log_path, encoding="utf-8", errors="replace") as f:
+                print(f.read()[-4000:])
+            raise
+        ready = time.perf_counter() - start
+        idle = memory_mb(process.pid)
+        queries = make_queries(args.requests, args.seed)
+        load = asyncio.run(load_route(
+            base_url, "/api/query/complete", args.concurrency, args.requests, queries, args.request_timeout,
+        ))
+        loaded = memory_mb(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
+
+    return {
+        "mode": mode,
+        "workers": workers,
+        "preload": preload,
+        "ready_s": ready,
+        "idle_rss_mb": idle["rss_mb"],
+        "idle_pss_mb": idle["pss_mb"],
+        "rss_mb": loaded["rss_mb"],
+        "pss_mb": loaded["pss_mb"],
+        **{key: value for key, value in load.items() if key != "route"},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--weights-mb", type=int, default=512, help="Размер весов модели-заглушки")
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--token-work", type=int, default=20000, help="Итераций вычислений на токен")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--request-timeout", type=float, default=300)
+    parser.add_argument("--ready-timeout", type=float, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON с результатами")
+    parser.add_argument("--serve", choices=["single", "prefork"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_mode(args)
+        return
+
+    runs = [("single", 1, True), ("prefork", args.workers, False), ("prefork", args.workers, True)]
+    results = []
+    print(f"{'mode':>8} {'workers':>7} {'preload':>7} {'req/s':>8} {'p95 ms':>8} {'RSS MB':>8} {'PSS MB':>8}")
+    with tempfile.TemporaryDirectory(prefix="prefork-") as workdir:
+        for mode, workers, preload in runs:
+            result = run(mode, workers, preload, args, workdir)
+            results.append(result)
+            print(
+                f"{mode:>8} {workers:>7} {str(preload):>7} {result['throughput_rps']:>8.1f} "
+                f"{result['p95_ms']:>8.0f} {result['rss_mb']:>8.0f} {result['pss_mb']:>8.0f}"
+            )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,438 @@
+"""
+Офлайн набор бенчмарков API, генерации индекса и поиска. Модели заменены детерминированными
+(DeterministicLLM, HashingEmbedding), векторное хранилище — встроенная Chroma в --chroma-path
+(по умолчанию во временном каталоге прогона, чтобы не задеть рабочий CHROMA_PATH).
+
+Части:
+    api        пропускная способность и задержка p50/p95/p99 маршрутов /api/chat/request и /api/query/*
+               при заданном числе одновременных запросов; сервер uvicorn в отдельном процессе
+    ingestion  generate_datasource на синтетических корпусах растущего размера: документов в секунду
+               и пиковый RSS; каждый размер в отдельном процессе
+    retrieval  задержка векторного и гибридного поиска в зависимости от размера коллекции
+
+Результаты пишутся в JSON, два прогона сравниваются python -m benchmarks.compare.
+
+    python -m benchmarks.suite --output bench.json --concurrency 1 8 32 --requests 200 \\
+        --corpus-sizes 100 1000 5000 --collection-sizes 1000 10000 50000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+_BASE_WORDS = [
+    "статья", "кодекс", "закон", "пункт", "часть", "договор", "ответственность", "суд",
+    "налог", "имущество", "право", "обязанность", "срок", "лицо", "орган", "решение",
+]
+# Словарь с частотами по закону Ципфа, чтобы BM25 и эмбеддинги работали на правдоподобном распределении
+_VOCABULARY = _BASE_WORDS + [f"термин{i}" for i in range(5000)]
+_WEIGHTS = [1.0 / (rank + 1) for rank in range(len(_VOCABULARY))]
+
+ROUTES: Dict[str, Callable[[str], Dict[str, Any]]] = {
+    "/api/chat/request": lambda query: {"messages": [{"role": "user", "content": query}]},
+    "/api/query/complete": lambda query: {"query": query},
+    "/api/query/request-to-stored-index": lambda query: {"query": query},
+    "/api/query/request-agent": lambda query: {"query": query},
+    "/api/query/complete/stream": lambda query: {"query": query},
+    "/api/query/request-to-stored-index/stream": lambda query: {"query": query},
+    "/api/query/request-agent/stream": lambda query: {"query": query},
+}
+
+
+def synthetic_text(rng: random.Random, words: int) -> str:
+    tokens = rng.choices(_VOCABULARY, weights=_WEIGHTS, k=words)
+    sentences = [" ".join(tokens[i:i + 12]).capitalize() + "." for i in range(0, len(tokens), 12)]
+    return " ".join(sentences)
+
+
+def write_corpus(directory: str, documents: int, words: int, seed: int):
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(documents):
+        with open(os.path.join(directory, f"doc-{i:06d}.txt"), "w", encoding="utf-8") as f:
+            f.write(synthetic_text(rng, words))
+
+
+def make_queries(count: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    return [synthetic_text(rng, 6).rstrip(".") for _ in range(count)]
+
+
+def summarize(seconds: List[float], prefix: str = "") -> Dict[str, float]:
+    if not seconds:
+        return {}
+    values = np.asarray(seconds) * 1000
+    return {
+        f"{prefix}mean_ms": float(values.mean()),
+        f"{prefix}p50_ms": float(np.percentile(values, 50)),
+        f"{prefix}p95_ms": float(np.percentile(values, 95)),
+        f"{prefix}p99_ms": float(np.percentile(values, 99)),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if platform.system() == "Darwin" else rss / 1024
+
+
+def use_offline_models(max_tokens: int, first_token_latency: float, token_latency: float):
+    from llama_index.core.settings import Settings
+
+    from app.engine.tracing import traced_callback_manager
+    from benchmarks.mocks import DeterministicLLM, HashingEmbedding
+
+    Settings.callback_manager = traced_callback_manager()
+    Settings.llm = DeterministicLLM(
+        max_tokens=max_tokens,
+        first_token_latency=first_token_latency,
+        token_latency=token_latency,
+    )
+    Settings.embed_model = HashingEmbedding(embed_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")))
+    Settings.chunk_size = int(os.getenv("CHUNK_SIZE", "1024"))
+    Settings.chunk_overlap = int(os.getenv("CHUNK_OVERLAP", "20"))
+
+
+def use_workspace(workdir: str, name: str, chroma_path: Optional[str]) -> Dict[str, str]:
+    root = os.path.join(workdir, name)
+    env = {
+        "CHROMA_PATH": chroma_path or os.path.join(workdir, "chroma"),
+        "CHROMA_COLLECTION": f"bench-{name}",
+        "STORAGE_DIR": os.path.join(root, "storage"),
+        "STORAGE_CACHE_DIR": os.path.join(root, "cache"),
+        "DATA_DIR": os.path.join(root, "data"),
+    }
+    os.environ.update(env)
+    # Только встроенная Chroma
+    os.environ.pop("CHROMA_HOST", None)
+    return env
+
+
+def ingest(name: str, workdir: str, chroma_path: Optional[str], documents: int, words: int, seed: int,
+           models: Dict[str, Any]) -> Dict[str, Any]:
+    env = use_workspace(workdir, name, chroma_path)
+    write_corpus(env["DATA_DIR"], documents, words, seed)
+    use_offline_models(**models)
+
+    from app.engine import generate, loaders
+
+    # Модели уже заданы, источник — только синтетический корпус
+    generate.init_settings = lambda: None
+    generate.storage_dir = env["STORAGE_DIR"]
+    loaders.load_configs = lambda: {"file": {"path": env["DATA_DIR"]}}
+    logging.getLogger().setLevel(logging.WARNING)
+
+    baseline_rss = peak_rss_mb()
+    start = time.perf_counter()
+    generate.generate_datasource()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "documents": documents,
+        "words_per_document": words,
+        "seconds": elapsed,
+        "docs_per_sec": documents / elapsed,
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def bench_ingestion(args, workdir: str, models: Dict[str, Any]) -> List[Dict[str, Any]]:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    print(f"{'docs':>7} {'seconds':>9} {'docs/s':>8} {'peak RSS MB':>12}")
+    for documents in args.corpus_sizes:
+        # Отдельный процесс на размер: пиковый RSS не наследуется от предыдущих прогонов
+        with context.Pool(1) as pool:
+            result = pool.apply(ingest, (
+                f"ingestion-{documents}", workdir, args.chroma_path, documents, args.words, args.seed, models,
+            ))
+        results.append(result)
+        print(f"{documents:>7} {result['seconds']:>9.2f} {result['docs_per_sec']:>8.1f} {result['peak_rss_mb']:>12.1f}")
+    return results
+
+
+def bench_retrieval(args, workdir: str, models: Dict[str, Any]) -> List[Dict[str, Any]]:
+    env = use_workspace(workdir, "retrieval", args.chroma_path)
+    use_offline_models(**models)
+
+    from llama_index.core import VectorStoreIndex
+    from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+    from llama_index.core.settings import Settings
+
+    from app.engine.keyword_index import KeywordIndex
+    from app.engine.retriever import HybridRetriever
+    from app.engine.vectordb import get_collections_store, get_vector_store, shard_collection_name
+
+    vector_store = get_vector_store()
+    index = VectorStoreIndex.from_vector_store(vector_store)
+    # Те же узлы, разложенные по --shards коллекциям, для поиска с параллельным опросом коллекций
+    shard_names = [shard_collection_name(f"shard{i}") for i in range(args.shards)] if args.shards > 1 else []
+    shard_stores = [get_vector_store(name) for name in shard_names]
+    keyword_index = KeywordIndex(os.path.join(env["STORAGE_DIR"], "keyword_index"))
+    queries = make_queries(args.queries, args.seed + 1)
+    rng = random.Random(args.seed)
+
+    results = []
+    count = 0
+    print(f"{'nodes':>7} {'mode':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for size in sorted(args.collection_sizes):
+        while count < size:
+            nodes = []
+            for i in range(count, min(count + 1000, size)):
+                node = TextNode(id_=f"node-{i}", text=synthetic_text(rng, args.node_words))
+                node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=f"doc-{i // 4}")
+                nodes.append(node)
+            embeddings = Settings.embed_model.get_text_embedding_batch([node.text for node in nodes])
+            for node, embedding in zip(nodes, embeddings):
+                node.embedding = embedding
+            vector_store.add(nodes)
+            for i, shard_store in enumerate(shard_stores):
+                shard_store.add(nodes[i::len(shard_stores)])
+            keyword_index.add(nodes)
+            count += len(nodes)
+        keyword_index.persist()
+
+        retrievers = {
+            "vector": index.as_retriever(similarity_top_k=args.top_k),
+            "hybrid": HybridRetriever.from_env(index, keyword_index, similarity_top_k=args.top_k),
+        }
+        if shard_names:
+            sharded_index = VectorStoreIndex.from_vector_store(get_collections_store(shard_names))
+            retrievers["sharded"] = sharded_index.as_retriever(similarity_top_k=args.top_k)
+        for mode, retriever in retrievers.items():
+            retriever.retrieve(queries[0])
+            timings = []
+            for query in queries:
+                start = time.perf_counter()
+                retriever.retrieve(query)
+                timings.append(time.perf_counter() - start)
+            result = {"collection_size": size, "mode": mode, "queries": len(queries), **summarize(timings)}
+            results.append(result)
+            print(
+                f"{size:>7} {mode:>7} {result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f}"
+            )
+    return results
+
+
+def serve(port: int, workdir: str, chroma_path: Optional[str], documents: int, words: int, seed: int,
+          models: Dict[str, Any]):
+    ingest("api", workdir, chroma_path, documents, words, seed, models)
+
+    import uvicorn
+    from fastapi import FastAPI
+
+    from app.api.routers import api_router
+    from app.api.services.metrics import TracingMiddleware
+    from app.engine.registry import engine_registry
+
+    # Приложение как в main.py, но без init_settings: модели уже заменены
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware)
+    app.include_router(api_router, prefix="/api")
+    engine_registry.load()
+
+    # Журнал запросов сервера не смешивается с выводом бенчмарка
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_config=None, access_log=False)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_ready(base_url: str, process, timeout: float):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as client:
+        while time.monotonic() < deadline:
+            if not process.is_alive():
+                raise RuntimeError("Сервер бенчмарка завершился при запуске")
+            try:
+                if (await client.get("/docs")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"Сервер бенчмарка не запустился за {timeout:g} с")
+
+
+async def load_route(base_url: str, path: str, concurrency: int, requests: int, queries: List[str],
+                     timeout: float) -> Dict[str, Any]:
+    import httpx
+
+    body = ROUTES[path]
+    latencies: List[float] = []
+    first_bytes: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(
+            base_url=base_url,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=concurrency),
+    ) as client:
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                first_byte = None
+                try:
+                    async with client.stream("POST", path, json=body(queries[i % len(queries)])) as response:
+                        async for _ in response.aiter_bytes():
+                            if first_byte is None:
+                                first_byte = time.perf_counter()
+                        ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if not ok:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - start)
+                first_bytes.append((first_byte or time.perf_counter()) - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(requests)])
+        elapsed = time.perf_counter() - start
+
+    return {
+        "route": path,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed,
+        **summarize(latencies),
+        **summarize(first_bytes, prefix="first_byte_"),
+    }
+
+
+def bench_api(args, workdir: str, models: Dict[str, Any]) -> List[Dict[str, Any]]:
+    if not args.answer_cache:
+        # Запросы повторяются, с кешем ответов измерялся бы только кеш
+        os.environ["ANSWER_CACHE_ENABLED"] = "False"
+
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    context = multiprocessing.get_context("spawn")
+    process = context.Process(
+        target=serve,
+        args=(port, workdir, args.chroma_path, args.api_documents, args.words, args.seed, models),
+        daemon=True,
+    )
+    process.start()
+
+    results = []
+    try:
+        asyncio.run(_wait_ready(base_url, process, args.startup_timeout))
+        queries = make_queries(args.queries, args.seed + 2)
+        print(f"{'route':<42} {'conc':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+        for path in args.routes:
+            for concurrency in args.concurrency:
+                result = asyncio.run(load_route(base_url, path, concurrency, args.requests, queries, args.timeout))
+                results.append(result)
+                print(
+                    f"{path:<42} {concurrency:>5} {result['throughput_rps']:>8.1f} "
+                    f"{result.get('p50_ms', 0):>8.1f} {result.get('p95_ms', 0):>8.1f} "
+                    f"{result.get('p99_ms', 0):>8.1f} {result['errors']:>6}"
+                )
+    finally:
+        process.terminate()
+        process.join()
+    return results
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--parts", nargs="+", choices=["api", "ingestion", "retrieval"],
+                        default=["api", "ingestion", "retrieval"])
+    parser.add_argument("--chroma-path", default=None)
+    parser.add_argument("--keep", action="store_true", help="не удалять рабочий каталог")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--words", type=int, default=400, help="слов в документе корпуса")
+    # Модель
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--first-token-latency", type=float, default=0.05)
+    parser.add_argument("--token-latency", type=float, default=0.005)
+    # API
+    parser.add_argument("--routes", nargs="+", choices=list(ROUTES), default=list(ROUTES))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--api-documents", type=int, default=200)
+    parser.add_argument("--answer-cache", action="store_true")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    # Генерация индекса
+    parser.add_argument("--corpus-sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    # Поиск
+    parser.add_argument("--collection-sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--node-words", type=int, default=120)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--shards", type=int, default=4, help="коллекций для режима sharded (0 — не измерять)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.getLogger("uvicorn").setLevel(logging.WARNING)
+
+    models = {
+        "max_tokens": args.max_tokens,
+        "first_token_latency": args.first_token_latency,
+        "token_latency": args.token_latency,
+    }
+    workdir = tempfile.mkdtemp(prefix="bench-suite-")
+    report: Dict[str, Any] = {
+        "meta": {
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+    }
+
+    parts = {"api": bench_api, "ingestion": bench_ingestion, "retrieval": bench_retrieval}
+    try:
+        for part in args.parts:
+            print(f"\n== {part}")
+            report[part] = parts[part](args, workdir, models)
+            # Результаты сохраняются после каждой части
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\nРезультаты: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Задержка цикла событий под нагрузкой инструментов агента с подменёнными сетевыми бэкендами
+(DuckDuckGo и Википедия отвечают через time.sleep).
+
+Сравниваются: синхронный вызов инструмента в цикле событий, асинхронный вызов исходного
+FunctionTool и инструменты из ToolFactory (пул потоков, лимиты, таймауты, кеш).
+
+    python -m benchmarks.tools_event_loop --calls 64 --latency 0.2 --distinct 16
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+import types
+from typing import List
+
+
+def install_stub_backends(latency: float):
+    class DDGS:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def text(self, keywords, region, max_results):
+            time.sleep(latency)
+            return [{"title": f"{keywords} {i}", "href": "https://example.org", "body": "..."} for i in range(3)]
+
+    duckduckgo = types.ModuleType("duckduckgo_search")
+    duckduckgo.DDGS = DDGS
+    sys.modules["duckduckgo_search"] = duckduckgo
+
+    from app.engine.tools import wikipedia_pages
+
+    def api(lang, params):
+        time.sleep(latency)
+        if params.get("list") == "search":
+            return {"query": {"search": [{"title": params["srsearch"]}]}}
+        title = params["titles"]
+        return {"query": {"pages": [{
+            "title": title,
+            "revisions": [{"revid": 1}],
+            "extract": f"Статья {title}\n\n== Раздел ==\nТекст раздела.",
+        }]}}
+
+    # Страницы не кешируются на диске, чтобы каждый вызов шёл в «сеть»
+    wikipedia_pages._api = api
+    wikipedia_pages._cache = wikipedia_pages.WikipediaPageCache(tempfile.mkdtemp(), ttl=0)
+
+    from llama_index.core.embeddings import MockEmbedding
+    from llama_index.core.settings import Settings
+
+    Settings.embed_model = MockEmbedding(embed_dim=8)
+
+
+async def heartbeat(lags: List[float], stop: asyncio.Event, interval: float = 0.005):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - start - interval)
+
+
+async def run_load(tools, calls: int, distinct: int, mode: str):
+    lags: List[float] = []
+    stop = asyncio.Event()
+    beat = asyncio.create_task(heartbeat(lags, stop))
+    await asyncio.sleep(0.02)
+
+    async def one(i: int):
+        tool = tools[i % len(tools)]
+        argument = f"вопрос {i % distinct}"
+        kwargs = {"query": argument} if "search" in tool.metadata.name else {"page": argument}
+        if mode == "blocking":
+            tool.call(**kwargs)
+        else:
+            await tool.acall(**kwargs)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(calls)])
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await beat
+    lags.sort()
+    return elapsed, lags
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--distinct", type=int, default=16)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    install_stub_backends(args.latency)
+
+    from app.engine.tools import ToolFactory
+    from app.engine.tools import duckduckgo_tool, wikipedia_tool
+
+    plain = duckduckgo_tool.get_tools() + wikipedia_tool.get_tools()
+    execution = {"timeout": 10, "max_concurrency": args.max_concurrency, "cache_ttl": 300}
+    managed = ToolFactory.load_tools("duckduckgo_tool", execution) + ToolFactory.load_tools("wikipedia_tool", execution)
+
+    print(f"{'mode':<22} {'total s':>8} {'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11}")
+    for name, tools, mode in (
+            ("blocking call", plain, "blocking"),
+            ("FunctionTool.acall", plain, "async"),
+            ("ToolFactory", managed, "async"),
+            ("ToolFactory (cached)", managed, "async"),
+    ):
+        elapsed, lags = asyncio.run(run_load(tools, args.calls, args.distinct, mode))
+        p50 = lags[len(lags) // 2] if lags else 0.0
+        p99 = lags[min(int(len(lags) * 0.99), len(lags) - 1)] if lags else 0.0
+        worst = lags[-1] if lags else 0.0
+        print(f"{name:<22} {elapsed:>8.2f} {p50 * 1000:>11.2f} {p99 * 1000:>11.2f} {worst * 1000:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,23 +1,87 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
+from llama_index.core.settings import Settings
 
 from app.api.routers import api_router
-from app.settings import init_settings
+from app.api.routers.health import health_router
+from app.api.services.metrics import TracingMiddleware, metrics_response
+from app.api.services.readiness import ReadinessMiddleware
+from app.api.services.sessions import get_chat_sessions
+from app.api.services.suggestion import get_suggestions
+from app.engine.filters import MetadataFilterError
+from app.engine.llm_scheduler import BatchingLLM, LLMOverloadedError
+from app.engine.reranker import close_reranker
+from app.engine.vectordb import UnknownCollectionError, vector_store_manager
+from app.startup import StartupConfig, start
 
 load_dotenv()
 
 APP_HOST = os.getenv("APP_HOST", "0.0.0.0")
 APP_PORT = int(os.getenv("APP_PORT", "8000"))
+APP_RELOAD = os.getenv("APP_RELOAD", "False").lower() == "true"
 
-app = FastAPI()
 
-init_settings()
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # Модели, индекс и инструменты загружаются один раз и переиспользуются всеми запросами.
+    # В режиме background порт открыт сразу, готовность — /health/ready
+    config = StartupConfig.from_env()
+    startup_task = None
+    if config.mode == "blocking":
+        await start(config)
+    else:
+        startup_task = asyncio.create_task(start(config))
+        # Ошибка запуска уже в журнале и в /health; исключение задачи считается полученным
+        startup_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+    sessions = get_chat_sessions()
+    suggestions = get_suggestions()
+    yield
+    if startup_task is not None and not startup_task.done():
+        startup_task.cancel()
+    if sessions is not None:
+        # Сжатие истории обращается к LLM, поэтому завершается до остановки планировщика
+        await sessions.wait_compactions()
+    if suggestions is not None:
+        # Подсказки не нужны после остановки, их генерация отменяется
+        await suggestions.close()
+    # Settings.llm без загруженной модели создал бы модель по умолчанию
+    if isinstance(Settings._llm, BatchingLLM):
+        Settings.llm.scheduler.close()
+    vector_store_manager.close()
+    close_reranker()
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ReadinessMiddleware)
+app.add_middleware(TracingMiddleware)
+
+
+@app.exception_handler(LLMOverloadedError)
+async def llm_overloaded_handler(_: Request, exc: LLMOverloadedError):
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
+
+@app.exception_handler(UnknownCollectionError)
+@app.exception_handler(MetadataFilterError)
+async def bad_search_request_handler(_: Request, exc: ValueError):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
+
 
 app.include_router(api_router, prefix="/api")
+app.include_router(health_router, prefix="/health")
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    # Гистограммы в формате Prometheus: запросы, поиск, эмбеддинги, LLM, инструменты, очереди
+    return metrics_response()
 
 
 def mount_static(directory: str, path: str):
@@ -29,4 +93,4 @@ mount_static("storage", "/api/files/data")
 mount_static("output", "/api/files/output")
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host=APP_HOST, port=APP_PORT, reload=True)
+    uvicorn.run("main:app", host=APP_HOST, port=APP_PORT, reload=APP_RELOAD)
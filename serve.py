@@ -0,0 +1,212 @@
+"""
+Запуск для эксплуатации: главный процесс загружает модели один раз, открывает порт и создаёт
+SERVER_WORKERS рабочих процессов через fork. Веса моделей остаются общими страницами памяти
+(copy-on-write), а запросы обрабатываются параллельно на нескольких ядрах, не упираясь в GIL.
+
+    python serve.py
+
+Индекс, клиенты Chroma, потоки и пулы каждый рабочий процесс открывает сам после fork.
+Главный процесс не выполняет вычислений моделей: пулы потоков torch/OpenMP не переживают fork.
+"""
+import gc
+import logging
+import os
+import shutil
+import signal
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import uvicorn
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("uvicorn")
+
+
+@dataclass
+class ServerConfig:
+    host: str = "0.0.0.0"
+    port: int = 8000
+    workers: int = 1
+    # Загрузить модели в главном процессе до fork (иначе каждый рабочий процесс загружает свою копию)
+    preload: bool = True
+    # Одновременных соединений на рабочий процесс, сверх этого — 503
+    limit_concurrency: Optional[int] = None
+    # Потоков torch на рабочий процесс (по умолчанию ядра делятся между процессами поровну)
+    torch_threads: Optional[int] = None
+    graceful_timeout: float = 30.0
+
+    @classmethod
+    def from_env(cls) -> "ServerConfig":
+        workers = max(int(os.getenv("SERVER_WORKERS", "1")), 1)
+        limit_concurrency = os.getenv("WORKER_LIMIT_CONCURRENCY")
+        torch_threads = os.getenv("WORKER_TORCH_THREADS")
+        return cls(
+            host=os.getenv("APP_HOST", "0.0.0.0"),
+            port=int(os.getenv("APP_PORT", "8000")),
+            workers=workers,
+            preload=os.getenv("SERVER_PRELOAD", "True").lower() == "true",
+            limit_concurrency=int(limit_concurrency) if limit_concurrency else None,
+            torch_threads=int(torch_threads) if torch_threads else max((os.cpu_count() or 1) // workers, 1),
+            graceful_timeout=float(os.getenv("SERVER_GRACEFUL_TIMEOUT", "30")),
+        )
+
+
+def prepare_metrics_dir() -> str:
+    # Метрики процессов собираются из файлов в общем каталоге; его нужно задать до импорта prometheus_client
+    path = os.environ.setdefault(
+        "PROMETHEUS_MULTIPROC_DIR", os.path.join(os.getenv("STORAGE_CACHE_DIR", ".cache"), "prometheus"),
+    )
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# До импорта приложения: prometheus_client выбирает способ хранения метрик при импорте
+prepare_metrics_dir()
+
+
+def set_torch_threads(threads: Optional[int]):
+    if not threads:
+        return
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(threads)
+
+
+class Supervisor:
+    """
+    Главный процесс: создаёт рабочие процессы, перезапускает завершившиеся и останавливает их по SIGTERM/SIGINT.
+    Если процесс падает сразу после запуска, сервер останавливается, а не перезапускает его бесконечно
+    """
+
+    # Процесс, завершившийся с ошибкой быстрее этого (в секундах), считается не запустившимся.
+    # Остановленный сигналом процесс (например, OOM killer) перезапускается всегда
+    crash_window: float = 5.0
+
+    def __init__(self, config: ServerConfig, uvicorn_config: uvicorn.Config):
+        self.config = config
+        self.uvicorn_config = uvicorn_config
+        self.workers: Dict[int, float] = {}
+        self.stopping = False
+        self.exit_code = 0
+
+    def run(self) -> int:
+        sock = self.uvicorn_config.bind_socket()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self.config.workers):
+            self._spawn(sock)
+        logger.info(f"Главный процесс {os.getpid()}: рабочих процессов {self.config.workers}")
+
+        while not self.stopping:
+            for pid, started_at, code in self._reap():
+                if code > 0 and time.monotonic() - started_at < self.crash_window:
+                    logger.error(f"Рабочий процесс {pid} завершился при запуске с кодом {code}, сервер остановлен")
+                    self.exit_code = 1
+                    self.stopping = True
+                    break
+                logger.warning(f"Рабочий процесс {pid} завершился с кодом {code}, запускается новый")
+                self._spawn(sock)
+            time.sleep(0.5)
+
+        self._shutdown()
+        sock.close()
+        return self.exit_code
+
+    def _spawn(self, sock):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._serve(sock)
+                code = 0
+            except BaseException:
+                logger.exception("Ошибка рабочего процесса")
+            finally:
+                os._exit(code)
+        self.workers[pid] = time.monotonic()
+
+    def _serve(self, sock):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        set_torch_threads(self.config.torch_threads)
+        server = uvicorn.Server(self.uvicorn_config)
+        server.run(sockets=[sock])
+        if not server.started:
+            raise RuntimeError("Сервер не запустился")
+
+    def _reap(self) -> List[Tuple[int, float, int]]:
+        # Завершившиеся рабочие процессы: (pid, время запуска, код завершения)
+        from prometheus_client import multiprocess
+
+        exited = []
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            if pid in self.workers:
+                multiprocess.mark_process_dead(pid)
+                exited.append((pid, self.workers.pop(pid), os.waitstatus_to_exitcode(status)))
+        return exited
+
+    def _stop(self, signum, _frame):
+        logger.info(f"Получен сигнал {signal.Signals(signum).name}, остановка рабочих процессов")
+        self.stopping = True
+
+    def _shutdown(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # Рабочие процессы завершают текущие запросы; по истечении срока они останавливаются принудительно
+        deadline = time.monotonic() + self.config.graceful_timeout
+        while self.workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.workers):
+            logger.warning(f"Рабочий процесс {pid} не завершился за {self.config.graceful_timeout} с")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        while self.workers:
+            self._reap()
+            time.sleep(0.1)
+
+
+def main() -> int:
+    config = ServerConfig.from_env()
+    # Токенизаторы HuggingFace не переносят fork после использования своего пула потоков
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    uvicorn_config = uvicorn.Config(
+        "main:app",
+        host=config.host,
+        port=config.port,
+        limit_concurrency=config.limit_concurrency,
+        timeout_graceful_shutdown=config.graceful_timeout,
+    )
+    uvicorn_config.load()
+
+    sessions_in_memory = os.getenv("SESSION_BACKEND", "memory") == "memory"
+    if config.workers > 1 and sessions_in_memory and os.getenv("SESSIONS_ENABLED", "True").lower() == "true":
+        logger.warning("Сессии чата хранятся в памяти каждого процесса отдельно, для нескольких процессов "
+                       "нужен SESSION_BACKEND=sqlite")
+
+    if config.preload:
+        from app.startup import preload_models
+
+        preload_models()
+    # Объекты, созданные до fork, не обходятся сборщиком мусора и их страницы не копируются рабочими процессами
+    gc.collect()
+    gc.freeze()
+    return Supervisor(config, uvicorn_config).run()
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+from llama_index.core import Document
+from llama_index.core.storage.docstore import SimpleDocumentStore
+
+from app.engine.docstore import SQLiteDocumentStore, SQLiteKVStore, migrate_json_storage
+
+
+@pytest.fixture
+def kvstore(tmp_path):
+    store = SQLiteKVStore(str(tmp_path / "docstore.sqlite3"))
+    yield store
+    store.close()
+
+
+def test_put_get_delete(kvstore):
+    kvstore.put("a", {"value": 1})
+    kvstore.put("b", {"value": 2}, collection="other")
+
+    assert kvstore.get("a") == {"value": 1}
+    assert kvstore.get("b") is None
+    assert kvstore.get_all(collection="other") == {"b": {"value": 2}}
+    assert kvstore.keys(collection="other") == ["b"]
+    assert kvstore.delete("a")
+    assert not kvstore.delete("a")
+
+
+def test_nested_transaction_commits_with_outer(tmp_path, kvstore):
+    with kvstore.transaction():
+        with kvstore.transaction():
+            kvstore.put("a", {"value": 1})
+        # Вложенная транзакция не фиксируется отдельно: другое соединение записи ещё не видит
+        other = SQLiteKVStore(kvstore.path)
+        try:
+            assert other.get("a") is None
+        finally:
+            other.close()
+
+    assert kvstore.get("a") == {"value": 1}
+
+
+def test_error_in_nested_transaction_rolls_back_outer(kvstore):
+    kvstore.put("kept", {"value": 0})
+    with pytest.raises(RuntimeError):
+        with kvstore.transaction():
+            kvstore.put("a", {"value": 1})
+            with kvstore.transaction():
+                kvstore.put("b", {"value": 2})
+                raise RuntimeError("сбой")
+
+    assert kvstore.get("a") is None
+    assert kvstore.get("b") is None
+    assert kvstore.get("kept") == {"value": 0}
+
+    # После отката хранилище снова принимает транзакции
+    with kvstore.transaction():
+        kvstore.put("c", {"value": 3})
+    assert kvstore.get("c") == {"value": 3}
+
+
+def test_document_ids_keep_documents_with_equal_content(kvstore):
+    docstore = SQLiteDocumentStore(kvstore)
+    documents = [Document(id_="a", text="одинаковый"), Document(id_="b", text="одинаковый")]
+    docstore.set_document_hashes({document.id_: document.hash for document in documents})
+
+    assert sorted(docstore.document_ids()) == ["a", "b"]
+    # В словаре хешей документы с одинаковым содержимым схлопываются
+    assert len(docstore.get_all_document_hashes()) == 1
+
+
+def test_migrate_json_storage(tmp_path):
+    storage_dir = str(tmp_path / "storage")
+    json_store = SimpleDocumentStore()
+    json_store.add_documents([Document(id_="a", text="первый"), Document(id_="b", text="второй")])
+    json_store.persist(os.path.join(storage_dir, "docstore.json"))
+    index_store_path = os.path.join(storage_dir, "index_store.json")
+    with open(index_store_path, "w", encoding="utf-8") as f:
+        f.write("{}")
+
+    docstore = SQLiteDocumentStore.from_env(storage_dir)
+    try:
+        assert docstore.get_document("a").text == "первый"
+        assert sorted(docstore.document_ids()) == ["a", "b"]
+    finally:
+        docstore.kvstore.close()
+
+    assert not os.path.exists(os.path.join(storage_dir, "docstore.json"))
+    assert os.path.exists(os.path.join(storage_dir, "docstore.json.migrated"))
+    # index_store.json не используется и не переносится
+    assert os.path.exists(index_store_path)
+
+
+def test_migrate_json_storage_runs_once(tmp_path, kvstore):
+    storage_dir = str(tmp_path / "storage")
+    json_store = SimpleDocumentStore()
+    json_store.add_documents([Document(id_="a", text="первый")])
+    json_store.persist(os.path.join(storage_dir, "docstore.json"))
+
+    migrate_json_storage(storage_dir, kvstore)
+    SQLiteDocumentStore(kvstore).delete_document("a")
+    migrate_json_storage(storage_dir, kvstore)
+
+    assert SQLiteDocumentStore(kvstore).get_document("a", raise_error=False) is None
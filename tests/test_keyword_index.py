@@ -0,0 +1,129 @@
+import os
+
+from typing import Optional
+
+import pytest
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+
+from app.engine.keyword_index import KeywordIndex, tokenize
+
+
+def _node(node_id: str, text: str, ref_doc_id: Optional[str] = None) -> TextNode:
+    relationships = {}
+    if ref_doc_id is not None:
+        relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id=ref_doc_id)
+    return TextNode(id_=node_id, text=text, relationships=relationships)
+
+
+def _ids(results):
+    return [node_id for node_id, _ in results]
+
+
+@pytest.fixture
+def index(tmp_path):
+    return KeywordIndex(str(tmp_path / "keyword_index"), max_segments=8)
+
+
+def test_tokenize_normalizes_case_and_yo():
+    assert tokenize("Ёлка, статья 15.1") == ["елка", "статья", "15", "1"]
+
+
+def test_nodes_searchable_after_persist(index):
+    index.add([_node("a", "налоговый кодекс статья"), _node("b", "трудовой кодекс")])
+    assert index.search("налоговый", top_k=5) == []
+
+    index.persist()
+
+    assert _ids(index.search("налоговый", top_k=5)) == ["a"]
+    assert set(_ids(index.search("кодекс", top_k=5))) == {"a", "b"}
+
+
+def test_search_ranks_by_term_frequency(index):
+    index.add([
+        _node("rare", "договор аренды помещения и прочие условия"),
+        _node("often", "договор договор договор аренды"),
+        _node("none", "трудовой кодекс"),
+    ])
+    index.persist()
+
+    assert _ids(index.search("договор", top_k=5)) == ["often", "rare"]
+
+
+def test_delete_marks_tombstone_without_merge(index):
+    index.add([_node(f"n{i}", f"общий текст {i}", ref_doc_id=f"doc{i}") for i in range(8)])
+    index.persist()
+
+    index.delete_documents(["doc3"])
+    index.persist()
+
+    assert "n3" not in _ids(index.search("общий", top_k=10))
+    assert len(index) == 7
+    # Одна удалённая запись из восьми не вызывает слияния
+    assert len(index._segments) == 1
+    assert index._deleted == {index._segments[0].name: {3}}
+
+
+def test_tombstones_survive_reload(tmp_path, index):
+    index.add([_node(f"n{i}", f"общий текст {i}", ref_doc_id=f"doc{i}") for i in range(8)])
+    index.persist()
+    index.delete_documents(["doc0"])
+    index.persist()
+
+    reloaded = KeywordIndex.load(str(tmp_path))
+
+    assert len(reloaded) == 7
+    assert "n0" not in _ids(reloaded.search("общий", top_k=10))
+    assert "doc0" not in reloaded._doc_nodes
+
+
+def test_pending_nodes_of_deleted_document_are_dropped(index):
+    index.add([_node("a", "текст", ref_doc_id="doc")])
+    index.delete_documents(["doc"])
+    index.persist()
+
+    assert index.is_empty
+    assert index.search("текст", top_k=5) == []
+
+
+def test_merge_drops_deleted_and_keeps_scores(tmp_path):
+    merged = KeywordIndex(str(tmp_path / "merged"), max_segments=2)
+    for batch in range(3):
+        merged.add([
+            _node(f"b{batch}n{i}", f"закон {'статья ' * i}пункт {batch}", ref_doc_id=f"doc{batch}-{i}")
+            for i in range(4)
+        ])
+        if batch == 2:
+            merged.delete_documents(["doc1-2"])
+        # Третий сегмент превышает max_segments: все сегменты сливаются в один
+        merged.persist()
+
+    assert len(merged._segments) == 1
+    assert merged._deleted == {}
+    assert len(merged) == 11
+
+    fresh = KeywordIndex(str(tmp_path / "fresh"))
+    fresh.add([
+        _node(f"b{batch}n{i}", f"закон {'статья ' * i}пункт {batch}", ref_doc_id=f"doc{batch}-{i}")
+        for batch in range(3)
+        for i in range(4)
+        if (batch, i) != (1, 2)
+    ])
+    fresh.persist()
+
+    # После слияния оценки BM25 совпадают с индексом, построенным без удалённого узла
+    expected = dict(fresh.search("статья закон", top_k=20))
+    actual = dict(merged.search("статья закон", top_k=20))
+    assert actual.keys() == expected.keys()
+    for node_id, score in expected.items():
+        assert actual[node_id] == pytest.approx(score)
+
+
+def test_merge_removes_replaced_segment_directories(tmp_path):
+    index = KeywordIndex(str(tmp_path / "keyword_index"), max_segments=1)
+    index.add([_node("a", "первый")])
+    index.persist()
+    index.add([_node("b", "второй")])
+    index.persist()
+
+    assert sorted(os.listdir(index.path)) == sorted(["meta.json", "vocab.json", index._segments[0].name])
+    assert set(_ids(index.search("первый второй", top_k=5))) == {"a", "b"}
@@ -0,0 +1,132 @@
+from typing import List, Sequence
+
+import numpy as np
+
+from app.engine.prefix_cache import PrefixKVCache, kv_cache_nbytes
+
+
+class _Tensor(np.ndarray):
+    def clone(self) -> "_Tensor":
+        return self.copy()
+
+
+class _DynamicCache:
+    """
+    Кеш с интерфейсом DynamicCache из transformers (key_cache/value_cache по слоям)
+    """
+
+    def __init__(self):
+        self.key_cache: List[_Tensor] = []
+        self.value_cache: List[_Tensor] = []
+
+    def update(self, keys, values, layer_idx: int):
+        if layer_idx < len(self.key_cache):
+            self.key_cache[layer_idx] = np.concatenate([self.key_cache[layer_idx], keys], axis=-2).view(_Tensor)
+            self.value_cache[layer_idx] = np.concatenate([self.value_cache[layer_idx], values], axis=-2).view(_Tensor)
+        else:
+            self.key_cache.append(keys)
+            self.value_cache.append(values)
+
+    def get_seq_length(self) -> int:
+        return self.key_cache[0].shape[-2] if self.key_cache else 0
+
+    def crop(self, length: int):
+        self.key_cache = [keys[..., :length, :] for keys in self.key_cache]
+        self.value_cache = [values[..., :length, :] for values in self.value_cache]
+
+
+def _cache(token_ids: Sequence[int], layers: int = 2) -> _DynamicCache:
+    # Ключ позиции — её токен, чтобы по кешу было видно, какая последовательность в нём
+    cache = _DynamicCache()
+    keys = np.asarray(token_ids, dtype=np.float32).reshape(1, 1, -1, 1).repeat(2, axis=-1).view(_Tensor)
+    for layer_idx in range(layers):
+        cache.update(keys.copy().view(_Tensor), (-keys).view(_Tensor), layer_idx)
+    return cache
+
+
+def _tokens(cache: _DynamicCache) -> List[int]:
+    return cache.key_cache[0][0, 0, :, 0].astype(int).tolist()
+
+
+def test_lookup_finds_longest_common_block_prefix():
+    prefix_cache = PrefixKVCache(max_bytes=1 << 20, block_tokens=4)
+    stored = list(range(12))
+    prefix_cache.store(stored, _cache(stored))
+
+    cache, length = prefix_cache.lookup(list(range(9)) + [100, 101, 102])
+
+    assert length == 8
+    assert _tokens(cache) == list(range(8))
+    assert len(cache.key_cache) == 2
+
+
+def test_lookup_leaves_last_prompt_token_to_model():
+    prefix_cache = PrefixKVCache(max_bytes=1 << 20, block_tokens=4)
+    prefix_cache.store(list(range(8)), _cache(range(8)))
+
+    _, length = prefix_cache.lookup(list(range(8)))
+
+    assert length == 4
+
+
+def test_lookup_miss():
+    prefix_cache = PrefixKVCache(max_bytes=1 << 20, block_tokens=4)
+    prefix_cache.store(list(range(8)), _cache(range(8)))
+
+    assert prefix_cache.lookup([100] + list(range(1, 8))) == (None, 0)
+
+
+def test_lookup_returns_independent_prefix_copy():
+    prefix_cache = PrefixKVCache(max_bytes=1 << 20, block_tokens=4)
+    prefix_cache.store(list(range(12)), _cache(range(12)))
+
+    cache, _ = prefix_cache.lookup(list(range(6)))
+    cache.key_cache[0][...] = -1
+    cache.update(cache.key_cache[0], cache.value_cache[0], 0)
+
+    again, length = prefix_cache.lookup(list(range(6)))
+    assert _tokens(again) == list(range(length))
+    # Копируется только использованное начало, а не вся запись
+    assert kv_cache_nbytes(again) == kv_cache_nbytes(_cache(range(4)))
+
+
+def test_store_keeps_whole_blocks_and_skips_duplicates():
+    prefix_cache = PrefixKVCache(max_bytes=1 << 20, block_tokens=4)
+    prefix_cache.store(list(range(10)), _cache(range(10)))
+    prefix_cache.store(list(range(8)), _cache(range(8)))
+
+    assert prefix_cache.snapshot()["entries"] == 1
+    assert prefix_cache._size == kv_cache_nbytes(_cache(range(8)))
+
+
+def test_evicts_least_recently_used():
+    entry_bytes = kv_cache_nbytes(_cache(range(8)))
+    prefix_cache = PrefixKVCache(max_bytes=entry_bytes * 2, block_tokens=4)
+    first, second, third = list(range(8)), list(range(100, 108)), list(range(200, 208))
+    prefix_cache.store(first, _cache(first))
+    prefix_cache.store(second, _cache(second))
+    prefix_cache.lookup(first + [0])
+    prefix_cache.store(third, _cache(third))
+
+    assert prefix_cache.lookup(second + [0]) == (None, 0)
+    assert prefix_cache.lookup(first + [0])[1] == 8
+    assert prefix_cache.lookup(third + [0])[1] == 8
+    assert prefix_cache.snapshot()["evictions"] == 1
+
+
+def test_eviction_keeps_shared_blocks_of_live_entry():
+    entry_bytes = kv_cache_nbytes(_cache(range(8)))
+    prefix_cache = PrefixKVCache(max_bytes=entry_bytes * 2, block_tokens=4)
+    older = [1, 2, 3, 4, 5, 6, 7, 8]
+    newer = [1, 2, 3, 4, 50, 60, 70, 80]
+    prefix_cache.store(older, _cache(older))
+    # Более новая запись с тем же первым блоком
+    prefix_cache.store(newer, _cache(newer))
+    prefix_cache.lookup(older + [0])
+    other = list(range(100, 108))
+    prefix_cache.store(other, _cache(other))
+
+    # Вытеснена более новая запись, общий первый блок по-прежнему находится через старую
+    cache, length = prefix_cache.lookup([1, 2, 3, 4, 9, 9, 9, 9])
+    assert length == 4
+    assert _tokens(cache) == [1, 2, 3, 4]